@@ -7,6 +7,51 @@ import sys
 import os
 import re
 import subprocess
+import threading
+import time
+from collections import namedtuple
+
+
+class ADBResult(namedtuple('ADBResult', ['stdout', 'stderr', 'returncode', 'elapsed'])):
+    '''
+    Immutable result of one adb command, elapsed is in seconds
+    '''
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    @property
+    def timed_out(self):
+        return False
+
+
+class ADBTimeout(ADBResult):
+    '''
+    Result of a command killed at its deadline, stdout and stderr hold what
+    it wrote until then
+    '''
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return False
+
+    @property
+    def timed_out(self):
+        return True
+
+
+class ADBTimeoutError(TimeoutError):
+    '''
+    Raised by callers that can't go on without the output of a command that
+    timed out, carries its ADBTimeout
+    '''
+    def __init__(self, result, cmd=None):
+        super(ADBTimeoutError, self).__init__(
+            "adb %s timed out after %.1fs" % (' '.join(cmd or []), result.elapsed))
+        self.result = result
 
 
 class ADB():
@@ -19,8 +64,6 @@ class ADB():
     __target = None
     #  -s SERIAL
     #  use device with given serial number (overrides $ANDROID_SERIAL)
-    devices = []
-    try_times = 0
 
     # reboot modes
     REBOOT_RECOVERY = 1
@@ -31,8 +74,41 @@ class ADB():
     # default TCP/IP host
     DEFAULT_TCP_HOST = "localhost"
 
-    def __init__(self, adb_path='adb', device=None):
+    # commands running at once against one device, across all instances
+    MAX_CONCURRENT = 2
+    __slots_lock = threading.Lock()
+    __device_slots = {}
+
+    # called as observer(cmd, result) after every command, e.g. for metrics
+    observer = None
+    # cores the adb processes run on, None for any
+    affinity = None
+
+    # seconds before a command is killed, None waits forever; per instance
+    # with set_timeout, per call with the timeout argument
+    TIMEOUT = None
+    # reset the transport in the background after a command ran into the
+    # instance deadline, or after RESET_AFTER timeouts in a row on the
+    # tighter per call deadlines
+    RESET_ON_TIMEOUT = True
+    RESET_AFTER = 3
+    RESET_TIMEOUT = 10
+    PING_TIMEOUT = 5
+    # seconds to drain the pipes of a killed command, children of adb can
+    # keep them open
+    KILL_TIMEOUT = 0.5
+    __timeouts = {}
+    __resets = set()
+
+    def __init__(self, adb_path='adb', device=None, connect=True):
         self.__adb_path = adb_path
+        self.devices = []
+        self.timeout = self.TIMEOUT
+        self.__resetting = False
+
+        if not connect:
+            # just the client, e.g. to list devices
+            return
 
         if device:
             self.set_target_device(device)
@@ -45,22 +121,27 @@ class ADB():
             self.set_target_device(self.devices[0][0])
             self.connect_check()
 
-    def connect_check(self):
+    def connect_check(self, tries=3):
         '''
         After we initialied an instance of Adb_Wrapper, we should check if it is
-        working well. If not, we must initial it again. Considering with the
-        case that we do not need to restart the adb while we re-initial it, so
-        we set the global flag 'NEED_RESTART_ADB' to False.
-        '''
-        adb_shell_args_test = ['ls', '-l', '/']
-        ret = self.shell_command(adb_shell_args_test)
-        if ret is None:
-            self.try_times += 1
-            if self.try_times > 3:
-                print("It has tried 3 times, please check your devices.")
-                return
+        working well. Retries up to `tries` times and returns whether the
+        device answered.
+        '''
+        for _ in range(tries):
+            if self.ping():
+                return True
             print('[W] Init Android_native_debug falied, try again.')
-            self.__init__()
+
+        print("It has tried %d times, please check your devices." % tries)
+        return False
+
+    def ping(self):
+        '''
+        Cheap round trip to the target device
+        adb shell echo ok
+        '''
+        res = self.shell(['echo', 'ok'], timeout=self.PING_TIMEOUT)
+        return res.ok and res.stdout.strip() == b'ok'
 
     def is_emulator(self):
         target_dev = self.get_target_device()
@@ -116,18 +197,50 @@ class ADB():
 
         return ret
 
-    def run_cmd(self, cmd):
+    def __device_slot(self):
         '''
-        Runs a command by using adb tool ($ adb <cmd>)
+        Semaphore bounding the concurrent commands on the target device
+        '''
+        with ADB.__slots_lock:
+            slot = ADB.__device_slots.get(self.__target)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.MAX_CONCURRENT)
+                ADB.__device_slots[self.__target] = slot
+            return slot
 
-        cmd have to be a list.
+    def __pin(self, pid):
         '''
-        self.__clean__()
+        Moves a spawned adb process to the ADB.affinity cores. Done from the
+        parent, preexec_fn isn't safe in a process running threads
+        '''
+        if ADB.affinity is None:
+            return
+        try:
+            os.sched_setaffinity(pid, ADB.affinity)
+        except (OSError, AttributeError):
+            # already gone, or no affinity on this platform
+            pass
 
+    def set_timeout(self, timeout):
+        '''
+        Default deadline in seconds of the commands of this instance, None
+        for no deadline
+        '''
+        self.timeout = timeout
+
+    def call(self, cmd, timeout=None):
+        '''
+        Runs a command by using adb tool ($ adb <cmd>) and returns an
+        ADBResult. Does not touch the instance state, so it is safe to use
+        from several threads at once.
+
+        A command still running after timeout seconds (the instance default
+        when None) is killed and an ADBTimeout returned. The transport is reset
+        in the background when the instance deadline ran out, or when the
+        target timed out RESET_AFTER times in a row.
+        '''
         if self.__adb_path is None:
-            self.__error = "ADB path not set"
-            self.__return = 1
-            return
+            return ADBResult(None, "ADB path not set", 1, 0.0)
 
         if not isinstance(cmd, list):
             cmd = cmd.split()
@@ -135,14 +248,184 @@ class ADB():
         # For compat of windows
         cmd_list = self.__build_command__(cmd)
 
-        # print(cmd_list)
-
-        adb_proc = subprocess.Popen(cmd_list, stdin=subprocess.PIPE,
+        with self.__device_slot():
+            start = time.perf_counter()
+            adb_proc = self.__spawn(cmd_list, stdin=subprocess.PIPE,
                                     stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    shell=False)
-        (self.__output, self.__error) = adb_proc.communicate()
-        self.__return = adb_proc.returncode
+                                    stderr=subprocess.PIPE)
+            try:
+                (output, error) = adb_proc.communicate(
+                    timeout=self.timeout if timeout is None else timeout)
+                res = ADBResult(output, error, adb_proc.returncode,
+                                time.perf_counter() - start)
+            except subprocess.TimeoutExpired:
+                adb_proc.kill()
+                try:
+                    (output, error) = adb_proc.communicate(
+                        timeout=self.KILL_TIMEOUT)
+                except subprocess.TimeoutExpired:
+                    adb_proc.stdout.close()
+                    adb_proc.stderr.close()
+                    adb_proc.wait()
+                    (output, error) = (b'', b'')
+                res = ADBTimeout(output, error, adb_proc.returncode,
+                                 time.perf_counter() - start)
+
+        if ADB.observer is not None:
+            ADB.observer(cmd, res)
+
+        if self.__count_timeout(res.timed_out, timeout is None):
+            self.__reset_later()
+
+        return res
+
+    def stream(self, cmd, sink, timeout=None, chunk=1 << 16):
+        '''
+        Runs a command by using adb tool ($ adb <cmd>) and feeds its output
+        to sink chunk by chunk as it arrives. Returns an ADBResult whose
+        stdout is the number of bytes read, or an ADBTimeout when it was
+        killed at its deadline, as call does.
+        '''
+        if self.__adb_path is None:
+            return ADBResult(0, "ADB path not set", 1, 0.0)
+
+        if not isinstance(cmd, list):
+            cmd = cmd.split()
+
+        cmd_list = self.__build_command__(cmd)
+        deadline = self.timeout if timeout is None else timeout
+        total = 0
+
+        with self.__device_slot():
+            start = time.perf_counter()
+            adb_proc = self.__spawn(cmd_list, stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL)
+
+            # killing adb ends the read below
+            expired = threading.Event()
+            timer = None
+            if deadline is not None:
+                timer = threading.Timer(
+                    deadline, lambda: (expired.set(), adb_proc.kill()))
+                timer.daemon = True
+                timer.start()
+
+            try:
+                while True:
+                    data = adb_proc.stdout.read1(chunk)
+                    if not data:
+                        break
+                    total += len(data)
+                    sink(data)
+            finally:
+                if timer is not None:
+                    timer.cancel()
+                adb_proc.stdout.close()
+                adb_proc.wait()
+
+            result = ADBTimeout if expired.is_set() else ADBResult
+            res = result(total, b'', adb_proc.returncode,
+                         time.perf_counter() - start)
+
+        if ADB.observer is not None:
+            ADB.observer(cmd, res)
+
+        if self.__count_timeout(res.timed_out, timeout is None):
+            self.__reset_later()
+
+        return res
+
+    def __spawn(self, cmd_list, **kwargs):
+        '''
+        Starts an adb process pinned to ADB.affinity -> Popen
+        '''
+        adb_proc = subprocess.Popen(cmd_list, shell=False, **kwargs)
+        self.__pin(adb_proc.pid)
+        return adb_proc
+
+    def __count_timeout(self, timed_out, hard):
+        '''
+        Tracks the timeouts in a row of the target -> whether its transport
+        needs a reset
+        '''
+        if self.__resetting or self.__target is None:
+            return False
+
+        with ADB.__slots_lock:
+            if not timed_out:
+                ADB.__timeouts.pop(self.__target, None)
+                return False
+
+            count = ADB.__timeouts.get(self.__target, 0) + 1
+            ADB.__timeouts[self.__target] = count
+
+        return self.RESET_ON_TIMEOUT and (hard or count >= self.RESET_AFTER)
+
+    def __reset_later(self):
+        '''
+        Resets the transport on a thread of its own, the caller is usually
+        a game loop that can't wait for it
+        '''
+        target = self.__target
+        with ADB.__slots_lock:
+            if target in ADB.__resets:
+                return
+            ADB.__resets.add(target)
+            ADB.__timeouts.pop(target, None)
+
+        client = ADB(self.__adb_path, connect=False)
+        client.set_target_device(target)
+
+        def reset():
+            try:
+                client.reset_transport()
+            except Exception as e:
+                print('[W] resetting %s failed: %s' % (target, e))
+            finally:
+                with ADB.__slots_lock:
+                    ADB.__resets.discard(target)
+
+        threading.Thread(target=reset, name='adb-reset-%s' % target,
+                         daemon=True).start()
+
+    def reset_transport(self):
+        '''
+        Drops and reestablishes the connection to the target device, e.g.
+        after a command hung on it
+        adb reconnect
+        '''
+        if self.__resetting or self.__target is None:
+            return None
+
+        self.__resetting = True
+        try:
+            if ':' in self.__target:
+                # adb connect serials reconnect with disconnect + connect
+                self.call(['disconnect', self.__target], timeout=self.RESET_TIMEOUT)
+                return self.call(['connect', self.__target], timeout=self.RESET_TIMEOUT)
+            return self.call(['reconnect'], timeout=self.RESET_TIMEOUT)
+        finally:
+            self.__resetting = False
+
+    def shell(self, cmd, timeout=None):
+        '''
+        Executes a shell command and returns an ADBResult, see call
+        adb shell <cmd>
+        '''
+        if not isinstance(cmd, list):
+            cmd = cmd.split()
+        return self.call(['shell'] + cmd, timeout)
+
+    def run_cmd(self, cmd, timeout=None):
+        '''
+        Runs a command by using adb tool ($ adb <cmd>)
+
+        cmd have to be a list.
+        '''
+        self.__clean__()
+        res = self.call(cmd, timeout)
+        (self.__output, self.__error, self.__return) = res[:3]
+        return res
 
     def shell_command(self, cmd):
         '''
@@ -246,10 +529,13 @@ class ADB():
         adb devices
         '''
         self.run_cmd(['devices', '-l'])
-        lines = re.split(r'\r\s+', self.__output.decode(encoding='utf-8'))
-        for line in lines[1:-1]:
+        self.devices = []
+        lines = self.__output.decode(encoding='utf-8').splitlines()
+        for line in lines[1:]:
             dev = line.split()
-            self.devices.append(dev)
+            if dev:
+                self.devices.append(dev)
+        return self.devices
 
     def set_target_device(self, device):
         '''
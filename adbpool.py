@@ -0,0 +1,186 @@
+#! /usr/bin/python3
+
+# a pool of adb transports, one per device serial
+#
+# every serial gets its own watcher thread that pings the device in the
+# background and reconnects with exponential backoff when it stops answering,
+# so a flaky device never stalls the loops of the other devices, and the loop
+# that owns it can ask for its transport without blocking:
+#
+#     pool = TransportPool()
+#     pool.start()
+#     ...
+#     client = pool.get(serial) # ADB instance or None if the device is down
+
+import random
+import threading
+import time
+
+import adb as pyadb3
+
+class Transport:
+    CONNECTING = "connecting"
+    HEALTHY = "healthy"
+    DOWN = "down"
+
+    def __init__(self, serial, adb_path = "adb"):
+        self.serial = serial
+
+        # handed out to the loop that owns the device, the watcher only
+        # uses the reentrant calls on it
+        self.client = pyadb3.ADB(adb_path, connect = False)
+        self.client.set_target_device(serial)
+
+        self.state = Transport.CONNECTING
+        self.ready = threading.Event()
+
+        self.failures = 0 # consecutive failed checks
+        self.reconnects = 0
+        self.last_ok = 0
+
+        self.thread = None
+
+    def __repr__(self):
+        return "<Transport %s %s>" % (self.serial, self.state)
+
+class TransportPool:
+    CHECK_INTERVAL = 5 # seconds between checks of a healthy device
+    SCAN_INTERVAL = 10 # seconds between adb devices scans
+    BACKOFF_MIN = 0.5
+    BACKOFF_MAX = 30
+
+    def __init__(self, adb_path = "adb", scan = True):
+        self.adb_path = adb_path
+        self.scan = scan
+
+        self.transports = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+        self.scanner = None
+
+    def start(self):
+        self.stopped.clear()
+
+        if self.scan:
+            self.scanner = threading.Thread(target = self.scan_loop, name = "adb-scan", daemon = True)
+            self.scanner.start()
+
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+        for t in list(self.transports.values()):
+            t.ready.set() # release waiters
+
+    # start watching a serial, no-op if it's already in the pool
+    def add(self, serial):
+        with self.lock:
+            t = self.transports.get(serial)
+
+            if t is not None:
+                return t
+
+            t = Transport(serial, self.adb_path)
+            self.transports[serial] = t
+
+        t.thread = threading.Thread(target = self.watch, args = (t,),
+                                    name = "adb-watch-%s" % serial, daemon = True)
+        t.thread.start()
+
+        return t
+
+    # watch a device reachable over TCP/IP (adb connect host:port)
+    def add_remote(self, host, port = pyadb3.ADB.DEFAULT_TCP_PORT):
+        return self.add("%s:%s" % (host, port))
+
+    # stop watching a serial
+    def remove(self, serial):
+        with self.lock:
+            t = self.transports.pop(serial, None)
+
+        if t is not None:
+            t.ready.set()
+
+    # ready ADB client for serial or None if it's not healthy right now,
+    # never blocks
+    def get(self, serial):
+        t = self.transports.get(serial)
+
+        if t is None or t.state != Transport.HEALTHY:
+            return None
+
+        return t.client
+
+    # block until serial is healthy -> ADB client or None on timeout
+    def wait(self, serial, timeout = None):
+        t = self.add(serial)
+        t.ready.wait(timeout)
+        return self.get(serial)
+
+    def healthy(self):
+        return [ s for s, t in list(self.transports.items()) if t.state == Transport.HEALTHY ]
+
+    def status(self):
+        return { s: (t.state, t.failures, t.reconnects, t.last_ok)
+                 for s, t in list(self.transports.items()) }
+
+    def scan_loop(self):
+        lister = pyadb3.ADB(self.adb_path, connect = False)
+
+        while not self.stopped.is_set():
+            try:
+                for dev in lister.init_devices():
+                    # skip unauthorized/offline entries, the watcher
+                    # would only keep failing on them
+                    if len(dev) >= 2 and dev[1] == "device":
+                        self.add(dev[0])
+            except Exception as e:
+                print("[W] adb devices failed: %s" % e)
+
+            self.stopped.wait(TransportPool.SCAN_INTERVAL)
+
+    def check(self, t):
+        try:
+            return t.client.ping()
+        except Exception:
+            return False
+
+    # adb connect serials get disconnect + connect, usb ones adb reconnect
+    def reconnect(self, t):
+        try:
+            t.client.reset_transport()
+        except Exception as e:
+            print("[W] reconnecting %s failed: %s" % (t.serial, e))
+
+        t.reconnects += 1
+
+    def watch(self, t):
+        backoff = TransportPool.BACKOFF_MIN
+
+        while not self.stopped.is_set() and self.transports.get(t.serial) is t:
+            if self.check(t):
+                if t.state != Transport.HEALTHY:
+                    print("[I] %s is up" % t.serial)
+
+                t.state = Transport.HEALTHY
+                t.failures = 0
+                t.last_ok = time.time()
+                t.ready.set()
+
+                backoff = TransportPool.BACKOFF_MIN
+                self.stopped.wait(TransportPool.CHECK_INTERVAL)
+            else:
+                if t.state == Transport.HEALTHY:
+                    print("[W] %s stopped answering" % t.serial)
+
+                t.ready.clear()
+                t.state = Transport.DOWN
+                t.failures += 1
+
+                self.reconnect(t)
+
+                # jitter so that devices on one hub don't retry in lockstep
+                self.stopped.wait(backoff * random.uniform(0.5, 1))
+                backoff = min(backoff * 2, TransportPool.BACKOFF_MAX)
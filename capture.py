@@ -0,0 +1,384 @@
+#! /usr/bin/python3
+
+# capture transports for android devices
+#
+# a transport turns the device screen into a BGR frame, decoded by its
+# decode.Decoder; AndroidDevice(capture = ...) hands it a decoder for
+# Device.RESIZE
+
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+import decode
+
+class Capture:
+    def __init__(self):
+        # frames come out of decoder, at its scale
+        self.decoder = decode.Decoder(1.0)
+
+        # seconds a grab may take, None for the transport's own limit
+        self.timeout = None
+
+    # -> (BGR frame, bytes transferred)
+    def grab(self):
+        raise NotImplementedError
+
+    def frame(self):
+        return self.grab()[0]
+
+    def close(self):
+        pass
+
+class ExecOutCapture(Capture):
+    CHUNK = 1 << 16
+
+    # client :: adb.ADB targeting the device, the commands go through it so
+    #           that they share its device slots, affinity and observer
+    def __init__(self, client):
+        super(ExecOutCapture, self).__init__()
+
+        self.client = client
+        self.serial = client.get_target_device()
+
+    # run cmd on the device and feed its output to sink chunk by chunk
+    # as it arrives -> bytes transferred, raises TimeoutError when it runs
+    # longer than the timeout (the client's when None)
+    def stream(self, cmd, sink):
+        res = self.client.stream([ "exec-out", cmd ], sink, self.timeout, ExecOutCapture.CHUNK)
+
+        if res.timed_out:
+            raise TimeoutError("exec-out %s timed out after %.1fs" % (cmd, res.elapsed))
+
+        return res.stdout
+
+class LinkAwareCapture(ExecOutCapture):
+    # encoding -> device command
+    ENCODINGS = {
+        "raw": "screencap",
+        "gzip": "screencap | gzip -1",
+        "png": "screencap -p",
+    }
+
+    REEVALUATE = 120 # seconds between comparisons of all encodings
+    PROBES = 2 # frames per encoding when comparing
+    EWMA = 0.2
+
+    def __init__(self, client, encodings = ("raw", "gzip", "png")):
+        super(LinkAwareCapture, self).__init__(client)
+
+        self.encodings = list(encodings)
+
+        # encoding -> { "bytes", "ms", "frames", "failures", "timeouts" }
+        self.stats = { enc: { "bytes": 0.0, "ms": 0.0, "frames": 0, "failures": 0, "timeouts": 0 }
+                       for enc in self.encodings }
+
+        self.encoding = None
+        self.evaluated = 0
+
+    def grab_with(self, enc):
+        buf = bytearray()
+
+        if enc == "gzip":
+            # decompress while the rest is still in flight
+            inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            size = self.stream(LinkAwareCapture.ENCODINGS[enc], lambda chunk: buf.extend(inflate.decompress(chunk)))
+            buf.extend(inflate.flush())
+        else:
+            size = self.stream(LinkAwareCapture.ENCODINGS[enc], buf.extend)
+
+        return self.decoder.decode(buf), size
+
+    # capture with enc and update its statistics -> (frame, bytes) or None
+    def measure(self, enc):
+        stats = self.stats[enc]
+        start = time.perf_counter()
+
+        try:
+            img, size = self.grab_with(enc)
+        except TimeoutError:
+            # the time lost still counts against the encoding, the caller
+            # decides whether there is time left to try again
+            stats["timeouts"] += 1
+
+            if stats["frames"]:
+                stats["ms"] += ((time.perf_counter() - start) * 1000 - stats["ms"]) * LinkAwareCapture.EWMA
+
+            raise
+        except Exception as e:
+            # e.g. no gzip on the device
+            stats["failures"] += 1
+            print("[W] %s capture with %s failed: %s" % (self.serial, enc, e))
+            return None
+
+        ms = (time.perf_counter() - start) * 1000
+
+        if stats["frames"]:
+            stats["bytes"] += (size - stats["bytes"]) * LinkAwareCapture.EWMA
+            stats["ms"] += (ms - stats["ms"]) * LinkAwareCapture.EWMA
+        else:
+            stats["bytes"], stats["ms"] = size, ms
+
+        stats["frames"] += 1
+
+        return img, size
+
+    # capture a few frames with every encoding and keep the fastest
+    def evaluate(self):
+        last = None
+        timeouts = 0
+
+        for enc in self.encodings:
+            for _ in range(LinkAwareCapture.PROBES):
+                try:
+                    res = self.measure(enc)
+                except TimeoutError:
+                    timeouts += 1
+                    break
+
+                if res is None:
+                    break
+
+                last = res
+
+        usable = [ enc for enc in self.encodings if self.stats[enc]["frames"] and
+                   self.stats[enc]["failures"] < 3 ]
+
+        if not usable:
+            if timeouts:
+                raise TimeoutError("every capture encoding timed out on %s" % self.serial)
+
+            raise IOError("no capture encoding works on %s" % self.serial)
+
+        best = min(usable, key = lambda enc: self.stats[enc]["ms"])
+
+        if best != self.encoding:
+            print("[I] %s captures with %s (%s)" % (self.serial, best, self.describe()))
+
+        self.encoding = best
+        self.evaluated = time.time()
+
+        return last
+
+    def grab(self):
+        if self.encoding is None or time.time() - self.evaluated > LinkAwareCapture.REEVALUATE:
+            res = self.evaluate()
+        else:
+            res = self.measure(self.encoding)
+
+            if res is None:
+                res = self.evaluate()
+
+        return res
+
+    # link throughput in bytes / sec as seen by the current encoding
+    def throughput(self):
+        stats = self.stats.get(self.encoding)
+
+        if not stats or not stats["ms"]:
+            return 0
+
+        return stats["bytes"] / stats["ms"] * 1000
+
+    def report(self):
+        return { enc: dict(stats) for enc, stats in self.stats.items() }
+
+    def describe(self):
+        return ", ".join("%s %.0f KB %.0f ms" % (enc, s["bytes"] / 1024, s["ms"])
+                         for enc, s in self.stats.items() if s["frames"])
+
+class StreamCapture(Capture):
+    # pushed to the device and started once: serves a stream of raw
+    # screencaps on 127.0.0.1:PORT of the device, each prefixed by its
+    # length as u32 little endian. the raw framebuffer always has the size
+    # setup probed (header + w * h * 4), so screencap writes straight to the
+    # socket and nothing touches the flash
+    HELPER = r"""
+case "$1" in
+serve)
+    exec nc -L -s 127.0.0.1 -p "$2" sh "$0" stream "$3" ;;
+stream)
+    n=$2
+    len=$(printf '\\%03o\\%03o\\%03o\\%03o' $((n & 255)) $((n >> 8 & 255)) $((n >> 16 & 255)) $((n >> 24 & 255)))
+    while printf "$len" && screencap; do :; done ;;
+esac
+"""
+
+    HELPER_PATH = "/data/local/tmp/rushcap.sh"
+    PORT = 27183 # on the device
+
+    TIMEOUT = 5 # seconds without a frame before grab gives up
+    SETUP_TIMEOUT = 10 # seconds every adb command of the setup may take
+    RECONNECT_DELAY = 0.5
+    RESETUP_AFTER = 2 # failed connections before the helper is restarted
+
+    # client :: adb.ADB targeting the device
+    def __init__(self, client, port = PORT):
+        super(StreamCapture, self).__init__()
+
+        self.client = client
+        self.serial = client.get_target_device()
+        self.port = port
+        self.local_port = None
+
+        # three buffers: one being received, the newest frame and the one
+        # being decoded, so neither side ever waits for the other
+        self.buffers = [ bytearray(), bytearray(), bytearray() ]
+        self.sizes = [ 0, 0, 0 ]
+        self.newest = None
+        self.decoding = None
+
+        self.cond = threading.Condition()
+        self.seq = 0 # frames received
+        self.consumed = 0 # seq of the last frame grabbed
+        self.received = 0 # bytes
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target = self.loop, name = "capture-%s" % self.serial, daemon = True)
+        self.thread.start()
+        return self
+
+    # adb command within SETUP_TIMEOUT -> ADBResult, raises
+    # adb.ADBTimeoutError when it had to be killed and IOError when it
+    # failed, unless check is false
+    def adb(self, cmd, check = True):
+        import adb as pyadb3
+
+        res = self.client.call(cmd, StreamCapture.SETUP_TIMEOUT)
+
+        if res.timed_out:
+            raise pyadb3.ADBTimeoutError(res, cmd)
+
+        if check and not res.ok:
+            raise IOError("adb %s failed: %s" % (" ".join(cmd), (res.stderr or b"").decode(errors = "replace").strip()))
+
+        return res
+
+    # push and start the helper, forward a free local port to it
+    def setup(self):
+        if self.local_port is not None:
+            # the forward of the last setup
+            self.adb([ "forward", "--remove", "tcp:%d" % self.local_port ], check = False)
+            self.local_port = None
+
+        fd, path = tempfile.mkstemp(suffix = ".sh")
+
+        try:
+            with os.fdopen(fd, "w") as fp:
+                fp.write(StreamCapture.HELPER)
+
+            self.adb([ "push", path, StreamCapture.HELPER_PATH ])
+        finally:
+            os.remove(path)
+
+        size = int(self.adb([ "exec-out", "screencap | wc -c" ]).stdout.strip())
+
+        # nothing to kill is fine
+        self.adb([ "shell", "pkill", "-f", "rushcap" ], check = False)
+        self.adb([ "shell", "nohup", "sh", StreamCapture.HELPER_PATH, "serve", str(self.port), str(size),
+                   ">", "/dev/null", "2>&1", "&" ])
+
+        # tcp:0 lets adb pick the local port and print it
+        out = self.adb([ "forward", "tcp:0", "tcp:%d" % self.port ]).stdout
+        self.local_port = int(out.strip())
+
+        print("[I] %s streams frames on port %d" % (self.serial, self.local_port))
+
+    def loop(self):
+        failures = 0
+
+        while not self.stopped.is_set():
+            seq = self.seq
+
+            try:
+                if self.local_port is None or failures >= StreamCapture.RESETUP_AFTER:
+                    self.setup()
+                    failures = 0
+
+                self.read_stream()
+            except Exception as e:
+                if not self.stopped.is_set():
+                    print("[W] %s frame stream: %s" % (self.serial, e))
+
+            # a connection that delivered frames doesn't count as failed
+            failures = 0 if self.seq > seq else failures + 1
+
+            self.stopped.wait(StreamCapture.RECONNECT_DELAY)
+
+    @staticmethod
+    def recv_into(sock, view):
+        while len(view):
+            n = sock.recv_into(view)
+
+            if not n:
+                raise EOFError("stream closed")
+
+            view = view[n:]
+
+    def read_stream(self):
+        sock = socket.create_connection(("127.0.0.1", self.local_port), StreamCapture.TIMEOUT)
+        header = bytearray(4)
+
+        try:
+            while not self.stopped.is_set():
+                StreamCapture.recv_into(sock, memoryview(header))
+                size, = struct.unpack("<I", header)
+
+                with self.cond:
+                    i = next(i for i in range(3) if i != self.newest and i != self.decoding)
+
+                if len(self.buffers[i]) < size:
+                    self.buffers[i] = bytearray(size)
+
+                StreamCapture.recv_into(sock, memoryview(self.buffers[i])[:size])
+
+                with self.cond:
+                    self.sizes[i] = size
+                    self.newest = i
+                    self.seq += 1
+                    self.received += size + 4
+                    self.cond.notify_all()
+        finally:
+            sock.close()
+
+    # next frame newer than the last one grabbed
+    def grab(self):
+        if self.thread is None:
+            # here rather than on the thread, so that the wait below only
+            # starts once the helper is up and a failed setup is raised
+            self.setup()
+            self.start()
+
+        timeout = StreamCapture.TIMEOUT if self.timeout is None else self.timeout
+
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.seq > self.consumed, timeout):
+                raise TimeoutError("no frame from %s in %.1fs" % (self.serial, timeout))
+
+            i = self.decoding = self.newest
+            size = self.sizes[i]
+            self.consumed = self.seq
+
+        try:
+            img = self.decoder.decode(memoryview(self.buffers[i])[:size])
+        finally:
+            with self.cond:
+                self.decoding = None
+
+        return img, size + 4
+
+    def close(self):
+        self.stopped.set()
+
+        if self.local_port is not None:
+            self.client.call([ "forward", "--remove", "tcp:%d" % self.local_port ], StreamCapture.SETUP_TIMEOUT)
+            self.client.shell([ "pkill", "-f", "rushcap" ], StreamCapture.SETUP_TIMEOUT)
+            self.local_port = None
@@ -0,0 +1,616 @@
+#! /usr/bin/python3
+
+# devices spread over many hosts, one coordinator for all of them
+#
+# every host runs an Agent: a Fleet for the devices it was given, plus a
+# heartbeat to the Coordinator carrying the devices its adb sees and the
+# report of its workers. the coordinator keeps the registry of hosts and
+# answers with the devices the host should play (a device seen by several
+# hosts, e.g. over adb connect, is given to one of them only) and the
+# calibrations it misses. calibration is done once per device model: the
+# coordinator asks one host to calibrate a device of a new model and hands
+# the result to every host with that model. the jump logs of the workers
+# are shipped to the coordinator as they grow.
+#
+# the RPC is JSON over TCP, each message prefixed by its length as u32
+# little endian, one request and one response at a time per connection.
+# with a shared secret every request has to carry it. calibrations travel
+# as checked values (refrac.Measure.check), never as code:
+#
+#     coordinator = Coordinator("cluster").serve(7300)
+#     agent = Agent(("coordinator", 7300), [ "--bottle", "bottle.png" ], [ "--mode", "auto" ])
+#     agent.run()
+#
+# assignments are leases: an agent whose last answered heartbeat was sent
+# half of Coordinator.HOST_TIMEOUT ago stops its workers, before the
+# coordinator gives their devices to another host. a watchdog thread checks
+# the lease, heartbeats may block up to their RPC timeout (a fifth of the
+# lease) and are not retried after a timeout
+
+import base64
+import glob
+import hmac
+import json
+import os
+import queue
+import re
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import fleet
+import jumplog
+import refrac
+
+MAX_MESSAGE = 16 << 20 # bytes
+
+class RPCError(Exception):
+    pass
+
+def send_msg(sock, obj):
+    data = json.dumps(obj).encode()
+    sock.sendall(struct.pack("<I", len(data)) + data)
+
+def recv_exactly(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+
+    while len(view):
+        got = sock.recv_into(view)
+
+        if not got:
+            raise EOFError("connection closed")
+
+        view = view[got:]
+
+    return bytes(buf)
+
+def recv_msg(sock):
+    size, = struct.unpack("<I", recv_exactly(sock, 4))
+
+    if size > MAX_MESSAGE:
+        raise ValueError("message of %d bytes, more than %d" % (size, MAX_MESSAGE))
+
+    return json.loads(recv_exactly(sock, size))
+
+class RPCServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    # target :: object whose rpc_<method> methods are served
+    # secret :: optional shared secret the requests must carry
+    def __init__(self, target, port = 0, host = "127.0.0.1", secret = None):
+        self.target = target
+        self.secret = secret
+        super(RPCServer, self).__init__((host, port), RPCHandler)
+
+    def start(self):
+        threading.Thread(target = self.serve_forever, name = "rpc", daemon = True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class RPCHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                req = recv_msg(self.request)
+            except (EOFError, OSError, ValueError):
+                return
+
+            secret = self.server.secret
+
+            if secret is not None and not hmac.compare_digest(str(req.get("secret", "")).encode(), secret.encode()):
+                # no answer to guess against
+                return
+
+            method = getattr(self.server.target, "rpc_" + str(req.get("method")), None)
+
+            if method is None:
+                resp = { "error": "no method %s" % req.get("method") }
+            else:
+                try:
+                    resp = { "result": method(**req.get("params", {})) }
+                except Exception as e:
+                    resp = { "error": "%s: %s" % (type(e).__name__, e) }
+
+            try:
+                send_msg(self.request, resp)
+            except OSError:
+                return
+
+class RPCClient:
+    TIMEOUT = 10
+
+    # addr :: (host, port)
+    def __init__(self, addr, timeout = TIMEOUT, secret = None):
+        self.addr = addr
+        self.timeout = timeout
+        self.secret = secret
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def call(self, method, **params):
+        with self.lock:
+            # a kept connection may have been dropped by the server meanwhile,
+            # a fresh one failing is a real failure and so is a timeout, the
+            # server may be busy with the request
+            for fresh in (self.sock is None, True):
+                try:
+                    if self.sock is None:
+                        self.sock = socket.create_connection(self.addr, self.timeout)
+
+                    req = { "method": method, "params": params }
+
+                    if self.secret is not None:
+                        req["secret"] = self.secret
+
+                    send_msg(self.sock, req)
+                    resp = recv_msg(self.sock)
+                    break
+                except (OSError, EOFError, ValueError) as e:
+                    self.close()
+
+                    if fresh or isinstance(e, socket.timeout):
+                        raise
+
+        if "error" in resp:
+            raise RPCError(resp["error"])
+
+        return resp["result"]
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+# "host:port" -> (host, port)
+def parse_addr(text, port = 7300):
+    host, _, p = text.rpartition(":")
+    return (host or "127.0.0.1", int(p)) if p.isdigit() else (text, port)
+
+# safe in file names
+def slug(text):
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", text)
+
+# adb devices -l rows -> [ (serial, model) ] of the usable devices, the
+# model (as a file name) falls back to the serial so an unknown device is
+# calibrated alone
+def list_devices(adb_path = "adb"):
+    import adb as pyadb3
+
+    devices = []
+
+    for dev in pyadb3.ADB(adb_path, connect = False).init_devices():
+        if len(dev) >= 2 and dev[1] == "device":
+            model = next((f[len("model:"):] for f in dev[2:] if f.startswith("model:")), dev[0])
+            devices.append((dev[0], slug(model)))
+
+    return devices
+
+class Host:
+    def __init__(self, name):
+        self.name = name
+        self.devices = {} # serial -> model
+        self.workers = [] # Fleet.rows of its last heartbeat
+        self.seen = 0
+
+class Coordinator:
+    HOST_TIMEOUT = 15 # seconds without a heartbeat before a host is dropped
+    CALIB_TIMEOUT = 180 # seconds a host may take to calibrate a model
+
+    # path :: directory of the calibrations (calib-<model>.json) and the
+    #         collected jump logs (<host>-<serial>.jumps)
+    def __init__(self, path = "cluster", secret = None):
+        self.path = path
+        self.secret = secret
+        os.makedirs(path, exist_ok = True)
+
+        self.hosts = {} # name -> Host
+        self.assigned = {} # serial -> host name
+        self.calibrations = {} # model -> calibration values
+        self.calibrating = {} # model -> (host name, serial, start time)
+        self.logs = {} # (host name, serial) -> jumplog.JumpLog
+        self.lock = threading.Lock()
+        self.server = None
+
+        # calibrations of earlier runs
+        for calib in glob.glob(os.path.join(path, "calib-*.json")):
+            model = os.path.basename(calib)[len("calib-"):-len(".json")]
+
+            try:
+                with open(calib) as fp:
+                    self.calibrations[model] = refrac.Measure.check(json.load(fp))
+            except ValueError as e:
+                print("[W] ignoring %s: %s" % (calib, e))
+
+    def serve(self, port = 0, host = "127.0.0.1"):
+        if self.secret is None and host not in ("127.0.0.1", "localhost", "::1"):
+            print("[W] coordinator on %s without a secret, anybody reaching it can join" % host)
+
+        self.server = RPCServer(self, port, host, self.secret).start()
+        print("[I] coordinator on %s:%d" % self.server.server_address[:2])
+        return self
+
+    def expire(self, now):
+        for name, host in list(self.hosts.items()):
+            if now - host.seen > Coordinator.HOST_TIMEOUT:
+                print("[W] host %s is gone, its devices are free" % name)
+                del self.hosts[name]
+
+        for model, (name, serial, start) in list(self.calibrating.items()):
+            if name not in self.hosts or now - start > Coordinator.CALIB_TIMEOUT:
+                del self.calibrating[model]
+
+    # keep the devices where they are while their host sees them, give the
+    # others to the host seeing them with the fewest devices
+    def assign(self):
+        load = { name: 0 for name in self.hosts }
+
+        for serial, name in list(self.assigned.items()):
+            if name in self.hosts and serial in self.hosts[name].devices:
+                load[name] += 1
+            else:
+                del self.assigned[serial]
+
+        for name in sorted(self.hosts):
+            for serial in sorted(self.hosts[name].devices):
+                if serial in self.assigned:
+                    continue
+
+                best = min((n for n in self.hosts if serial in self.hosts[n].devices),
+                           key = lambda n: (load[n], n))
+                self.assigned[serial] = best
+                load[best] += 1
+
+    # host :: agent name
+    # devices :: [ (serial, model) ] its adb sees
+    # workers :: its Fleet.rows
+    # calibrated :: models it has the calibration of
+    # -> { "assigned": [ serial ], "models": { serial: model },
+    #      "calibrations": { model: values }, "calibrate": [ serial ], "lease": seconds }
+    def rpc_heartbeat(self, host, devices, workers = (), calibrated = ()):
+        now = time.monotonic()
+
+        with self.lock:
+            h = self.hosts.get(host)
+
+            if h is None:
+                h = self.hosts[host] = Host(host)
+                print("[I] host %s joined with %d devices" % (host, len(devices)))
+
+            h.devices = { str(serial): slug(str(model)) for serial, model in devices }
+            h.workers = [ list(row) for row in workers ]
+            h.seen = now
+
+            self.expire(now)
+            self.assign()
+
+            mine = sorted(s for s, n in self.assigned.items() if n == host)
+            models = { s: h.devices[s] for s in mine }
+
+            calibrate = []
+
+            for serial in mine:
+                model = models[serial]
+
+                if model not in self.calibrations and model not in self.calibrating:
+                    self.calibrating[model] = (host, serial, now)
+                    calibrate.append(serial)
+
+            return { "assigned": mine, "models": models,
+                     "calibrations": { m: self.calibrations[m] for m in set(models.values())
+                                       if m in self.calibrations and m not in calibrated },
+                     "calibrate": calibrate, "lease": Coordinator.HOST_TIMEOUT }
+
+    # calibration values of model made by host, None when it failed
+    # -> whether they are now the calibration of the model
+    def rpc_calibration(self, host, model, measure = None, error = None):
+        model = slug(str(model))
+
+        with self.lock:
+            if self.calibrating.get(model, (None,))[0] != host:
+                # only the host that was asked may calibrate a model
+                return False
+
+            del self.calibrating[model]
+
+            if measure is None:
+                print("[W] %s failed to calibrate %s: %s" % (host, model, error))
+                return False
+
+            if model in self.calibrations:
+                return False # somebody was faster
+
+            try:
+                measure = refrac.Measure.check(measure)
+            except (ValueError, AttributeError) as e:
+                print("[W] %s sent a bad calibration of %s: %s" % (host, model, e))
+                return False
+
+            # written whole or not at all, a truncated file would be
+            # skipped on the next start
+            fd, tmp = tempfile.mkstemp(dir = self.path, suffix = ".tmp")
+
+            with os.fdopen(fd, "w") as fp:
+                json.dump(measure, fp)
+
+            os.replace(tmp, os.path.join(self.path, "calib-%s.json" % model))
+
+            self.calibrations[model] = measure
+            print("[I] %s calibrated %s" % (host, model))
+
+            return True
+
+    # records :: base64 of JUMP records, written from index start of the
+    #            log of the device on the host -> records collected so far,
+    #            the start the agent has to send next
+    def rpc_jumps(self, host, serial, start = None, records = ""):
+        with self.lock:
+            log = self.logs.get((host, serial))
+
+            if log is None:
+                path = os.path.join(self.path, "%s-%s.jumps" % (slug(host), slug(serial)))
+                log = self.logs[host, serial] = jumplog.JumpLog(path)
+
+            data = base64.b64decode(records)
+
+            if data and start == log.count:
+                log.extend(np.frombuffer(data, jumplog.JUMP))
+                log.flush()
+
+            return log.count
+
+    # "idle" :: seconds since the host's last heartbeat
+    def rpc_status(self):
+        now = time.monotonic()
+
+        with self.lock:
+            return { name: { "devices": h.devices, "workers": h.workers, "idle": now - h.seen,
+                             "assigned": sorted(s for s, n in self.assigned.items() if n == name) }
+                     for name, h in self.hosts.items() }
+
+    # exposition text for metrics.MetricsServer
+    def render(self):
+        import metrics as met
+
+        lines = []
+
+        with self.lock:
+            self.expire(time.monotonic())
+            lines.append("rush_cluster_hosts %d" % len(self.hosts))
+            lines.append("rush_cluster_calibrated_models %d" % len(self.calibrations))
+
+            for name, h in sorted(self.hosts.items()):
+                lines.append("rush_cluster_host_devices%s %d" % (met.label_text({ "host": name }), len(h.devices)))
+
+                for serial, pid, cores, cpu, p99, rounds in h.workers:
+                    labels = met.label_text({ "host": name, "serial": serial })
+                    lines.append("rush_cluster_worker_cpu_percent%s %s" % (labels, cpu))
+                    lines.append("rush_cluster_worker_p99_ms%s %s" % (labels, p99))
+                    lines.append("rush_cluster_worker_rounds%s %d" % (labels, rounds))
+
+            for (name, serial), log in sorted(self.logs.items()):
+                labels = met.label_text({ "host": name, "serial": serial })
+                lines.append("rush_cluster_jumps_collected%s %d" % (labels, log.count))
+
+        return "\n".join(lines) + "\n"
+
+# a Fleet whose workers use the calibration of their model and log their jumps
+class AgentFleet(fleet.Fleet):
+    def __init__(self, agent, *args, **kwargs):
+        super(AgentFleet, self).__init__(*args, **kwargs)
+        self.agent = agent
+
+    def argv(self, serial):
+        return (self.global_argv + [ "--serial", serial, "--measure", self.agent.measure_path(serial),
+                                     "run", "--headless" ] +
+                self.run_argv + [ "--log", self.agent.log_path(serial) ])
+
+class Agent:
+    INTERVAL = 5 # seconds between heartbeats
+    WATCH_INTERVAL = 0.5 # seconds between checks of the lease
+    BATCH = 4096 # jump records per message
+
+    # coordinator :: (host, port)
+    # global_argv, run_argv :: as Fleet, without --serial, --measure and --log
+    # name :: of this host in the registry
+    # path :: directory of the calibrations and jump logs of this host
+    def __init__(self, coordinator, global_argv, run_argv, name = None, path = "agent",
+                 adb_path = "adb", adb_cores = fleet.Fleet.ADB_CORES, secret = None):
+        self.client = RPCClient(coordinator, secret = secret)
+        self.name = name or socket.gethostname()
+        self.path = path
+        self.adb_path = adb_path
+        self.global_argv = list(global_argv)
+
+        os.makedirs(path, exist_ok = True)
+
+        # no devices until the coordinator gives some
+        self.fleet = AgentFleet(self, global_argv, run_argv, [], adb_path, adb_cores)
+
+        self.models = {} # serial -> model, of the assigned devices
+        self.sent = {} # serial -> jump records the coordinator has
+        self.calibrations = queue.Queue() # (serial, model) to calibrate, one at a time
+        self.last_ok = time.monotonic() # when the last answered heartbeat was sent
+        self.set_lease(Coordinator.HOST_TIMEOUT)
+        self.fleet_lock = threading.Lock() # the loop and the watchdog change the fleet
+
+        threading.Thread(target = self.calibrator, name = "calibrate", daemon = True).start()
+        threading.Thread(target = self.watchdog, name = "lease", daemon = True).start()
+
+    # a heartbeat must come back well within half of the lease
+    def set_lease(self, lease):
+        self.lease = lease
+        self.client.timeout = min(RPCClient.TIMEOUT, lease / 5)
+
+    def expired(self):
+        return time.monotonic() - self.last_ok > self.lease / 2
+
+    # stop the workers when the lease runs out, whether or not the
+    # heartbeat that should renew it ever returns
+    def watchdog(self):
+        while True:
+            time.sleep(Agent.WATCH_INTERVAL)
+
+            with self.fleet_lock:
+                if self.expired() and self.fleet.serials:
+                    print("[W] lease expired, stopping the workers")
+                    self.fleet.serials = []
+
+                    if self.fleet.update():
+                        self.fleet.rebalance()
+
+    def measure_path(self, serial):
+        return os.path.join(self.path, "measure-%s.py" % slug(self.models[serial]))
+
+    def log_path(self, serial):
+        return os.path.join(self.path, "%s.jumps" % slug(serial))
+
+    def calibrated(self):
+        return [ os.path.basename(p)[len("measure-"):-len(".py")]
+                 for p in glob.glob(os.path.join(self.path, "measure-*.py")) ]
+
+    # measure :: calibration values
+    def save_calibration(self, model, measure):
+        text = refrac.Measure.text(refrac.Measure.check(measure))
+
+        # written whole or not at all, workers may be reading it
+        fd, tmp = tempfile.mkstemp(dir = self.path, suffix = ".tmp")
+
+        with os.fdopen(fd, "w") as fp:
+            fp.write(text)
+
+        os.replace(tmp, os.path.join(self.path, "measure-%s.py" % slug(model)))
+
+    # calibrate serial in a rush calib process and hand the result in
+    def calibrate(self, serial, model):
+        fd, tmp = tempfile.mkstemp(dir = self.path, suffix = ".py")
+        os.close(fd)
+
+        argv = [ sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "rush.py") ] + \
+               self.global_argv + [ "--serial", serial, "--measure", tmp, "calib" ]
+
+        print("[I] calibrating %s on %s" % (model, serial))
+
+        try:
+            proc = subprocess.run(argv, stdout = subprocess.DEVNULL, stderr = subprocess.PIPE,
+                                  timeout = Coordinator.CALIB_TIMEOUT)
+
+            with open(tmp) as fp:
+                text = fp.read()
+
+            if proc.returncode or not text:
+                lines = proc.stderr.decode(errors = "replace").strip().splitlines()
+                raise RuntimeError(lines[-1] if lines else "exit status %d" % proc.returncode)
+
+            measure = refrac.Measure.parse(text)
+
+            if self.client.call("calibration", host = self.name, model = model, measure = measure):
+                self.save_calibration(model, measure)
+        except Exception as e:
+            print("[W] calibrating %s failed: %s" % (model, e))
+
+            try:
+                self.client.call("calibration", host = self.name, model = model, error = str(e))
+            except (OSError, EOFError, RPCError):
+                pass
+        finally:
+            os.remove(tmp)
+
+    def calibrator(self):
+        while True:
+            self.calibrate(*self.calibrations.get())
+
+    def heartbeat(self):
+        try:
+            devices = list_devices(self.adb_path)
+        except Exception as e:
+            print("[W] adb devices failed: %s" % e)
+            devices = []
+
+        # the coordinator renews the lease when the request arrives, which is
+        # after it was sent
+        with self.fleet_lock:
+            rows = self.fleet.rows()
+
+        sent = time.monotonic()
+        reply = self.client.call("heartbeat", host = self.name, devices = devices,
+                                 workers = rows, calibrated = self.calibrated())
+
+        for model, measure in reply["calibrations"].items():
+            try:
+                self.save_calibration(model, measure)
+            except (ValueError, AttributeError) as e:
+                print("[W] bad calibration of %s from the coordinator: %s" % (model, e))
+
+        for serial in reply["calibrate"]:
+            self.calibrations.put((serial, reply["models"][serial]))
+
+        self.models = reply["models"]
+        self.set_lease(reply["lease"])
+
+        # devices wait for the calibration of their model
+        have = set(self.calibrated())
+
+        with self.fleet_lock:
+            self.last_ok = sent
+
+            if not self.expired():
+                self.fleet.serials = [ s for s in reply["assigned"] if slug(self.models[s]) in have ]
+
+    # send the new records of every jump log
+    def ship_jumps(self):
+        for serial in list(self.models):
+            path = self.log_path(serial)
+            sent = self.sent.get(serial)
+
+            if sent is None:
+                # where the coordinator stands
+                sent = self.sent[serial] = self.client.call("jumps", host = self.name, serial = serial)
+
+            if not os.path.exists(path):
+                continue
+
+            records = jumplog.JumpLog.load(path)
+
+            if len(records) < sent:
+                print("[W] %s has fewer jumps than the coordinator, not shipping" % path)
+                continue
+
+            while sent < len(records):
+                chunk = records[sent:sent + Agent.BATCH]
+                sent = self.sent[serial] = self.client.call(
+                    "jumps", host = self.name, serial = serial, start = sent,
+                    records = base64.b64encode(chunk.tobytes()).decode())
+
+    def step(self):
+        try:
+            self.heartbeat()
+            self.ship_jumps()
+        except (OSError, EOFError, RPCError) as e:
+            print("[W] coordinator: %s" % e)
+
+        with self.fleet_lock:
+            if self.expired() and self.fleet.serials:
+                print("[W] lease expired, stopping the workers")
+                self.fleet.serials = []
+
+            if self.fleet.update():
+                self.fleet.rebalance()
+
+    def run(self):
+        while True:
+            # heartbeats INTERVAL apart however long a step took
+            next = time.monotonic() + Agent.INTERVAL
+            self.step()
+            time.sleep(max(next - time.monotonic(), 0))
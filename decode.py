@@ -0,0 +1,169 @@
+#! /usr/bin/python3
+
+# screenshot decoding at reduced resolution
+#
+# the frames are used at Device.RESIZE of the screen size, so decoding them
+# at full size only to throw most pixels away is wasted work. a Decoder
+# knows a few ways to get from an encoded screenshot to the target size:
+#
+#     jpeg    IMREAD_REDUCED_COLOR_2/4/8, libjpeg scales while decoding
+#     png     IMREAD_REDUCED_COLOR_2/4/8 or a full decode
+#     raw     strided slicing of the RGBA rows or a full conversion
+#
+# each finished with an area-averaging resize to the exact target size.
+# it times every candidate path on the first frames of each format, keeps
+# the cheapest and reports the choice and the decode times
+
+import struct
+import time
+
+import cv2
+import numpy as np
+
+REDUCED = ((8, cv2.IMREAD_REDUCED_COLOR_8),
+           (4, cv2.IMREAD_REDUCED_COLOR_4),
+           (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+# largest reduction factor f with scale * f <= 1 -> (f, imdecode flag)
+def reduction(scale):
+    for factor, flag in REDUCED:
+        if scale * factor <= 1:
+            return factor, flag
+
+    return 1, cv2.IMREAD_COLOR
+
+# -> "png", "jpeg" or "raw"
+def sniff(buf):
+    if buf[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+
+    if buf[:2] == b"\xff\xd8":
+        return "jpeg"
+
+    return "raw"
+
+# full image size without decoding -> (w, h)
+def image_size(buf, fmt):
+    if fmt == "png":
+        # IHDR is always the first chunk
+        return struct.unpack_from(">II", buf, 16)
+
+    if fmt == "raw":
+        return struct.unpack_from("<II", buf)
+
+    # jpeg: walk the markers up to the start of frame
+    i = 2
+
+    while i + 9 < len(buf):
+        if buf[i] != 0xff:
+            i += 1
+            continue
+
+        marker = buf[i + 1]
+
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            h, w = struct.unpack_from(">HH", buf, i + 5)
+            return w, h
+
+        i += 2 + struct.unpack_from(">H", buf, i + 2)[0]
+
+    raise IOError("no start of frame in jpeg")
+
+# raw screencap -> RGBA rows view (h, w, 4)
+def raw_pixels(buf):
+    w, h, fmt = struct.unpack_from("<3I", buf)
+    size = w * h * 4
+    header = len(buf) - size
+
+    if fmt != 1 or header not in (12, 16):
+        raise IOError("unexpected raw framebuffer (%dx%d format %d, %d bytes)" % (w, h, fmt, len(buf)))
+
+    return np.frombuffer(buf, np.uint8, size, header).reshape(h, w, 4)
+
+def fit(img, size, dst = None):
+    if img.shape[1] == size[0] and img.shape[0] == size[1]:
+        if dst is not None:
+            np.copyto(dst, img)
+            return dst
+
+        return img
+
+    return cv2.resize(img, size, dst = dst, interpolation = cv2.INTER_AREA)
+
+class Decoder:
+    TRIALS = 3 # timed decodes per candidate path before settling
+
+    def __init__(self, scale = 1.0):
+        self.scale = scale
+
+        # format -> { path: [ total ms, decodes ] }
+        self.timings = {}
+        self.chosen = {} # format -> path
+        self.last = (None, 0.0) # (path, ms) of the last decode
+
+    def candidates(self, fmt):
+        factor, _ = reduction(self.scale)
+
+        if factor == 1:
+            return [ "full" ]
+
+        if fmt == "raw":
+            return [ "stride%d" % factor, "full" ]
+
+        return [ "reduced%d" % factor, "full" ]
+
+    def decode_with(self, buf, fmt, path, size, dst = None):
+        if fmt == "raw":
+            rgba = raw_pixels(buf)
+
+            if path != "full":
+                f = int(path[len("stride"):])
+                rgba = rgba[::f, ::f]
+
+            img = cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGR)
+        else:
+            flag = cv2.IMREAD_COLOR if path == "full" else reduction(self.scale)[1]
+            img = cv2.imdecode(np.frombuffer(buf, np.uint8), flag)
+
+            if img is None:
+                raise IOError("cannot decode %s screenshot" % fmt)
+
+        return fit(img, size, dst)
+
+    # encoded screenshot -> BGR frame of (int(w * scale), int(h * scale))
+    def decode(self, buf, dst = None):
+        fmt = sniff(buf)
+        w, h = image_size(buf, fmt)
+        size = (int(w * self.scale), int(h * self.scale))
+
+        path = self.chosen.get(fmt)
+        stats = self.timings.setdefault(fmt, {})
+
+        if path is None:
+            # least tried candidate first
+            cands = self.candidates(fmt)
+            path = min(cands, key = lambda p: stats.get(p, [ 0, 0 ])[1])
+
+        start = time.perf_counter()
+        img = self.decode_with(buf, fmt, path, size, dst)
+        ms = (time.perf_counter() - start) * 1000
+
+        total = stats.setdefault(path, [ 0.0, 0 ])
+        total[0] += ms
+        total[1] += 1
+
+        self.last = (path, ms)
+
+        if fmt not in self.chosen and all(stats.get(p, [ 0, 0 ])[1] >= Decoder.TRIALS for p in self.candidates(fmt)):
+            self.chosen[fmt] = min(self.candidates(fmt), key = lambda p: stats[p][0] / stats[p][1])
+            print("[I] decoding %s with %s (%s)" % (fmt, self.chosen[fmt], self.describe(fmt)))
+
+        return img
+
+    def describe(self, fmt):
+        return ", ".join("%s %.2f ms" % (p, t / n) for p, (t, n) in self.timings.get(fmt, {}).items() if n)
+
+    # format -> (chosen path or None while still trying, { path: mean ms })
+    def report(self):
+        return { fmt: (self.chosen.get(fmt), { p: t / n for p, (t, n) in stats.items() if n })
+                 for fmt, stats in self.timings.items() }
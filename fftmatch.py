@@ -0,0 +1,105 @@
+#! /usr/bin/python3
+
+# normalized cross-correlation in the frequency domain
+#
+# TM_CCOEFF_NORMED of a template T (n pixels) at every position of a frame I
+#
+#     R = sum(T' I) / sqrt(sum(T'^2) * (sum(I^2) - sum(I)^2 / n))
+#
+# with T' = T - mean(T), sums over the window under the template. the
+# numerator is one correlation, done as a product of spectra, and the window
+# sums come from running sums (integral images) of the frame, four lookups
+# per window whatever its size. the spectrum of a
+# template only depends on the DFT size, so it is computed once per frame
+# size and cached, and one forward transform of a frame serves any number
+# of templates, e.g. all the scales of a calibration sweep:
+#
+#     corr = Correlator((w, h))
+#     corr.add("bottle", template)
+#     corr.transform(gray)
+#     score, loc = corr.match("bottle")
+
+import cv2
+import numpy as np
+
+class Correlator:
+    MIN_VAR = 1.0 # per pixel, flatter windows score about 0
+
+    # size :: (w, h) of the frames
+    def __init__(self, size):
+        w, h = size
+        self.size = size
+
+        # the valid positions never wrap around, so the frame size rounded
+        # up to a fast DFT size is enough
+        self.dft_size = (cv2.getOptimalDFTSize(w), cv2.getOptimalDFTSize(h))
+        self.pad = np.zeros(self.dft_size[::-1], np.float32)
+
+        self.templates = {} # key -> (spectrum, (tw, th), sum(T'^2))
+        self.spectrum = None # of the last frame
+        self.sums = None # integral images of the last frame
+        self.squares = None
+        self.windows = {} # (tw, th) -> variances (times n) under the windows of the last frame
+
+    def add(self, key, template):
+        th, tw = template.shape
+        assert tw <= self.size[0] and th <= self.size[1], "template larger than the frame"
+
+        t = template.astype(np.float32)
+        t -= t.mean()
+
+        pad = np.zeros_like(self.pad)
+        pad[:th, :tw] = t
+
+        self.templates[key] = cv2.dft(pad), (tw, th), float((t.astype(np.float64) ** 2).sum())
+
+    def remove(self, key):
+        self.templates.pop(key, None)
+
+    # forward transform of a grayscale frame, shared by the following matches
+    def transform(self, gray):
+        h, w = gray.shape
+        assert (w, h) == self.size
+
+        self.pad[:h, :w] = gray
+        self.spectrum = cv2.dft(self.pad)
+
+        self.sums, self.squares = cv2.integral2(gray, sdepth = cv2.CV_64F)
+        self.windows = {}
+
+    # variances (times n) of the frame under every window of size
+    def window(self, size):
+        var = self.windows.get(size)
+
+        if var is None:
+            tw, th = size
+
+            def box(ii):
+                return cv2.add(cv2.subtract(ii[th:, tw:], ii[:-th, tw:]),
+                               cv2.subtract(ii[:-th, :-tw], ii[th:, :-tw]))
+
+            sums = box(self.sums)
+            var = cv2.scaleAdd(cv2.multiply(sums, sums), -1 / (tw * th), box(self.squares))
+            var = self.windows[size] = cv2.max(var.astype(np.float32), Correlator.MIN_VAR * tw * th)
+
+        return var
+
+    # -> NCC map of the template over the last transformed frame, as matchTemplate
+    def correlate(self, key):
+        spectrum, (tw, th), tnorm = self.templates[key]
+        w, h = self.size
+
+        corr = cv2.dft(cv2.mulSpectrums(self.spectrum, spectrum, 0, conjB = True),
+                       flags = cv2.DFT_INVERSE | cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)
+        num = corr[:h - th + 1, :w - tw + 1]
+
+        return cv2.divide(num, cv2.sqrt(self.window((tw, th)) * np.float32(tnorm)))
+
+    # best match -> (score, top left corner)
+    def match(self, key):
+        _, max_val, _, max_loc = cv2.minMaxLoc(self.correlate(key))
+        return max_val, max_loc
+
+    # best match of every key against the last frame -> { key: (score, loc) }
+    def match_all(self, keys = None):
+        return { key: self.match(key) for key in (self.templates if keys is None else keys) }
@@ -0,0 +1,292 @@
+#! /usr/bin/python3
+
+# one worker process per device, placed on cores on purpose
+#
+# the cores this process may use are split in two: ADB_CORES of them for
+# the adb server and the adb commands, the rest divided between the
+# workers, each pinned to its own share. a worker caps its OpenCV thread
+# pool at the size of its share, so the pools of different workers never
+# fight over a core. placement is recomputed whenever a worker starts or
+# stops, and the report shows the CPU usage and p99 capture to decision
+# latency (without the wait before pressing and the press) of every
+# worker to pick the device density of a host from:
+#
+#     fleet = Fleet([ "--bottle", "bottle.png" ], [ "--mode", "auto" ])
+#     fleet.run()
+
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+import numpy as np
+
+HAS_AFFINITY = hasattr(os, "sched_setaffinity")
+
+# pin every thread of pid, sched_setaffinity(pid) alone only moves its
+# main thread
+def pin(pid, cores):
+    try:
+        tids = [ int(t) for t in os.listdir("/proc/%d/task" % pid) ]
+    except OSError:
+        tids = [ pid ]
+
+    for tid in tids:
+        try:
+            os.sched_setaffinity(tid, cores)
+        except OSError:
+            pass # exited meanwhile
+
+# utime + stime of pid in seconds
+def cpu_time(pid):
+    try:
+        with open("/proc/%d/stat" % pid) as fp:
+            fields = fp.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+# pids of running adb servers
+def adb_servers():
+    pids = []
+
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+
+        try:
+            with open("/proc/%s/cmdline" % entry, "rb") as fp:
+                cmd = fp.read().split(b"\0")
+        except OSError:
+            continue
+
+        if cmd and os.path.basename(cmd[0]) == b"adb" and b"server" in cmd:
+            pids.append(int(entry))
+
+    return pids
+
+# split cores between n workers -> list of core sets
+def place(cores, n):
+    if n == 0:
+        return []
+
+    if n >= len(cores):
+        # more workers than cores, they share one core each
+        return [ { cores[i % len(cores)] } for i in range(n) ]
+
+    share, extra = divmod(len(cores), n)
+    shares = []
+    start = 0
+
+    for i in range(n):
+        size = share + (i < extra)
+        shares.append(set(cores[start:start + size]))
+        start += size
+
+    return shares
+
+# entry point of a worker process
+# argv :: rush command line for this device, ending in "run ..."
+# latency :: shared ring of capture to decision latencies in ms, the last
+#            slot counts rounds
+def worker(argv, latency, adb_cores):
+    import cv2
+    import rush
+    import adb as pyadb3
+
+    if adb_cores and HAS_AFFINITY:
+        # the adb commands this worker spawns run beside the adb server
+        pyadb3.ADB.affinity = adb_cores
+
+    args = rush.parser().parse_args(argv)
+    rush.setup(args)
+
+    player = rush.open_player(args)
+    size = len(latency) - 1
+    threads = 0
+
+    # terminate() sends SIGTERM, leave through the finally below so that
+    # the landings learned since the last save are written
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    try:
+        while True:
+            if HAS_AFFINITY:
+                # the scheduler may have moved this worker
+                n = len(os.sched_getaffinity(0))
+
+                if n != threads:
+                    threads = n
+                    cv2.setNumThreads(n)
+
+            delay = player.step()
+
+            # without the random wait before pressing and the press itself
+            if player.decided is not None:
+                rounds = int(latency[size])
+                latency[rounds % size] = player.decided * 1000
+                latency[size] = rounds + 1
+
+            time.sleep(delay)
+    finally:
+        player.muscle.flush()
+
+class Worker:
+    RING = 512 # latencies kept for the percentiles
+
+    def __init__(self, serial, argv, adb_cores):
+        self.serial = serial
+        self.latency = multiprocessing.Array("d", Worker.RING + 1, lock = False)
+        self.proc = multiprocessing.Process(target = worker, args = (argv, self.latency, adb_cores),
+                                            name = "rush-%s" % serial, daemon = True)
+        self.cores = set()
+        self.cpu = (None, 0) # (cpu time, wall time) at the last report
+
+    def p99(self):
+        n = min(int(self.latency[Worker.RING]), Worker.RING)
+
+        if not n:
+            return 0
+
+        return float(np.percentile(np.frombuffer(self.latency, np.float64, n), 99))
+
+    # CPU usage in % of one core since the last call
+    def usage(self):
+        now, used = time.time(), cpu_time(self.proc.pid)
+        last_used, last = self.cpu
+        self.cpu = (used, now)
+
+        if used is None or last_used is None:
+            return 0
+
+        return (used - last_used) / max(now - last, 1e-9) * 100
+
+class Fleet:
+    ADB_CORES = 1 # reserved for adb when there are more than two cores
+    SCAN_INTERVAL = 10
+    REPORT_INTERVAL = 30
+
+    # global_argv :: rush options shared by all devices (before the command)
+    # run_argv :: options of the run command
+    # serials :: devices to run, all connected ones when None
+    def __init__(self, global_argv, run_argv, serials = None, adb_path = "adb", adb_cores = ADB_CORES):
+        self.global_argv = list(global_argv)
+        self.run_argv = list(run_argv)
+        self.serials = serials
+        self.adb_path = adb_path
+
+        cores = sorted(os.sched_getaffinity(0)) if HAS_AFFINITY else []
+
+        if len(cores) > 2 and adb_cores:
+            self.adb_cores = set(cores[-adb_cores:])
+            self.cores = cores[:-adb_cores]
+        else:
+            self.adb_cores = set()
+            self.cores = cores
+
+        self.workers = {}
+
+    def wanted(self):
+        if self.serials is not None:
+            return self.serials
+
+        import adb as pyadb3
+
+        client = pyadb3.ADB(self.adb_path, connect = False)
+        return [ dev[0] for dev in client.init_devices() if len(dev) >= 2 and dev[1] == "device" ]
+
+    # rush command line of the worker for serial
+    def argv(self, serial):
+        return self.global_argv + [ "--serial", serial, "run", "--headless" ] + self.run_argv
+
+    def start(self, serial):
+        w = self.workers[serial] = Worker(serial, self.argv(serial), self.adb_cores)
+        w.proc.start()
+        print("[I] started worker for %s (pid %d)" % (serial, w.proc.pid))
+
+    def stop(self, serial):
+        w = self.workers.pop(serial)
+        w.proc.terminate()
+        w.proc.join(5)
+
+        if w.proc.is_alive():
+            w.proc.kill()
+            w.proc.join()
+
+        print("[I] stopped worker for %s" % serial)
+
+    # start workers for new devices, drop exited ones and, when the devices
+    # are given, stop the workers of those no longer given -> changed or not
+    def update(self):
+        changed = False
+
+        for serial, w in list(self.workers.items()):
+            if not w.proc.is_alive():
+                print("[W] worker for %s exited (%s)" % (serial, w.proc.exitcode))
+                del self.workers[serial]
+                changed = True
+
+        try:
+            wanted = self.wanted()
+        except Exception as e:
+            print("[W] adb devices failed: %s" % e)
+            wanted = []
+
+        for serial in wanted:
+            if serial not in self.workers:
+                self.start(serial)
+                changed = True
+
+        if self.serials is not None:
+            for serial in list(self.workers):
+                if serial not in wanted:
+                    self.stop(serial)
+                    changed = True
+
+        return changed
+
+    def rebalance(self):
+        if not HAS_AFFINITY:
+            return
+
+        if self.adb_cores:
+            for pid in adb_servers():
+                pin(pid, self.adb_cores)
+
+        shares = place(self.cores, len(self.workers))
+
+        for w, cores in zip(self.workers.values(), shares):
+            w.cores = cores
+            pin(w.proc.pid, cores)
+
+        print("[I] placement: adb on %s, %s" % (sorted(self.adb_cores) or "any",
+              ", ".join("%s on %s" % (w.serial, sorted(w.cores)) for w in self.workers.values())))
+
+    # -> [ (serial, pid, cores, cpu %, p99 ms, rounds) ], cpu since the last call
+    def rows(self):
+        return [ (w.serial, w.proc.pid, sorted(w.cores), w.usage(), w.p99(), int(w.latency[Worker.RING]))
+                 for w in self.workers.values() ]
+
+    def report(self):
+        rows = self.rows()
+
+        for serial, pid, cores, cpu, p99, rounds in rows:
+            print("%-24s pid %-7d cores %-12s cpu %6.1f%%  p99 %8.1f ms  rounds %d" %
+                  (serial, pid, ",".join(map(str, cores)), cpu, p99, rounds))
+
+        return rows
+
+    def run(self):
+        last_report = time.time()
+
+        while True:
+            if self.update():
+                self.rebalance()
+
+            if time.time() - last_report >= Fleet.REPORT_INTERVAL:
+                self.report()
+                last_report = time.time()
+
+            time.sleep(Fleet.SCAN_INTERVAL)
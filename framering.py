@@ -0,0 +1,214 @@
+#! /usr/bin/python3
+
+# a ring of preallocated frame slots in shared memory
+#
+# one capture process writes decoded frames in place, any number of detector
+# processes attach by name and get zero-copy numpy views of the slots
+#
+# every slot carries a sequence number used as a seqlock:
+#     odd  -> the writer is filling the slot
+#     even -> the slot holds frame (seq / 2 - 1)
+# the writer never waits for readers; a slow reader finds out that its view
+# was overwritten by checking the slot sequence again (see FrameRing.valid)
+
+import numpy as np
+import sys
+
+from multiprocessing import shared_memory, resource_tracker
+
+class FrameRing:
+    MAGIC = 0x62726e67 # "brng"
+
+    # header layout (int64 words)
+    H_MAGIC = 0
+    H_SLOTS = 1
+    H_HEAD = 2 # number of frames committed so far
+    H_NDIM = 3
+    H_SHAPE = 4 # 3 words of shape
+    H_DTYPE = 7 # ord(dtype.char)
+    H_WORDS = 8
+
+    ALIGN = 64
+
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner
+
+        header = np.ndarray((FrameRing.H_WORDS,), np.int64, shm.buf)
+
+        if header[FrameRing.H_MAGIC] != FrameRing.MAGIC:
+            raise ValueError("%s is not a frame ring" % shm.name)
+
+        self.slots = int(header[FrameRing.H_SLOTS])
+        self.shape = tuple(int(v) for v in header[FrameRing.H_SHAPE:FrameRing.H_SHAPE + header[FrameRing.H_NDIM]])
+        self.dtype = np.dtype(chr(header[FrameRing.H_DTYPE]))
+
+        self.header = header
+        self.seqs = np.ndarray((self.slots,), np.int64, shm.buf, FrameRing.H_WORDS * 8)
+
+        frame_size = FrameRing.frame_size(self.shape, self.dtype)
+        base = FrameRing.data_offset(self.slots)
+
+        self.frames = [ np.ndarray(self.shape, self.dtype, shm.buf, base + i * frame_size)
+                        for i in range(self.slots) ]
+
+    @staticmethod
+    def frame_size(shape, dtype):
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        return (size + FrameRing.ALIGN - 1) // FrameRing.ALIGN * FrameRing.ALIGN
+
+    @staticmethod
+    def data_offset(slots):
+        size = (FrameRing.H_WORDS + slots) * 8
+        return (size + FrameRing.ALIGN - 1) // FrameRing.ALIGN * FrameRing.ALIGN
+
+    # create a new ring, called by the capture process
+    @staticmethod
+    def create(shape, dtype = np.uint8, slots = 8, name = None):
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+
+        assert 1 <= len(shape) <= 3
+        assert slots >= 2
+
+        size = FrameRing.data_offset(slots) + slots * FrameRing.frame_size(shape, dtype)
+        shm = shared_memory.SharedMemory(name = name, create = True, size = size)
+
+        header = np.ndarray((FrameRing.H_WORDS + slots,), np.int64, shm.buf)
+        header[:] = 0
+        header[FrameRing.H_SLOTS] = slots
+        header[FrameRing.H_NDIM] = len(shape)
+        header[FrameRing.H_SHAPE:FrameRing.H_SHAPE + len(shape)] = shape
+        header[FrameRing.H_DTYPE] = ord(dtype.char)
+        header[FrameRing.H_MAGIC] = FrameRing.MAGIC
+        del header
+
+        return FrameRing(shm, True)
+
+    # attach to an existing ring by name, called by detector processes
+    @staticmethod
+    def attach(name):
+        if sys.version_info >= (3, 13):
+            shm = shared_memory.SharedMemory(name = name, track = False)
+        else:
+            # the creator owns the segment, keep it out of the resource
+            # tracker so it's not unlinked when this process exits
+            register = resource_tracker.register
+            resource_tracker.register = lambda *args: None
+
+            try:
+                shm = shared_memory.SharedMemory(name = name)
+            finally:
+                resource_tracker.register = register
+
+        return FrameRing(shm, False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    # total number of frames committed so far
+    def head(self):
+        return int(self.header[FrameRing.H_HEAD])
+
+    ##### writer side #####
+
+    # start writing frame number self.head() in place
+    # -> writable view of the slot, to be followed by commit()
+    def claim(self):
+        n = self.head()
+        slot = n % self.slots
+
+        self.seqs[slot] = 2 * n + 1 # odd: being written
+
+        return self.frames[slot]
+
+    def commit(self):
+        n = self.head()
+        slot = n % self.slots
+
+        self.seqs[slot] = 2 * n + 2
+        self.header[FrameRing.H_HEAD] = n + 1
+
+        return n
+
+    # copy a frame into the ring -> frame number
+    def write(self, frame):
+        np.copyto(self.claim(), frame, casting = "no")
+        return self.commit()
+
+    ##### reader side #####
+
+    # -> (frame number, zero-copy view) or None if frame n is not available,
+    #    either because it was overwritten or it is not written yet
+    # the view is only guaranteed to hold frame n while valid(n) is true
+    def read(self, n):
+        slot = n % self.slots
+
+        if self.seqs[slot] != 2 * n + 2:
+            return None
+
+        return n, self.frames[slot]
+
+    # newest committed frame -> (frame number, view) or None
+    def latest(self):
+        head = self.head()
+
+        # the newest slot may be overwritten while we look at it,
+        # fall back to older ones
+        for n in range(head - 1, max(head - self.slots, 0) - 1, -1):
+            res = self.read(n)
+
+            if res is not None:
+                return res
+
+        return None
+
+    # next frame for a reader that last saw frame n
+    # a reader that fell behind skips to the oldest frame still in the ring
+    # -> (frame number, view) or None if nothing new is there
+    def next(self, n):
+        head = self.head()
+        n = max(n + 1, head - self.slots + 1)
+
+        while n < head:
+            res = self.read(n)
+
+            if res is not None:
+                return res
+
+            n += 1
+
+        return None
+
+    # is the view obtained for frame n still intact
+    def valid(self, n):
+        return self.seqs[n % self.slots] == 2 * n + 2
+
+    # copy frame n out of the ring -> array or None if it got overwritten
+    def copy(self, n):
+        res = self.read(n)
+
+        if res is None:
+            return None
+
+        frame = res[1].copy()
+
+        return frame if self.valid(n) else None
+
+    def close(self):
+        # views must go before the buffer can be released
+        self.frames = []
+        self.seqs = None
+        self.header = None
+
+        self.shm.close()
+
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,136 @@
+#! /usr/bin/python3
+
+# capture rate governor
+#
+# picks the delay before the next screenshot from the loop state and the
+# scene activity, so a phone is only captured as often as a decision needs:
+#
+#     idle     -> coach mode, nothing will be pressed: between min_fps and
+#                 max_fps depending on how much the scene moves
+#     landing  -> a press was sent: no captures until the bottle should have
+#                 landed, then max_fps until the scene settles, or for at
+#                 most MAX_SETTLE seconds when it never does
+#     deciding -> about to press: max_fps
+#
+# activity is the mean absolute difference between tiny grayscale
+# thumbnails of consecutive frames, in gray levels
+
+import collections
+import time
+
+import cv2
+
+class CaptureGovernor:
+    IDLE = "idle"
+    LANDING = "landing"
+    DECIDING = "deciding"
+
+    STATES = (IDLE, LANDING, DECIDING)
+
+    THUMB_SIZE = (16, 28) # w, h
+    ACTIVE = 8.0 # activity at which idle capture runs at max_fps
+    SETTLED = 1.0 # activity under which the scene counts as still
+    SETTLE_FRAMES = 2 # still frames needed after landing
+    FLIGHT = 0.5 # seconds between the end of the press and the landing
+    MAX_SETTLE = 3.0 # seconds after the landing the scene may keep moving
+
+    def __init__(self, min_fps = 1.0, max_fps = 15.0):
+        assert 0 < min_fps <= max_fps
+
+        self.min_fps = min_fps
+        self.max_fps = max_fps
+
+        self.state = CaptureGovernor.IDLE
+        self.thumb = None
+        self.activity = 0.0
+        self.still = 0 # consecutive still frames
+        self.landing_at = 0
+
+        self.frames = 0
+        self.unsettled = 0 # landings that ended at MAX_SETTLE
+        self.state_frames = dict.fromkeys(CaptureGovernor.STATES, 0)
+        self.last_delay = 0
+        self.decisions = collections.deque(maxlen = 256) # (time, state, activity, delay)
+
+    # feed a captured frame
+    def observe(self, frame):
+        small = cv2.resize(frame, CaptureGovernor.THUMB_SIZE, interpolation = cv2.INTER_AREA)
+
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+        if self.thumb is not None:
+            self.activity = float(cv2.absdiff(small, self.thumb).mean())
+
+        self.thumb = small
+        self.still = self.still + 1 if self.activity < CaptureGovernor.SETTLED else 0
+
+        self.frames += 1
+        self.state_frames[self.state] += 1
+
+        if self.state == CaptureGovernor.LANDING and self.landed():
+            self.state = CaptureGovernor.DECIDING
+
+    # the loop is about to decide (auto mode) or only watching (coach mode)
+    def set_state(self, deciding):
+        if self.state != CaptureGovernor.LANDING:
+            self.state = CaptureGovernor.DECIDING if deciding else CaptureGovernor.IDLE
+
+    # a press of duration ms was sent
+    def pressed(self, duration):
+        self.state = CaptureGovernor.LANDING
+        self.landing_at = time.time() + duration / 1000 + CaptureGovernor.FLIGHT
+        self.still = 0
+
+    def landed(self):
+        now = time.time()
+
+        if now < self.landing_at:
+            return False
+
+        if self.still >= CaptureGovernor.SETTLE_FRAMES:
+            return True
+
+        # an animated background never settles
+        if now >= self.landing_at + CaptureGovernor.MAX_SETTLE:
+            self.unsettled += 1
+            return True
+
+        return False
+
+    # can the loop act on the current frame
+    def ready(self):
+        return self.state != CaptureGovernor.LANDING
+
+    def fps(self):
+        if self.state == CaptureGovernor.IDLE:
+            k = min(self.activity / CaptureGovernor.ACTIVE, 1.0)
+            return self.min_fps + (self.max_fps - self.min_fps) * k
+
+        return self.max_fps
+
+    # seconds to wait before the next capture
+    def delay(self):
+        now = time.time()
+
+        if self.state == CaptureGovernor.LANDING and now < self.landing_at:
+            delay = self.landing_at - now
+        else:
+            delay = 1 / self.fps()
+
+        self.last_delay = delay
+        self.decisions.append((now, self.state, self.activity, delay))
+
+        return delay
+
+    def metrics(self):
+        return {
+            "state": self.state,
+            "fps": 1 / self.last_delay if self.last_delay else self.max_fps,
+            "activity": self.activity,
+            "frames": self.frames,
+            "unsettled": self.unsettled,
+            "state_frames": dict(self.state_frames),
+            "min_fps": self.min_fps,
+            "max_fps": self.max_fps,
+        }
@@ -0,0 +1,154 @@
+#! /usr/bin/python3
+
+# append-only binary log with one fixed-size record per jump
+#
+# the file is a 64 byte header followed by packed JUMP records; the writer
+# keeps it memory-mapped and grows it in chunks, readers map it as a numpy
+# structured array without parsing anything:
+#
+#     log = JumpLog("session.jumps")
+#     log.append(time = ..., bottle = (x, y), ...)
+#
+#     jumps = JumpLog.load("session.jumps")
+#     jumps["dist"].mean()
+
+import os
+import time
+
+import numpy as np
+
+JUMP = np.dtype([
+    ("time", "<f8"), # capture time of the frame the jump was decided on
+    ("press_time", "<f8"),
+    ("bottle", "<i4", (2,)),
+    ("target", "<i4", (2,)),
+    ("dist", "<f4"),
+    ("duration", "<f4"), # ms
+    ("dir", "i1"), # 1 right, -1 left
+    ("turn", "i1"), # 0, or 1 / -1 when the direction changed
+    ("pad", "V6"),
+    # per-stage timings in ms
+    ("t_capture", "<f4"),
+    ("t_find_bottle", "<f4"),
+    ("t_next", "<f4"),
+    ("t_press", "<f4"),
+    ("fingerprint", "<u8"), # see fingerprint()
+    ("frame", "<i8"), # index of the frame in a recording, -1 if none
+])
+
+MAGIC = b"BRJUMPS1"
+HEADER = np.dtype([
+    ("magic", "S8"),
+    ("record_size", "<u4"),
+    ("pad", "V4"),
+    ("count", "<u8"), # committed records
+    ("created", "<f8"),
+    ("reserved", "V32"),
+])
+
+# 64 bit difference hash of a frame on a sparse 9x8 grid of pixels,
+# cheap enough to take on every jump
+def fingerprint(frame):
+    h, w = frame.shape[:2]
+    small = frame[h // 16::h // 8, w // 18::w // 9][:8, :9].astype(np.int32)
+
+    if small.ndim == 3:
+        small = small.sum(axis = 2)
+
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int(np.packbits(bits).view(">u8")[0])
+
+class JumpLog:
+    GROW = 4096 # records per file extension
+
+    def __init__(self, path):
+        self.path = path
+
+        exists = os.path.exists(path) and os.path.getsize(path) >= HEADER.itemsize
+
+        self.fp = open(path, "r+b" if exists else "w+b")
+
+        if not exists:
+            header = np.zeros((), HEADER)
+            header["magic"] = MAGIC
+            header["record_size"] = JUMP.itemsize
+            header["created"] = time.time()
+            self.fp.write(header.tobytes())
+            self.fp.flush()
+
+        self.header = np.memmap(self.fp, HEADER, "r+", 0, ())
+        JumpLog.check(self.header, path)
+
+        self.count = int(self.header["count"])
+        self.records = None
+        self.map(max(self.count, 1))
+
+    @staticmethod
+    def check(header, path):
+        if header["magic"] != MAGIC or header["record_size"] != JUMP.itemsize:
+            raise ValueError("%s is not a jump log of this version" % path)
+
+    # map room for at least n records
+    def map(self, n):
+        capacity = (n + JumpLog.GROW - 1) // JumpLog.GROW * JumpLog.GROW
+        size = HEADER.itemsize + capacity * JUMP.itemsize
+
+        if os.path.getsize(self.path) < size:
+            self.fp.truncate(size)
+
+        self.records = np.memmap(self.fp, JUMP, "r+", HEADER.itemsize, (capacity,))
+
+    # write one record, fields as keyword arguments -> record index
+    def append(self, **fields):
+        if self.count >= len(self.records):
+            self.records.flush()
+            self.map(self.count + 1)
+
+        rec = self.records[self.count]
+
+        for key, value in fields.items():
+            rec[key] = value
+
+        if "frame" not in fields:
+            rec["frame"] = -1
+
+        # the record is complete before the count says so
+        self.count += 1
+        self.header["count"] = self.count
+
+        return self.count - 1
+
+    # write records of another log (a JUMP array) -> index of the first
+    def extend(self, records):
+        if self.count + len(records) > len(self.records):
+            self.records.flush()
+            self.map(self.count + len(records))
+
+        self.records[self.count:self.count + len(records)] = records
+
+        self.count += len(records)
+        self.header["count"] = self.count
+
+        return self.count - len(records)
+
+    def flush(self):
+        self.records.flush()
+        self.header.flush()
+
+    def close(self):
+        self.flush()
+        self.records = self.header = None
+        self.fp.close()
+
+    # read a log, -> structured array of the committed records (memory-mapped)
+    @staticmethod
+    def load(path):
+        header = np.fromfile(path, HEADER, 1)[0]
+        JumpLog.check(header, path)
+
+        count = int(header["count"])
+
+        if count == 0:
+            return np.zeros(0, JUMP)
+
+        return np.memmap(path, JUMP, "r", HEADER.itemsize, (count,))
@@ -63,6 +63,8 @@ import cv2
 import os
 import io
 
+from governor import CaptureGovernor
+
 RESIZE_RATIO = 0.3
 SIM_PRESS_X = 600
 SIM_PRESS_Y = 600
@@ -128,6 +130,8 @@ def do_jump(apos, bpos, resize = RESIZE_RATIO):
 
     adb.shell_command(cmd)
 
+    return d2t(dist)
+
 screen = None
 bottle_pos = None
 
@@ -261,6 +265,8 @@ def init_bottle(screen, path = BOTTLE_IMG_PATH, resize = RESIZE_RATIO):
 cv2.namedWindow("screen")
 cv2.setMouseCallback("screen", on_mouse)
 
+governor = CaptureGovernor()
+
 mode = "coach"
 key = 0
 delay = 0
@@ -269,6 +275,9 @@ init = False
 while True:
     screen = screencap(resize = RESIZE_RATIO)
 
+    governor.observe(screen)
+    governor.set_state(mode == "auto")
+
     if not init:
         init = True
         init_bottle(screencap())
@@ -283,7 +292,7 @@ while True:
 
     cv2.imshow("screen", screen)
 
-    key = cv2.waitKey(1) & 0xff
+    key = cv2.waitKey(max(1, int(governor.delay() * 1000))) & 0xff
 
     if key == ord("s"):
         print("stop auto mode")
@@ -294,8 +303,8 @@ while True:
         print("continue auto mode")
         mode = "auto"
     
-    if mode == "auto" and delay > DELAY_FRAME:
-        do_jump(bottle_pos, next_pos)
+    if mode == "auto" and delay > DELAY_FRAME and governor.ready():
+        governor.pressed(do_jump(bottle_pos, next_pos))
         delay = 0
 
     delay += 1
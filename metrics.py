@@ -0,0 +1,347 @@
+#! /usr/bin/python3
+
+# counters and histograms of a worker, served as text over HTTP
+#
+#     http://host:port/metrics   Prometheus text format
+#
+# every thread updating a metric gets its own slots in it, so the hot path
+# only adds to a list it alone writes: no locks, and nothing is lost when the
+# loop and the adb watchers count at once. a scrape sums the slots of all
+# threads. Collector scrapes many workers and serves them merged, each
+# series labelled with the worker it came from
+
+import http.server
+import re
+import socketserver
+import threading
+import time
+import urllib.request
+
+# latency buckets in ms
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+def label_text(labels):
+    if not labels:
+        return ""
+
+    return "{%s}" % ",".join('%s="%s"' % kv for kv in sorted(labels.items()))
+
+class Metric:
+    KIND = None
+
+    def __init__(self, name, help, labels, size):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.size = size
+
+        self.local = threading.local()
+        self.slots = [] # of all threads
+        self.lock = threading.Lock() # only taken once per thread
+
+    # this thread's slots
+    def mine(self):
+        try:
+            return self.local.slots
+        except AttributeError:
+            slots = self.local.slots = [ 0 ] * self.size
+
+            with self.lock:
+                self.slots.append(slots)
+
+            return slots
+
+    def totals(self):
+        with self.lock:
+            shards = list(self.slots)
+
+        return [ sum(col) for col in zip(*shards) ] if shards else [ 0 ] * self.size
+
+class Counter(Metric):
+    KIND = "counter"
+
+    def __init__(self, name, help = "", labels = None):
+        super(Counter, self).__init__(name, help, labels or {}, 1)
+
+    def inc(self, n = 1):
+        self.mine()[0] += n
+
+    def value(self):
+        return self.totals()[0]
+
+    def render(self):
+        return [ "%s%s %s" % (self.name, label_text(self.labels), self.value()) ]
+
+class Gauge(Metric):
+    KIND = "gauge"
+
+    # a single value, last writer wins
+    def __init__(self, name, help = "", labels = None):
+        super(Gauge, self).__init__(name, help, labels or {}, 0)
+        self.current = 0
+
+    def set(self, value):
+        self.current = value
+
+    def value(self):
+        return self.current
+
+    def render(self):
+        return [ "%s%s %s" % (self.name, label_text(self.labels), self.current) ]
+
+class Histogram(Metric):
+    KIND = "histogram"
+
+    # slots: a count per bucket, then +Inf, then the sum
+    def __init__(self, name, help = "", labels = None, buckets = BUCKETS):
+        super(Histogram, self).__init__(name, help, labels or {}, len(buckets) + 2)
+        self.buckets = buckets
+
+    def observe(self, value):
+        slots = self.mine()
+        i = 0
+
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            i += 1
+
+        slots[i] += 1
+        slots[-1] += value
+
+    def render(self):
+        totals = self.totals()
+        lines = []
+        count = 0
+
+        for bound, n in zip(self.buckets + ("+Inf",), totals):
+            count += n
+            lines.append("%s_bucket%s %d" % (self.name, label_text(dict(self.labels, le = bound)), count))
+
+        lines.append("%s_sum%s %s" % (self.name, label_text(self.labels), totals[-1]))
+        lines.append("%s_count%s %d" % (self.name, label_text(self.labels), count))
+
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = {} # (name, labels) -> metric
+        self.lock = threading.Lock()
+
+    def get(self, cls, name, help, labels, **kwargs):
+        key = name, tuple(sorted((labels or {}).items()))
+
+        with self.lock:
+            metric = self.metrics.get(key)
+
+            if metric is None:
+                metric = self.metrics[key] = cls(name, help, labels, **kwargs)
+
+        return metric
+
+    def counter(self, name, help = "", labels = None):
+        return self.get(Counter, name, help, labels)
+
+    def gauge(self, name, help = "", labels = None):
+        return self.get(Gauge, name, help, labels)
+
+    def histogram(self, name, help = "", labels = None, buckets = BUCKETS):
+        return self.get(Histogram, name, help, labels, buckets = buckets)
+
+    def render(self):
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key = lambda m: m.name)
+
+        lines = []
+        name = None
+
+        for m in metrics:
+            if m.name != name:
+                name = m.name
+                lines.append("# HELP %s %s" % (m.name, m.help))
+                lines.append("# TYPE %s %s" % (m.name, m.KIND))
+
+            lines += m.render()
+
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+# the metrics Player updates
+class LoopMetrics:
+    STAGES = ("capture", "decode", "find_bottle", "next", "press")
+    STATES = ("coach", "auto", "jump", "idle", "landing", "deciding")
+
+    def __init__(self, registry = REGISTRY):
+        r = registry
+
+        self.jumps = r.counter("rush_jumps_total", "presses sent")
+        self.games = r.counter("rush_games_total", "games ended, the bottle was lost after jumping")
+        self.frames = r.counter("rush_frames_total", "frames captured")
+
+        self.skipped = { reason: r.counter("rush_frames_skipped_total", "rounds without a decision",
+                                           { "reason": reason })
+                         for reason in ("not_ready", "settling", "deadline") }
+
+        self.stages = { stage: r.histogram("rush_stage_ms", "latency of a loop stage in ms",
+                                           { "stage": stage })
+                        for stage in LoopMetrics.STAGES }
+
+        self.states = { state: r.gauge("rush_loop_state", "1 for the current loop state",
+                                       { "state": state })
+                        for state in LoopMetrics.STATES }
+
+        self.fps = r.gauge("rush_capture_fps", "capture rate picked by the governor")
+        self.activity = r.gauge("rush_scene_activity", "gray levels the scene changed by between frames")
+        self.unsettled = r.gauge("rush_unsettled_landings", "landings the governor stopped waiting for")
+
+        self.checks = r.gauge("rush_locator_checks", "frames the color locator was cross-checked on")
+        self.disagreements = r.gauge("rush_locator_disagreements", "cross-checks the locators disagreed on")
+        self.locator_error = r.gauge("rush_locator_max_error", "largest distance between the locators in pixels")
+
+        self.state = None
+
+    # CaptureGovernor.metrics()
+    def set_governor(self, values):
+        self.fps.set(values["fps"])
+        self.activity.set(values["activity"])
+        self.unsettled.set(values["unsettled"])
+
+    # of a refrac.Marker in "check" mode
+    def set_locator(self, marker):
+        self.checks.set(marker.checks)
+        self.disagreements.set(marker.disagreements)
+        self.locator_error.set(marker.max_error)
+
+    def set_state(self, state):
+        if state == self.state:
+            return
+
+        if self.state is not None:
+            self.states[self.state].set(0)
+
+        self.states[state].set(1)
+        self.state = state
+
+# count and time every adb command in registry
+def watch_adb(registry = REGISTRY):
+    import adb as pyadb3
+
+    commands = {}
+
+    def observe(cmd, res):
+        verb = cmd[0] if cmd else ""
+        m = commands.get(verb)
+
+        if m is None:
+            labels = { "command": verb }
+            m = commands[verb] = (registry.histogram("rush_adb_ms", "latency of adb commands in ms", labels),
+                                  registry.counter("rush_adb_failures_total", "adb commands that failed", labels))
+
+        m[0].observe(res.elapsed * 1000)
+
+        if not res.ok:
+            m[1].inc()
+
+    pyadb3.ADB.observer = observe
+
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    # render :: () -> exposition text
+    def __init__(self, port = 9200, render = REGISTRY.render, host = "127.0.0.1"):
+        self.render = render
+        super(MetricsServer, self).__init__((host, port), MetricsHandler)
+
+    @property
+    def url(self):
+        return "http://%s:%d/metrics" % self.server_address[:2]
+
+    def start(self):
+        threading.Thread(target = self.serve_forever, name = "metrics-http", daemon = True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            return self.send_error(404)
+
+        data = self.server.render().encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+SAMPLE = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})?\s+(\S+)$")
+
+# exposition text -> [ (name, labels text, value) ]
+def parse(text):
+    samples = []
+
+    for line in text.splitlines():
+        m = SAMPLE.match(line)
+
+        if m:
+            samples.append((m.group(1), m.group(2) or "", float(m.group(3))))
+
+    return samples
+
+class Collector:
+    TIMEOUT = 2
+
+    # targets :: worker metrics urls, e.g. http://10.0.0.5:9200/metrics
+    def __init__(self, targets):
+        self.targets = list(targets)
+        self.results = {} # target -> (time, samples or None)
+
+    def scrape_one(self, target):
+        try:
+            with urllib.request.urlopen(target, timeout = Collector.TIMEOUT) as resp:
+                self.results[target] = time.time(), parse(resp.read().decode())
+        except Exception as e:
+            print("[W] scraping %s failed: %s" % (target, e))
+            self.results[target] = time.time(), None
+
+    # scrape all targets at once
+    def scrape(self):
+        threads = [ threading.Thread(target = self.scrape_one, args = (t,), daemon = True) for t in self.targets ]
+
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        return self.results
+
+    # merged exposition text, every series labelled with its worker
+    def render(self):
+        self.scrape()
+        lines = []
+
+        for target in self.targets:
+            _, samples = self.results.get(target, (0, None))
+            worker = 'worker="%s"' % target
+
+            lines.append("rush_up{%s} %d" % (worker, samples is not None))
+
+            for name, labels, value in samples or ():
+                labels = "{%s,%s" % (worker, labels[1:]) if labels else "{%s}" % worker
+                lines.append("%s%s %s" % (name, labels, value))
+
+        return "\n".join(lines) + "\n"
+
+    # sum of a metric over all workers, e.g. total("rush_jumps_total")
+    def total(self, name):
+        return sum(value for _, samples in self.results.values() if samples
+                   for n, _, value in samples if n == name)
@@ -0,0 +1,136 @@
+#! /usr/bin/python3
+
+# on-demand sampling profiler
+#
+# while on, a background thread samples the stacks of all other threads at
+# a fixed rate for at most `window` seconds and then writes them in the
+# collapsed format flamegraph.pl and speedscope read:
+#
+#     thread;outer (file.py:12);inner (file.py:34) 17
+#
+# while off there is no thread and no hook, so it costs nothing. toggle it
+# from the loop (key "p" in the window) or with SIGUSR1 when headless
+
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+
+class SamplingProfiler:
+    def __init__(self, rate = 100, window = 30, output = "profile-%(pid)d-%(time)d.folded"):
+        self.rate = rate # samples per second
+        self.window = window # seconds, the profiler turns itself off after that
+        self.output = output
+
+        self.thread = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+        self.stacks = None
+        self.samples = 0
+        self.last_output = None
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        with self.lock:
+            if self.running():
+                return
+
+            self.stacks = collections.Counter()
+            self.samples = 0
+            self.stopped.clear()
+
+            self.thread = threading.Thread(target = self.loop, name = "profiler", daemon = True)
+            self.thread.start()
+
+        print("[I] profiler on (%d Hz, up to %ds)" % (self.rate, self.window))
+
+    # stop sampling and write the output -> path written or None
+    def stop(self):
+        thread = self.thread
+
+        if thread is None:
+            return None
+
+        self.stopped.set()
+
+        if thread is not threading.current_thread():
+            thread.join()
+
+        return self.last_output
+
+    def toggle(self):
+        if self.running():
+            return self.stop()
+
+        self.start()
+
+    # toggle on a signal, for headless runs: kill -USR1 <pid>
+    # -> False where there is no such signal (windows)
+    def install_signal(self, sig = None):
+        if sig is None:
+            sig = getattr(signal, "SIGUSR1", None)
+
+        if sig is None:
+            return False
+
+        # stopping joins the sampler and writes the output,
+        # keep that off the main thread the handler runs on
+        signal.signal(sig, lambda *args: threading.Thread(target = self.toggle, daemon = True).start())
+        return True
+
+    @staticmethod
+    def collapse(frame):
+        stack = []
+
+        while frame is not None:
+            code = frame.f_code
+            stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+            frame = frame.f_back
+
+        stack.reverse()
+        return stack
+
+    def sample(self, me, names):
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+
+            name = names.get(ident) or "thread-%d" % ident
+            self.stacks[";".join([ name ] + SamplingProfiler.collapse(frame))] += 1
+
+        self.samples += 1
+
+    def loop(self):
+        me = threading.get_ident()
+        interval = 1 / self.rate
+        deadline = time.time() + self.window
+
+        names = {}
+        next_at = time.time()
+
+        while not self.stopped.is_set() and time.time() < deadline:
+            # thread names only change when threads come and go
+            if len(names) != threading.active_count():
+                names = { t.ident: t.name for t in threading.enumerate() }
+
+            self.sample(me, names)
+
+            next_at += interval
+            self.stopped.wait(max(next_at - time.time(), 0))
+
+        self.write()
+
+    def write(self):
+        path = self.output % { "pid": os.getpid(), "time": time.time() }
+
+        with open(path, "w") as fp:
+            for stack, count in self.stacks.most_common():
+                fp.write("%s %d\n" % (stack, count))
+
+        self.last_output = path
+        print("[I] profiler off, %d samples written to %s" % (self.samples, path))
@@ -1,22 +1,25 @@
 #! /usr/bin/python3
 
+import ast
 import random
 import numpy as np
-from PIL import Image
 import math
 import time
 import sys
 import cv2
 import os
 import io
+import multiprocessing
+import struct
+import fractions
 
 INF = float("inf")
 
 class Util:
     @staticmethod
-    def resize(img, ratio):
+    def resize(img, ratio, dst = None):
         h, w = img.shape[:2]
-        return cv2.resize(img, (int(w * ratio), int(h * ratio)))
+        return cv2.resize(img, (int(w * ratio), int(h * ratio)), dst = dst)
 
     @staticmethod
     def pin(img, pos, radius = 3, color = (0, 0, 0)):
@@ -30,34 +33,176 @@ class Device:
     PRESS_POINT = (600, 600)
     RESIZE = 0.3 # resize the input image for better performance
 
+    # position of the last captured frame in the full (resized) frame,
+    # not (0, 0) when only a band of the screen is captured
+    origin = (0, 0)
+
+    # seconds a capture may take before it raises TimeoutError, None for
+    # the transport's default
+    timeout = None
+
     def __init__(self):
         h, w = self.screencap().shape[:2]
+
+        self.size = (w, h) # of full frames
         Device.PRESS_POINT = (w / 2 / Device.RESIZE, h / 2 / Device.RESIZE)
 
-    def screencap(self):
-        raw = self.screenraw()
-        img = cv2.imdecode(np.fromstring(raw, np.uint8), cv2.IMREAD_COLOR)
+    # dst :: optional preallocated frame (e.g. a FrameRing slot) to resize into
+    def screencap(self, dst = None):
+        return self.decoder().decode(self.screenraw(), dst)
 
-        img = Util.resize(img, Device.RESIZE)
+    # decode.Decoder picking the cheapest way to decode at Device.RESIZE
+    def decoder(self):
+        dec = getattr(self, "_decoder", None)
 
-        return img
+        if dec is None or dec.scale != Device.RESIZE:
+            import decode
+            dec = self._decoder = decode.Decoder(Device.RESIZE)
+
+        return dec
 
     def press(self, duration):
         self.taphold(*Device.PRESS_POINT, duration)
 
+    # can the device take commands right now
+    def ready(self):
+        return True
+
 class AndroidDevice(Device):
-    def __init__(self):
-        import adb as pyadb3
+    PRESS_SLACK = 2.0 # seconds a swipe may take on top of its duration
+    CONNECT_TIMEOUT = 60 # seconds the pool may take to bring the device up
+
+    # pool :: optional adbpool.TransportPool that keeps the connection healthy
+    # band :: optional (top, bottom) fractions of the screen height, only
+    #         these rows of the raw framebuffer are transferred
+    # capture :: optional callable client -> capture.Capture transport used
+    #            instead of screencap + pull
+    def __init__(self, serial = None, adb_path = "adb", pool = None, band = None, capture = None):
+        self.serial = serial
+        self.pool = pool
+        self.band = None
+        self.capture = None
+
+        if pool is None:
+            import adb as pyadb3
+            self.adb = pyadb3.ADB(adb_path, device = serial)
+        else:
+            self.adb = pool.wait(serial, AndroidDevice.CONNECT_TIMEOUT)
+
+            if self.adb is None:
+                raise IOError("%s didn't come up in %ds" % (serial, AndroidDevice.CONNECT_TIMEOUT))
 
-        self.adb = pyadb3.ADB()
+        if band is not None:
+            self.set_band(*band)
+
+        if capture is not None:
+            self.capture = capture(self.adb)
+            self.capture.decoder = self.decoder()
 
         super(AndroidDevice, self).__init__()
 
+        if self.band is not None:
+            # the captured frame is only the band
+            Device.PRESS_POINT = (self.raw_size[0] / 2, self.raw_size[1] / 2)
+            self.size = (int(self.raw_size[0] * Device.RESIZE), int(self.raw_size[1] * Device.RESIZE))
+
+    # adb command within timeout (self.timeout when None) -> ADBResult,
+    # raises adb.ADBTimeoutError when it had to be killed
+    def adb_call(self, cmd, timeout = None):
+        import adb as pyadb3
+
+        res = self.adb.call(cmd, self.timeout if timeout is None else timeout)
+
+        if res.timed_out:
+            raise pyadb3.ADBTimeoutError(res, cmd)
+
+        return res
+
+    # run a shell pipeline on the device -> raw stdout
+    def exec_out(self, cmd):
+        return self.adb_call([ "exec-out", cmd ]).stdout or b""
+
+    # raw screencap output is a header (width, height, format[, dataspace]
+    # as u32) followed by RGBA_8888 rows -> (width, height, header size)
+    def probe_raw(self):
+        w, h, fmt = struct.unpack("<3I", self.exec_out("screencap | head -c 12")[:12])
+        size = int(self.exec_out("screencap | wc -c").strip())
+
+        assert fmt == 1, "unsupported framebuffer format %d" % fmt # RGBA_8888
+
+        return w, h, size - w * h * 4
+
+    def set_band(self, top, bottom):
+        import decode
+
+        w, h, header = self.probe_raw()
+
+        # align the band so that it starts on a whole pixel of the resized
+        # frame (10 rows at RESIZE 0.3) and on a row the decoder's strided
+        # path keeps
+        step = fractions.Fraction(Device.RESIZE).limit_denominator(1000).denominator
+        factor = decode.reduction(Device.RESIZE)[0]
+        step = step * factor // math.gcd(step, factor)
+
+        y0 = int(h * top) // step * step
+        y1 = min(-(-int(h * bottom) // step) * step, h)
+
+        self.raw_size = (w, h)
+        self.band = (y0, y1)
+        self.band_cmd = "screencap | tail -c +%d | head -c %d" % \
+                        (header + y0 * w * 4 + 1, (y1 - y0) * w * 4)
+
+        self.origin = (0, int(round(y0 * Device.RESIZE)))
+
+    def screencap(self, dst = None):
+        if self.band is None:
+            if self.capture is not None:
+                # decoded at Device.RESIZE by the capture's decoder
+                self.capture.decoder = self.decoder()
+                self.capture.timeout = self.timeout
+                img = self.capture.frame()
+
+                if dst is not None:
+                    np.copyto(dst, img)
+                    return dst
+
+                return img
+
+            return super(AndroidDevice, self).screencap(dst)
+
+        w = self.raw_size[0]
+        y0, y1 = self.band
+        raw = self.exec_out(self.band_cmd)
+
+        rows = len(raw) // (w * 4)
+        assert rows == y1 - y0, "short framebuffer read (%d of %d rows)" % (rows, y1 - y0)
+
+        # a raw screencap header for the band, so it is decoded (and timed)
+        # like whole frames
+        return self.decoder().decode(struct.pack("<3I", w, rows, 1) + raw, dst)
+
+    def ready(self):
+        if self.pool is None:
+            return True
+
+        client = self.pool.get(self.serial)
+
+        if client is not None:
+            self.adb = client
+
+        return client is not None
+
     def screenraw(self):
-        self.adb.shell_command("screencap /sdcard/bottle-test.png")
-        self.adb.run_cmd([ "pull", "/sdcard/bottle-test.png", "bottle-test.png" ])
+        # one local file per device, fleet workers share the directory
+        local = "bottle-test.png" if self.serial is None else "bottle-test-%s.png" % self.serial.replace(":", "_")
 
-        with open("bottle-test.png", "rb") as fp:
+        # a timeout anywhere leaves a stale or partial local file
+        start = time.perf_counter()
+        self.adb_call([ "shell", "screencap", "/sdcard/bottle-test.png" ])
+        left = None if self.timeout is None else max(self.timeout - (time.perf_counter() - start), 0.01)
+        self.adb_call([ "pull", "/sdcard/bottle-test.png", local ], left)
+
+        with open(local, "rb") as fp:
             cont = fp.read()
 
         return cont
@@ -65,17 +210,41 @@ class AndroidDevice(Device):
     def taphold(self, x, y, duration):
         cmd = "input swipe %d %d %d %d %d" % (x, y, x, y, duration)
         print(cmd)
-        self.adb.shell_command(cmd)
+        self.adb_call([ "shell" ] + cmd.split(), duration / 1000 + AndroidDevice.PRESS_SLACK)
 
 class iOSDevice(Device):
-    def __init__(self):
-        import wda
+    # mjpeg :: url of WDA's MJPEG server, frames are then streamed instead of
+    #          requesting a screenshot per frame
+    def __init__(self, url = "http://localhost:8100", mjpeg = None):
+        if mjpeg is None:
+            import wda
+
+            self.client = wda.Client(url)
+            self.session = self.client.session()
+            self.stream = None
+        else:
+            import wdastream
 
-        self.client = wda.Client()
-        self.session = self.client.session()
+            self.client = self.session = wdastream.WDASession(url)
+            self.stream = wdastream.MJPEGReader(mjpeg).start()
+            self.seq = 0
 
         super(iOSDevice, self).__init__()
 
+    def screencap(self, dst = None):
+        if self.stream is None:
+            return super(iOSDevice, self).screencap(dst)
+
+        # newest frame, decoded at reduced scale; waits rather than
+        # returning the same frame twice
+        self.seq, img = self.stream.wait_newer(self.seq, Device.RESIZE, self.stream.timeout)
+
+        if dst is not None:
+            np.copyto(dst, img)
+            return dst
+
+        return img
+
     def screenraw(self):
         return self.client.screenshot()
 
@@ -86,6 +255,111 @@ class Measure:
     PIVOT_POS = None
     UNIT = -1 # pixel / TJSU
     SCALE = 0
+    RESIZE = Device.RESIZE # frame scale the measures are for
+
+    FIELDS = ("UNIT", "PIVOT_POS", "SCALE", "RESIZE")
+
+    # calibration values { UNIT, PIVOT_POS, SCALE, RESIZE } -> the same
+    # values normalized, raises ValueError when they can't be a calibration
+    @staticmethod
+    def check(values):
+        def positive(key):
+            value = values.get(key)
+
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+               not 0 < value < INF:
+                raise ValueError("calibration %s must be a positive number, not %r" % (key, value))
+
+            return float(value)
+
+        pivot = values.get("PIVOT_POS")
+
+        if not isinstance(pivot, (list, tuple)) or len(pivot) != 2 or \
+           not all(isinstance(v, int) and not isinstance(v, bool) and 0 <= v < 1 << 16 for v in pivot):
+            raise ValueError("calibration PIVOT_POS must be two pixel coordinates, not %r" % (pivot,))
+
+        resize = positive("RESIZE")
+
+        if resize > 4:
+            raise ValueError("calibration RESIZE %r out of range" % resize)
+
+        return { "UNIT": positive("UNIT"), "PIVOT_POS": tuple(pivot),
+                 "SCALE": positive("SCALE"), "RESIZE": resize }
+
+    # text of a calibration file -> its checked values; the file is read as
+    # data, nothing in it is run
+    @staticmethod
+    def parse(text):
+        values = {}
+
+        try:
+            tree = ast.parse(text)
+        except SyntaxError as e:
+            raise ValueError("calibration is not readable: %s" % e)
+
+        for node in tree.body:
+            if not isinstance(node, ast.ClassDef) or node.name != "Measure":
+                continue
+
+            for stmt in node.body:
+                if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and \
+                   isinstance(stmt.targets[0], ast.Name) and stmt.targets[0].id in Measure.FIELDS:
+                    values[stmt.targets[0].id] = ast.literal_eval(stmt.value)
+
+        # files from before RESIZE was stored
+        values.setdefault("RESIZE", 0.3)
+
+        return Measure.check(values)
+
+    # calibration file text of values, as Marker.save_calib writes it
+    @staticmethod
+    def text(values):
+        return """class Measure:
+    UNIT = %f
+    PIVOT_POS = %s
+    SCALE = %f
+    RESIZE = %f""" % (values["UNIT"], tuple(values["PIVOT_POS"]), values["SCALE"], values["RESIZE"])
+
+    # use checked values, rescaled to the frames of Device.RESIZE
+    @staticmethod
+    def apply(values):
+        Measure.UNIT = values["UNIT"]
+        Measure.PIVOT_POS = tuple(values["PIVOT_POS"])
+        Measure.SCALE = values["SCALE"]
+        Measure.RESIZE = values["RESIZE"]
+
+        # calibrated on frames of another scale
+        return Measure.rescale(Device.RESIZE / Measure.RESIZE)
+
+    # load the calibration written by Marker.save_calib
+    @staticmethod
+    def load(path = "measure.py"):
+        with open(path) as fp:
+            return Measure.apply(Measure.parse(fp.read()))
+
+    # measures for frames scaled by factor
+    @staticmethod
+    def rescale(factor):
+        if factor == 1:
+            return Measure
+
+        Measure.UNIT *= factor
+        Measure.PIVOT_POS = int(Measure.PIVOT_POS[0] * factor), int(Measure.PIVOT_POS[1] * factor)
+        Measure.SCALE /= factor
+        Measure.RESIZE *= factor
+
+        return Measure
+
+    # stand-in calibration from the frame size and the template in use,
+    # for devices that were never calibrated
+    @staticmethod
+    def estimate(width, height, bottle):
+        Measure.UNIT = bottle.shape[0] * 0.9 / Marker.BOTTLE_HEIGHT
+        Measure.PIVOT_POS = \
+            int((width + Marker.CENTER_DELTA[0]) / 2), \
+            int((height + Marker.CENTER_DELTA[1]) / 2)
+
+        return Measure
 
 # image -> start & end point
 class Marker:
@@ -112,11 +386,131 @@ class Marker:
     X_AXIS_SCREEN_ANGLE = 0.8224182792713783
     Z_AXIS_SCREEN_ANGLE = 0.7483780475235182
 
-    def __init__(self, path):
+    # bottle body color range in BGR, no block uses it
+    BOTTLE_COLOR_LOW = (75, 43, 45)
+    BOTTLE_COLOR_HIGH = (118, 68, 72)
+    COLOR_BAND = (0.25, 0.85) # rows searched by the color locator, fraction of the height
+    COLOR_SLICE = 3 # rows at the bottom of the mask averaged for the base
+    COLOR_TOLERANCE = 4 # pixels the locators may disagree by in "check" mode
+    WARN_INTERVAL = 10 # seconds between warnings about disagreeing locators
+
+    LOCATORS = ("template", "color", "check", "fft")
+    CALIB_SCALES = (0.2, 4, 30) # linspace of the scales calib tries
+
+    # locator :: "template" matches the calibrated template
+    #            "color" thresholds the bottle color, needs no scale calibration
+    #            "check" uses the template and cross-checks the color locator
+    #            "fft" matches the template in the frequency domain (fftmatch),
+    #            calib then tries all scales against one transform of the frame
+    # coarse :: thumbnail scale of the two-resolution mode, e.g. 0.25: mark finds
+    #           the bottle (by template) and the target on a thumbnail of the
+    #           frame and only refines them in small crops of the frame
+    # segment :: label the frame once per mark (segment.SceneIndex) and look the
+    #            target and the current block up in it instead of flood filling
+    def __init__(self, path, locator = "template", coarse = None, segment = False):
+        assert locator in Marker.LOCATORS
+
         self.bottle = cv2.imread(path, 0)
         self.prev_dir = 1
+        self.draw = True # annotate the frames in display
+
+        self.locator = locator
+        self.coarse = coarse
+        self.thumb = None # of the last find_bottle_refined
+        self.coarse_bottle = (None, None) # (self.bottle, its thumbnail scale copy)
+
+        self.segment = segment
+        self.index = None # segment.SceneIndex of the last mark
+
+        self.correlator = None # fftmatch.Correlator for the frame size
+        self.fft_bottle = None # template the correlator has
+        self.checks = 0
+        self.disagreements = 0
+        self.max_error = 0
+        self.warned = -INF # time of the last disagreement warning
+
+        # of the last mark
+        self.turn = 0
+        self.score = 0 # of the bottle match
+        self.timings = (0, 0) # find_bottle, next in sec
+
+        # of the last find_bottle, drawn by display: the frame is left alone
+        # until next has flood filled it
+        self.bottle_box = None # (top left, bottom right) of the template match
+        self.color_pos = None # of the color locator
+
+    # narrow :: let the color locator only search Marker.COLOR_BAND,
+    #           false when screen already is a band of the frame
+    def find_bottle(self, screen, narrow = True):
+        if self.locator == "template":
+            return self.find_bottle_template(screen)
+
+        if self.locator == "color":
+            pos, val = self.find_bottle_color(screen, narrow)
+
+            if pos is None:
+                # nothing bottle colored, e.g. under an effect: the template
+                # still gives a position, the 0 score tells the caller
+                pos, _ = self.find_bottle_template(screen)
+
+            return pos, val
+
+        if self.locator == "fft":
+            return self.find_bottle_fft(screen)
 
-    def find_bottle(self, screen):
+        pos, val = self.find_bottle_template(screen)
+        cpos, _ = self.find_bottle_color(screen, narrow)
+
+        self.checks += 1
+
+        err = INF if cpos is None else Util.dist(pos, cpos)
+
+        if err > Marker.COLOR_TOLERANCE:
+            self.disagreements += 1
+
+            # the counts are in the metrics, don't flood the log
+            if time.monotonic() - self.warned >= Marker.WARN_INTERVAL:
+                self.warned = time.monotonic()
+                print("[W] locators disagree: template %s color %s (%d of %d checks)" %
+                      (pos, cpos, self.disagreements, self.checks))
+
+        if err != INF:
+            self.max_error = max(self.max_error, err)
+
+        return pos, val
+
+    # locate the base of the bottle by its color
+    # -> (pos, 1) or (None, 0) if there is no bottle colored pixel
+    def find_bottle_color(self, screen, narrow = True):
+        h = screen.shape[0]
+        top = int(h * Marker.COLOR_BAND[0]) if narrow else 0
+        bottom = int(h * Marker.COLOR_BAND[1]) if narrow else h
+
+        mask = cv2.inRange(screen[top:bottom], Marker.BOTTLE_COLOR_LOW, Marker.BOTTLE_COLOR_HIGH)
+
+        # ignore rows with a stray pixel or two
+        rows = np.flatnonzero(np.count_nonzero(mask, axis = 1) > 2)
+
+        if not len(rows):
+            return None, 0
+
+        base = rows[-1]
+        ys, xs = np.nonzero(mask[max(base - Marker.COLOR_SLICE + 1, 0):base + 1])
+        x = xs.mean()
+
+        # follow the column of the base up to the head for the height,
+        # the template position sits at 0.9 of it
+        half = (xs.max() - xs.min()) / 2 + 1
+        column = mask[:base + 1, int(max(x - half, 0)):int(x + half) + 1]
+        head = np.flatnonzero(column.any(axis = 1))[0]
+
+        pos = (int(x), int(top + base - 0.1 * (base - head)))
+
+        self.color_pos = pos
+
+        return pos, 1
+
+    def find_bottle_template(self, screen):
         h, w = self.bottle.shape
 
         res = cv2.matchTemplate(cv2.cvtColor(screen, cv2.COLOR_BGR2GRAY),
@@ -126,7 +520,8 @@ class Marker:
 
         pos = (int(max_loc[0] + w / 2), int(max_loc[1] + h * 0.9))
 
-        cv2.rectangle(screen, max_loc, (max_loc[0] + w, max_loc[1] + h), (0, 0, 0), 1)
+        self.bottle_box = max_loc, (max_loc[0] + w, max_loc[1] + h)
+
         # cv2.rectangle(screen, min_loc, (min_loc[0] + w, min_loc[1] + h), (0, 0, 255), 2)
         # Util.pin(screen, pos)
         # cv2.imshow("screen", screen)
@@ -134,14 +529,76 @@ class Marker:
         # pos -> center of the bottle
         return pos, max_val
 
+    # find_bottle_template with the correlation done by fftmatch, the
+    # template spectrum is computed once per frame size
+    def find_bottle_fft(self, screen):
+        import fftmatch
+
+        h, w = self.bottle.shape
+        size = screen.shape[1], screen.shape[0]
+
+        if self.correlator is None or self.correlator.size != size:
+            self.correlator = fftmatch.Correlator(size)
+            self.fft_bottle = None
+
+        if self.fft_bottle is not self.bottle:
+            self.correlator.add("bottle", self.bottle)
+            self.fft_bottle = self.bottle
+
+        self.correlator.transform(cv2.cvtColor(screen, cv2.COLOR_BGR2GRAY))
+        max_val, max_loc = self.correlator.match("bottle")
+
+        self.bottle_box = max_loc, (max_loc[0] + w, max_loc[1] + h)
+
+        return (int(max_loc[0] + w / 2), int(max_loc[1] + h * 0.9)), max_val
+
+    # find the bottle on a thumbnail, then match the template again in a crop
+    # of the frame around the rough position
+    def find_bottle_refined(self, screen):
+        c = self.coarse
+        h, w = self.bottle.shape
+
+        if self.coarse_bottle[0] is not self.bottle:
+            self.coarse_bottle = self.bottle, Util.resize(self.bottle, c)
+
+        self.thumb = Util.resize(screen, c)
+
+        res = cv2.matchTemplate(cv2.cvtColor(self.thumb, cv2.COLOR_BGR2GRAY),
+                                self.coarse_bottle[1], cv2.TM_CCOEFF_NORMED)
+        _, max_val, _, max_loc = cv2.minMaxLoc(res)
+
+        # a thumbnail pixel is 1 / c frame pixels, allow for two of them
+        m = int(2 / c) + 1
+        x0 = max(int(max_loc[0] / c) - m, 0)
+        y0 = max(int(max_loc[1] / c) - m, 0)
+        crop = screen[y0:y0 + h + 2 * m, x0:x0 + w + 2 * m]
+
+        if crop.shape[0] >= h and crop.shape[1] >= w:
+            res = cv2.matchTemplate(cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY),
+                                    self.bottle, cv2.TM_CCOEFF_NORMED)
+            _, max_val, _, loc = cv2.minMaxLoc(res)
+            max_loc = (x0 + loc[0], y0 + loc[1])
+        else:
+            max_loc = (int(max_loc[0] / c), int(max_loc[1] / c))
+
+        self.bottle_box = max_loc, (max_loc[0] + w, max_loc[1] + h)
+
+        return (int(max_loc[0] + w / 2), int(max_loc[1] + h * 0.9)), max_val
+
     def apply_calib(self):
         self.bottle = Util.resize(self.bottle, 1 / Measure.SCALE)
 
+    # take the template for frames of the given width from a tbank.TemplateBank
+    # instead of rescaling self.bottle
+    def apply_bank(self, bank, width):
+        scale = bank.scale_for_width(width)
+
+        self.bottle = bank.pick(scale)
+        Measure.SCALE = 1 / scale
+
     def save_calib(self):
-        return """class Measure:
-    UNIT = %f
-    PIVOT_POS = %s
-    SCALE = %f""" % (Measure.UNIT, Measure.PIVOT_POS, Measure.SCALE)
+        return Measure.text({ "UNIT": Measure.UNIT, "PIVOT_POS": Measure.PIVOT_POS,
+                              "SCALE": Measure.SCALE, "RESIZE": Device.RESIZE })
 
     # calib :: screen -> update self.bottle Measure.UNIT
     # ASSERT: screen is at the initial position
@@ -149,15 +606,18 @@ class Marker:
         max_val = -INF
         max_scale = 0
 
-        for scale in np.linspace(0.2, 4, 30).tolist():
-            print("trying scale %f" % scale)
+        if self.locator == "fft":
+            max_scale = self.calib_scale_fft(screen)
+        else:
+            for scale in np.linspace(*Marker.CALIB_SCALES).tolist():
+                print("trying scale %f" % scale)
 
-            nscreen = Util.resize(screen, scale)   
-            _, val = self.find_bottle(nscreen)
+                nscreen = Util.resize(screen, scale)   
+                _, val = self.find_bottle_template(nscreen)
 
-            if val > max_val:
-                max_val = val
-                max_scale = scale
+                if val > max_val:
+                    max_val = val
+                    max_scale = scale
         
         print("optimal scale %f" % max_scale)
 
@@ -192,6 +652,30 @@ class Marker:
 
         return Measure
 
+    # the calib sweep with the template scaled instead of the frame, every
+    # scale correlated against one forward transform -> best scale
+    def calib_scale_fft(self, screen):
+        import fftmatch
+
+        h, w = screen.shape[:2]
+        corr = fftmatch.Correlator((w, h))
+
+        for scale in np.linspace(*Marker.CALIB_SCALES).tolist():
+            th, tw = self.bottle.shape
+            th, tw = int(th / scale), int(tw / scale)
+
+            # the frame was scaled up or down to fit the template before
+            if 0 < th <= h and 0 < tw <= w:
+                corr.add(scale, cv2.resize(self.bottle, (tw, th)))
+
+        corr.transform(cv2.cvtColor(screen, cv2.COLOR_BGR2GRAY))
+        scores = corr.match_all()
+
+        for scale, (val, _) in sorted(scores.items()):
+            print("scale %f: %f" % (scale, val))
+
+        return max(scores, key = lambda scale: scores[scale][0])
+
     # real distance in x axis
     @staticmethod
     def rd_x(dist):
@@ -202,8 +686,84 @@ class Marker:
     def rd_z(dist):
         return dist / math.sin(Marker.Z_AXIS_SCREEN_ANGLE)
 
-    def next(self, screen, bottle_pos):
+    # origin :: position of screen in the full frame, see Device.origin
+    #           bottle_pos and the result are relative to screen
+    def next(self, screen, bottle_pos, origin = (0, 0)):
+        h, w = screen.shape[:2]
+        (px, py), dir, turn = self.predict(bottle_pos, origin)
+
+        if self.index is not None:
+            # a seed on the background or an edge snaps to the closest block
+            region = self.index.region_at((px, py)) or self.index.nearest((px, py))
+
+            if region is None:
+                return (px, py), dir, turn
+
+            return self.index.center(region), dir, turn
+
+        # adjust pos
+        return Marker.fill_center(screen, (px, py)), dir, turn
+
+    # center of the block around pos by flood filling it, pos itself when
+    # it is off the screen; screen is left alone
+    @staticmethod
+    def fill_center(screen, pos):
         h, w = screen.shape[:2]
+        px, py = int(pos[0]), int(pos[1])
+
+        if px < 0 or px >= w or py < 0 or py >= h:
+            return px, py
+
+        if not screen.flags.writeable:
+            # FLOODFILL_MASK_ONLY leaves the image alone but cv2 wants it writable
+            screen = screen.copy()
+
+        mask = np.zeros((h + 2, w + 2), np.uint8)
+        _, _, _, (x, y, fw, fh) = \
+            cv2.floodFill(screen, mask, (px, py),
+                          (0, 0, 0), (4, 4, 4), (4, 4, 4),
+                          cv2.FLOODFILL_MASK_ONLY)
+
+        return int(x + fw / 2), int(y + fh / 2)
+
+    # next with the target region found on the thumbnail of the last
+    # find_bottle_refined and only filled again in a crop of the frame
+    def next_refined(self, screen, bottle_pos, origin = (0, 0)):
+        h, w = screen.shape[:2]
+        (px, py), dir, turn = self.predict(bottle_pos, origin)
+
+        if px < 0 or px >= w or py < 0 or py >= h:
+            return (px, py), dir, turn
+
+        c = self.coarse
+        th, tw = self.thumb.shape[:2]
+
+        mask = np.zeros((th + 2, tw + 2), np.uint8)
+        _, _, _, (x, y, fw, fh) = \
+            cv2.floodFill(self.thumb, mask, (min(int(px * c), tw - 1), min(int(py * c), th - 1)),
+                          (0, 0, 0), (4, 4, 4), (4, 4, 4),
+                          cv2.FLOODFILL_MASK_ONLY)
+
+        m = int(2 / c) + 1
+        x0, y0 = max(int(x / c) - m, 0), max(int(y / c) - m, 0)
+        x1, y1 = min(int((x + fw) / c) + m, w), min(int((y + fh) / c) + m, h)
+
+        crop = screen[y0:y1, x0:x1]
+
+        if not (x0 <= px < x1 and y0 <= py < y1):
+            return (px, py), dir, turn
+
+        mask = np.zeros((y1 - y0 + 2, x1 - x0 + 2), np.uint8)
+        _, _, _, (x, y, fw, fh) = \
+            cv2.floodFill(crop, mask, (px - x0, py - y0),
+                          (0, 0, 0), (4, 4, 4), (4, 4, 4),
+                          cv2.FLOODFILL_MASK_ONLY)
+
+        return (int(x0 + x + fw / 2), int(y0 + y + fh / 2)), dir, turn
+
+    # predicted landing point from the pivot, before snapping it to the
+    # block -> (pos, dir, turn), updates prev_dir
+    def predict(self, bottle_pos, origin = (0, 0)):
         bx, by = bottle_pos
 
         # if Measure.PIVOT_POS == None:
@@ -213,6 +773,7 @@ class Marker:
         # else:
         
         cx, cy = Measure.PIVOT_POS
+        cx, cy = cx - origin[0], cy - origin[1]
 
         # cv2.circle(screen, (cx, cy), 4, (100, 100, 100), -1)
         # Util.pin(screen, (cx, cy))
@@ -254,30 +815,169 @@ class Marker:
 
         # obs_angle = math.acos()
 
-        px, py = (int(px), int(py))
+        return (int(px), int(py)), self.prev_dir, turn
 
-        # adjust pos
+    # vectorized version of the prediction part of next
+    # bottle :: (N, 2) bottle positions of consecutive frames
+    # prev_dir :: direction of the jump before the first frame
+    # -> predicted next positions (N, 2), dirs (N,), turns (N,)
+    @staticmethod
+    def predict_batch(bottle, pivot, prev_dir = 1):
+        cx, cy = pivot
+        bx = bottle[:, 0].astype(np.float64)
+        by = bottle[:, 1].astype(np.float64)
 
-        mask = np.zeros((h + 2, w + 2), np.uint8)
+        dx = cx - bx
+        dy = cy - by
 
-        if px < 0 or px >= w or py < 0 or py >= h:
-            return (px, py), self.prev_dir, turn
+        dist = np.hypot(dx, dy)
+
+        dirs = np.where(cx > bx, 1, -1)
+        prevs = np.concatenate(([prev_dir], dirs[:-1]))
+
+        # correction on turn
+        turning = dx * prevs < 0
+
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            a1 = np.arctan(np.abs(dy) / np.abs(dx)) + \
+                 np.where(prevs == 1, Marker.JUMP_RIGHT_ANGLE, Marker.JUMP_LEFT_ANGLE)
+
+        tot = Marker.JUMP_LEFT_ANGLE + Marker.JUMP_RIGHT_ANGLE
+        tot = tot if tot < math.pi / 2 else math.pi - tot
+
+        dist = np.where(turning, dist * np.sin(a1) / math.sin(tot), dist)
+        turns = np.where(turning, np.where(prevs == 1, -1, 1), 0)
+
+        right = dirs == 1
+        px = np.where(right, cx + dist * Marker.JUMP_RIGHT_ANGLE_COS,
+                             cx - dist * Marker.JUMP_LEFT_ANGLE_COS)
+        py = np.where(right, cy - dist * Marker.JUMP_RIGHT_ANGLE_SIN,
+                             cy - dist * Marker.JUMP_LEFT_ANGLE_SIN)
+
+        pred = np.stack((np.trunc(px), np.trunc(py)), axis = 1).astype(np.int64)
+
+        return pred, dirs, turns
+
+    # batch version of mark for offline re-scoring
+    # frames :: stacked (N, H, W, 3) array or np.memmap of consecutive frames
+    # workers > 1 spreads the matching over worker processes
+    # -> bottle positions (N, 2), next positions (N, 2), distances (N,)
+    # unlike mark, the frames are not modified and self.prev_dir is kept;
+    # the bottle is found with self.find_bottle, the coarse and the segment
+    # modes have no batch version
+    def mark_batch(self, frames, workers = 0, chunk = 64, prev_dir = None):
+        if self.coarse or self.segment:
+            raise ValueError("mark_batch supports neither the coarse nor the segment mode")
+
+        if prev_dir is None:
+            prev_dir = self.prev_dir
+
+        n = len(frames)
+        pivot = tuple(Measure.PIVOT_POS)
+
+        bottle = np.zeros((n, 2), np.int64)
+        next = np.zeros((n, 2), np.int64)
+        dist = np.zeros(n, np.float64)
+
+        spans = [ (i, min(i + chunk, n)) for i in range(0, n, chunk) ]
+
+        if workers > 1 and len(spans) > 1:
+            global _batch_frames
+
+            if "fork" in multiprocessing.get_all_start_methods():
+                # children inherit the frames (or the mapping) for free
+                _batch_frames = frames
+                ctx = multiprocessing.get_context("fork")
+                jobs = [ (None, start, stop, self, pivot, prev_dir) for start, stop in spans ]
+            else:
+                ctx = multiprocessing.get_context()
+                jobs = [ (np.asarray(frames[max(start - 1, 0):stop]), start, stop,
+                          self, pivot, prev_dir) for start, stop in spans ]
+
+            try:
+                with ctx.Pool(workers) as pool:
+                    for (start, stop), res in zip(spans, pool.imap(_mark_chunk, jobs)):
+                        bottle[start:stop], next[start:stop], dist[start:stop] = res
+            finally:
+                _batch_frames = None
         else:
-            _, _, _, (x, y, w, h) = \
-                cv2.floodFill(screen, mask, (px, py),
-                            (0, 0, 0), (4, 4, 4), (4, 4, 4),
-                            cv2.FLOODFILL_MASK_ONLY)
+            for start, stop in spans:
+                bottle[start:stop], next[start:stop], dist[start:stop] = \
+                    Marker.mark_chunk(frames, start, stop, self, pivot, prev_dir)
+
+        return bottle, next, dist
+
+    # mark frames[start:stop] given the frames before them
+    # the direction of the previous jump is recovered from frames[start - 1]
+    @staticmethod
+    def mark_chunk(frames, start, stop, marker, pivot, prev_dir = 1):
+        first = max(start - 1, 0)
+
+        bottle = np.zeros((stop - first, 2), np.int64)
+
+        for i in range(first, stop):
+            bottle[i - first] = marker.find_bottle(np.asarray(frames[i]))[0]
+
+        if first < start:
+            prev_dir = 1 if pivot[0] > bottle[0, 0] else -1
+            bottle = bottle[1:]
 
-            return (int(x + w / 2), int(y + h / 2)), self.prev_dir, turn
+        pred, _, _ = Marker.predict_batch(bottle, pivot, prev_dir)
+        next = pred.copy()
 
-    def now_center(self, next_pos):
-        return 2 * Measure.PIVOT_POS[0] - next_pos[0], \
+        for i in range(start, stop):
+            next[i - start] = Marker.fill_center(np.asarray(frames[i]), pred[i - start])
+
+        dist = np.hypot(*(bottle - next).T.astype(np.float64))
+
+        return bottle, next, dist
+
+    # origin :: of the frame self.index was built on
+    def now_center(self, next_pos, origin = (0, 0)):
+        x, y = 2 * Measure.PIVOT_POS[0] - next_pos[0], \
                2 * Measure.PIVOT_POS[1] - next_pos[1]
 
-    def mark(self, screen):
-        bottle_pos, _ = self.find_bottle(screen)
-        next, dir, turn = self.next(screen, bottle_pos)
-        center = self.now_center(next)
+        if self.index is not None:
+            # the block the bottle stands on
+            region = self.index.region_at((x - origin[0], y - origin[1]))
+
+            if region is not None:
+                cx, cy = self.index.center(region)
+                return cx + origin[0], cy + origin[1]
+
+        return x, y
+
+    # origin :: position of screen in the full frame, see Device.origin
+    #           the results are always in full frame coordinates
+    def mark(self, screen, origin = (0, 0)):
+        ox, oy = origin
+
+        self.bottle_box = self.color_pos = None
+        t0 = time.perf_counter()
+
+        if self.segment and not self.coarse:
+            import segment
+
+            self.index = segment.SceneIndex(screen)
+
+        if self.coarse:
+            bottle_pos, self.score = self.find_bottle_refined(screen)
+            t1 = time.perf_counter()
+            next, dir, turn = self.next_refined(screen, bottle_pos, origin)
+        else:
+            bottle_pos, self.score = self.find_bottle(screen, narrow = origin == (0, 0))
+            t1 = time.perf_counter()
+            next, dir, turn = self.next(screen, bottle_pos, origin)
+
+        t2 = time.perf_counter()
+
+        bottle_pos = bottle_pos[0] + ox, bottle_pos[1] + oy
+        next = next[0] + ox, next[1] + oy
+
+        self.turn = turn
+        self.timings = (t1 - t0, t2 - t1)
+
+        center = self.now_center(next, origin)
  
         # delta = Util.dist(bottle_pos, center)
         dist = Util.dist(bottle_pos, next)
@@ -300,17 +1000,35 @@ class Marker:
 
         return bottle_pos, next, dist
 
-    def display(self, screen, bottle_pos, next_pos, *other):
-        cv2.line(screen, bottle_pos, next_pos, (0, 255, 0), 1)
+    # positions are in full frame coordinates, screen is at origin
+    def display(self, screen, bottle_pos, next_pos, *other, origin = (0, 0)):
+        ox, oy = origin
+        local = lambda pos: (int(pos[0] - ox), int(pos[1] - oy))
 
-        now_center = self.now_center(next_pos)
+        now_center = self.now_center(next_pos, origin)
+        target = self.index.region_at(local(next_pos)) if self.index is not None else None
 
+        bottle_pos, next_pos, now_center, pivot = \
+            map(local, (bottle_pos, next_pos, now_center, Measure.PIVOT_POS))
+
+        if self.bottle_box is not None:
+            cv2.rectangle(screen, *self.bottle_box, (0, 0, 0), 1)
+
+        if self.color_pos is not None:
+            Util.pin(screen, self.color_pos, color = (0, 255, 255))
+
+        cv2.line(screen, bottle_pos, next_pos, (0, 255, 0), 1)
         cv2.line(screen, now_center, next_pos, (255, 0, 0), 1)
 
         Util.pin(screen, bottle_pos)
         Util.pin(screen, next_pos)
         Util.pin(screen, now_center)
-        Util.pin(screen, Measure.PIVOT_POS, color = (0, 0, 255))
+        Util.pin(screen, pivot, color = (0, 0, 255))
+
+        if target is not None:
+            x, y, w, h = target.bbox
+            cv2.rectangle(screen, (x, y), (x + w, y + h), (255, 0, 255), 1)
+            Util.pin(screen, target.top, color = (255, 0, 255))
 
 class Muscle:
     VZ_DUR_RATIO = 70 # vel_z / duration
@@ -320,8 +1038,117 @@ class Muscle:
 
     MIN_DELAY = 1.6 # in sec
 
-    def __init__(self):
-        pass
+    # linear model dur = SLOPE * dist / Device.RESIZE + OFFSET, adapted online
+    # with recursive least squares from where the bottle actually landed
+    SLOPE = 1.22
+    OFFSET = 100
+    SLOPE_RANGE = (0.8, 1.8)
+    OFFSET_RANGE = (0, 250)
+    MAX_STEP = (0.03, 5) # largest change of slope, offset per landing
+    FORGET = 0.98 # older landings weigh less, the game may change
+    PRIOR = (1e-4, 2.25) # initial covariance of slope, offset
+    MAX_MISS = 0.5 # landings further off than this fraction of the jump are ignored
+    SAVE_INTERVAL = 30 # seconds between writes of the model file, see flush
+
+    # adapt :: correct the model from the landings Player reports
+    # path, key :: json file keeping the model of every device, by key
+    def __init__(self, adapt = False, path = None, key = "default"):
+        self.adapt = adapt
+        self.path = path
+        self.key = key
+
+        self.slope = Muscle.SLOPE
+        self.offset = Muscle.OFFSET
+        self.cov = [ [ Muscle.PRIOR[0], 0.0 ], [ 0.0, Muscle.PRIOR[1] ] ]
+        self.landings = 0
+        self.saved = (0, 0) # (time, landings) of the last save
+
+        if path is not None and os.path.exists(path):
+            import json
+
+            with open(path) as fp:
+                state = json.load(fp).get(key)
+
+            if state is not None:
+                self.set_state(state)
+
+    # the bottle of a jump of dist that took dur ms came to rest miss pixels
+    # past the target (negative: short of it), one RLS step -> applied or not
+    def landed(self, dist, dur, miss):
+        if not self.adapt or dist <= 0 or abs(miss) > Muscle.MAX_MISS * dist:
+            return False
+
+        # the distance dur actually covers
+        x = ((dist + miss) / Device.RESIZE, 1.0)
+        P = self.cov
+        lam = Muscle.FORGET
+
+        Px = (P[0][0] * x[0] + P[0][1] * x[1], P[1][0] * x[0] + P[1][1] * x[1])
+        denom = lam + x[0] * Px[0] + x[1] * Px[1]
+        gain = (Px[0] / denom, Px[1] / denom)
+        err = dur - (self.slope * x[0] + self.offset)
+
+        step = [ g * err for g in gain ]
+        step = [ min(max(d, -m), m) for d, m in zip(step, Muscle.MAX_STEP) ]
+
+        self.slope = min(max(self.slope + step[0], Muscle.SLOPE_RANGE[0]), Muscle.SLOPE_RANGE[1])
+        self.offset = min(max(self.offset + step[1], Muscle.OFFSET_RANGE[0]), Muscle.OFFSET_RANGE[1])
+
+        # P = (P - gain x^T P) / lam, P stays symmetric
+        self.cov = [ [ (P[i][j] - gain[i] * Px[j]) / lam for j in range(2) ] for i in range(2) ]
+        self.landings += 1
+
+        print("[I] landed %+.1f px off, duration model %.3f * d + %.1f" % (miss, self.slope, self.offset))
+
+        if self.path is not None and time.time() - self.saved[0] >= Muscle.SAVE_INTERVAL:
+            self.save()
+
+        return True
+
+    # write the landings since the last save
+    def flush(self):
+        if self.path is not None and self.landings != self.saved[1]:
+            self.save()
+
+    # write this device's model, keeping the others; the fleet workers share
+    # the file, so the read-modify-write holds a lock on it
+    def save(self):
+        import json
+
+        try:
+            import fcntl
+        except ImportError:
+            fcntl = None # no other workers to race with off posix
+
+        with open(self.path + ".lock", "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+            states = {}
+
+            if os.path.exists(self.path):
+                with open(self.path) as fp:
+                    states = json.load(fp)
+
+            states[self.key] = self.state()
+
+            tmp = "%s.%d.tmp" % (self.path, os.getpid())
+
+            with open(tmp, "w") as fp:
+                json.dump(states, fp, indent = 1)
+
+            os.replace(tmp, self.path)
+
+        self.saved = (time.time(), self.landings)
+
+    def state(self):
+        return { "slope": self.slope, "offset": self.offset, "cov": self.cov, "landings": self.landings }
+
+    def set_state(self, state):
+        self.slope = state["slope"]
+        self.offset = state["offset"]
+        self.cov = state["cov"]
+        self.landings = state.get("landings", 0)
 
     # dist is the distance in 3d in pixels
     def duration(self, cur, next, dist):
@@ -333,7 +1160,7 @@ class Muscle:
         print(dist)
         
         # dur = 1.3 * dist / Device.RESIZE + 110
-        dur = 1.22 * dist / Device.RESIZE + 100
+        dur = self.slope * dist / Device.RESIZE + self.offset
         
         return dur
 
@@ -374,60 +1201,269 @@ class Muscle:
 
         return dur
 
-dev = AndroidDevice()
-marker = Marker("bottle.png")
-muscle = Muscle()
+# frames shared with forked mark_batch workers
+_batch_frames = None
 
-screen = dev.screencap()
+def _mark_chunk(job):
+    frames, start, stop, marker, pivot, prev_dir = job
 
-if len(sys.argv) >= 2 and sys.argv[1] == "calib":
-    marker.calib(screen) # 2.820690
+    if frames is None:
+        frames = _batch_frames
+    else:
+        # only the slice [start - 1, stop) was sent
+        first = max(start - 1, 0)
+        start, stop = start - first, stop - first
+
+    return Marker.mark_chunk(frames, start, stop, marker, pivot, prev_dir)
+
+class Player:
+    MODES = ("coach", "auto", "jump")
+
+    LOST_SCORE = 0.5 # bottle match score under which the bottle counts as lost
+    CAPTURE_SHARE = 0.4 # of the budget one capture attempt may take
+
+    # governor :: optional governor.CaptureGovernor pacing the captures
+    # profiler :: optional profiler.SamplingProfiler toggled with "p"
+    # log :: optional jumplog.JumpLog getting a record per jump
+    # viewer :: optional viewer.FrameViewer streaming annotated frames
+    # metrics :: optional metrics.LoopMetrics to count and time the rounds in
+    # budget :: optional seconds a round may take from capture to decision;
+    #           a capture that times out is retried once if the budget
+    #           allows, else the round is skipped, and a decision made too
+    #           late isn't acted on. the press has its own deadline, its
+    #           duration plus AndroidDevice.PRESS_SLACK
+    def __init__(self, dev, marker, muscle, mode = "coach", headless = False,
+                 governor = None, profiler = None, log = None, viewer = None, metrics = None,
+                 budget = None):
+        self.dev = dev
+        self.marker = marker
+        self.muscle = muscle
+        self.mode = mode
+        self.headless = headless
+        self.governor = governor
+        self.profiler = profiler
+        self.log = log
+        self.viewer = viewer
+        self.metrics = metrics
+        self.budget = budget
+
+        self.last_dur = -INF
+        self.jumped = False # since the bottle was last lost
+        self.pending = None # (bottle, target, dist, duration) of a jump whose landing wasn't seen yet
+        self.decided = None # seconds from capture to decision of the last round, None without a frame
+
+    # one capture -> mark -> (press) round
+    # -> seconds to wait before the next round
+    def step(self):
+        m = self.metrics
+        self.decided = None
+
+        if not self.dev.ready():
+            if m is not None:
+                m.skipped["not_ready"].inc()
+
+            # the transport pool is reconnecting, don't block on it
+            return 0.1
+
+        captured = time.time()
+        t0 = time.perf_counter()
+        screen = self.capture(t0)
+        t_capture = time.perf_counter() - t0
+
+        if screen is None:
+            if m is not None:
+                m.skipped["deadline"].inc()
+
+            return 0.1
+
+        if m is not None:
+            m.frames.inc()
+            m.stages["capture"].observe(t_capture * 1000)
+
+            path, ms = self.dev.decoder().last
+
+            if path is not None:
+                m.stages["decode"].observe(ms)
+
+        acting = self.mode == "auto" or self.mode == "jump"
+
+        # only annotate frames somebody looks at
+        watched = self.viewer is not None and self.viewer.wants_frame()
+        self.marker.draw = not self.headless or watched
+
+        if self.governor is not None:
+            self.governor.observe(screen)
+            self.governor.set_state(acting)
+            # still flying or settling
+            ready = self.governor.ready()
+
+            if acting and not ready and m is not None:
+                m.skipped["settling"].inc()
+
+            acting = acting and ready
+
+        origin = self.dev.origin
+        res = self.marker.mark(screen, origin)
+        if self.pending is not None and (self.governor is None or self.governor.ready()):
+            self.check_landing(res)
+
+        dur = self.muscle.duration(*res) # + random.uniform(-50, 50)
+
+        if m is not None:
+            t_find, t_next = self.marker.timings
+            m.stages["find_bottle"].observe(t_find * 1000)
+            m.stages["next"].observe(t_next * 1000)
+
+            if self.marker.locator == "check":
+                m.set_locator(self.marker)
+
+            # the bottle is gone from a frame after jumping: game over
+            if self.jumped and self.marker.score < Player.LOST_SCORE:
+                m.games.inc()
+                self.jumped = False
+
+            m.set_state(self.governor.state if self.governor is not None else self.mode)
+
+        self.decided = time.perf_counter() - t0
+
+        if acting and self.budget is not None and self.decided > self.budget:
+            # the scene may have moved on since the frame was taken
+            print("[W] decided after %.0f ms, over the %.0f ms budget, not pressing" %
+                  (self.decided * 1000, self.budget * 1000))
+
+            if m is not None:
+                m.skipped["deadline"].inc()
 
-    with open("measure.py", "wb") as fp:
-        fp.write(marker.save_calib().encode())
-else:
-    import measure
-    Measure = measure.Measure
-    marker.apply_calib() # 2.820690
+            acting = False
 
-res = marker.mark(screen)
+        if acting:
+            time.sleep(random.uniform(0, 1))
 
-# cv2.imshow("screen", screen)
-# cv2.waitKey(0)
+            pressed = time.time()
+            t0 = time.perf_counter()
 
-last_dur = -INF
-mode = "coach"
+            try:
+                self.dev.press(dur)
+                self.pending = res[0], res[1], res[2], dur
+            except TimeoutError as e:
+                # the swipe may have gone through: never press again, and
+                # don't learn from a landing of unknown duration
+                print("[W] press: %s" % e)
+                self.pending = None
 
-last_jump = time.time()
+            t_press = time.perf_counter() - t0
 
-while True:
-    screen = dev.screencap()
-    res = marker.mark(screen)
-    dur = muscle.duration(*res) # + random.uniform(-50, 50)
+            jumped = self.jumped = True
 
-    marker.display(screen, *res)
+            if m is not None:
+                m.jumps.inc()
+                m.stages["press"].observe(t_press * 1000)
 
-    if mode == "auto" or mode == "jump":
-        time.sleep(random.uniform(0, 1))
-        dev.press(dur)
-        jumped = True
+            if self.log is not None:
+                import jumplog
 
-        if mode == "jump":
-            mode = "coach"
-    else:
-        last_dur = dur
-        jumped = False
-
-    cv2.imshow("screen", screen)
-
-    key = cv2.waitKey(int(Muscle.MIN_DELAY * 1000) if jumped else 1) & 0xff
-
-    if key == ord("c"):
-        mode = "auto"
-        print("op#auto mode")
-    elif key == ord("s"):
-        mode = "coach"
-        print("op#coach mode")
-    elif key == ord("j"):
-        mode = "jump"
-        print("op#jump")
+                t_find, t_next = self.marker.timings
+                self.log.append(time = captured, press_time = pressed,
+                                bottle = res[0], target = res[1], dist = res[2],
+                                duration = dur, dir = self.marker.prev_dir, turn = self.marker.turn,
+                                t_capture = t_capture * 1000, t_find_bottle = t_find * 1000,
+                                t_next = t_next * 1000, t_press = t_press * 1000,
+                                fingerprint = jumplog.fingerprint(screen))
+
+            if self.governor is not None:
+                self.governor.pressed(dur)
+
+            if self.mode == "jump":
+                self.mode = "coach"
+        else:
+            self.last_dur = dur
+            jumped = False
+
+        if self.marker.draw:
+            self.marker.display(screen, *res, origin = origin)
+
+        if not self.headless:
+            cv2.imshow("screen", screen)
+
+        if watched:
+            self.viewer.submit(screen)
+
+        if self.governor is not None:
+            delay = self.governor.delay()
+
+            if m is not None:
+                m.set_governor(self.governor.metrics())
+
+            return delay
+
+        return Muscle.MIN_DELAY if jumped else 0.001
+
+    # screencap within the budget, retried once when the first attempt timed
+    # out early enough -> frame or None
+    def capture(self, start):
+        for attempt in range(2):
+            if self.budget is not None:
+                left = self.budget - (time.perf_counter() - start)
+
+                if attempt and left < self.budget * Player.CAPTURE_SHARE:
+                    break
+
+                self.dev.timeout = min(left, self.budget * Player.CAPTURE_SHARE)
+
+            try:
+                return self.dev.screencap()
+            except TimeoutError as e:
+                print("[W] capture: %s" % e)
+
+        return None
+
+    # res :: mark of the first settled frame after a jump
+    def check_landing(self, res):
+        (bx, by), (tx, ty), dist, dur = self.pending
+        self.pending = None
+
+        if self.marker.score < Player.LOST_SCORE:
+            return # game over
+
+        # the camera has moved since, but the bottle stands on the block
+        # now_center points at, whatever the view
+        cx, cy = self.marker.now_center(res[1], self.dev.origin)
+        ex, ey = res[0][0] - cx, res[0][1] - cy
+
+        # along the jump: past the target, across it: not a comparable jump
+        ux, uy = (tx - bx) / max(dist, 1e-9), (ty - by) / max(dist, 1e-9)
+        along = ex * ux + ey * uy
+        across = -ex * uy + ey * ux
+
+        if abs(across) <= Muscle.MAX_MISS * dist:
+            self.muscle.landed(dist, dur, along)
+
+    def key(self, key):
+        if key == ord("c"):
+            self.mode = "auto"
+            print("op#auto mode")
+        elif key == ord("s"):
+            self.mode = "coach"
+            print("op#coach mode")
+        elif key == ord("j"):
+            self.mode = "jump"
+            print("op#jump")
+        elif key == ord("p") and self.profiler is not None:
+            self.profiler.toggle()
+
+    def run(self):
+        try:
+            while True:
+                delay = self.step()
+
+                if self.headless:
+                    time.sleep(delay)
+                else:
+                    # waitKey(0) would block until a key is pressed
+                    self.key(cv2.waitKey(max(1, int(delay * 1000))) & 0xff)
+        finally:
+            self.muscle.flush()
+
+if __name__ == "__main__":
+    import rush
+    rush.main(sys.argv[1:] or [ "run" ])
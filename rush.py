@@ -0,0 +1,592 @@
+#! /usr/bin/python3
+
+# command line entry point
+#
+#     rush.py devices
+#     rush.py calib
+#     rush.py run [--mode auto] [--headless]
+#     rush.py fleet [--serials A B] -- [--mode auto]
+#     rush.py coordinator [--port 7300]
+#     rush.py agent --coordinator host:7300 -- [--mode auto]
+#     rush.py record frames.npy -n 500
+#     rush.py replay frames.npy [-j 4]
+#     rush.py detect [-j 4] [--seconds 60]
+#     rush.py bench [frames.npy]
+#     rush.py collect http://host:9200/metrics ...
+#     rush.py bank [bank.npz] [--sprites 'source/res/*.png']
+#
+# keep the imports here light: cv2, numpy and the device backends are only
+# imported by the subcommand that needs them
+
+import argparse
+import os
+import time
+
+def open_device(args):
+    import refrac
+
+    if args.ios:
+        return refrac.iOSDevice(args.wda, mjpeg = args.mjpeg)
+
+    band = None
+
+    if args.band:
+        # the band is cut out of screencap on the device, the other
+        # transports capture whole frames
+        if args.capture != "pull":
+            raise SystemExit("--band only works with --capture pull")
+
+        band = tuple(float(v) for v in args.band.split(":"))
+
+    capture = None
+
+    if args.capture == "auto":
+        import capture as cap
+        capture = cap.LinkAwareCapture
+    elif args.capture == "stream":
+        import capture as cap
+        capture = cap.StreamCapture
+
+    pool = None
+
+    if args.serial:
+        import adbpool
+
+        # pings the device in the background and reconnects it, the loop
+        # skips rounds meanwhile instead of blocking on adb
+        pool = adbpool.TransportPool(args.adb, scan = False).start()
+        pool.add(args.serial)
+
+    return refrac.AndroidDevice(serial = args.serial, adb_path = args.adb, pool = pool, band = band, capture = capture)
+
+# size :: (width, height) of the frames to mark, picks the template from
+#         --bank and estimates the calibration when there is no calibration file
+def open_marker(args, calib = True, size = None):
+    import refrac
+
+    marker = refrac.Marker(args.bottle, locator = args.locator, coarse = args.coarse, segment = args.segment)
+
+    if args.bank and size is not None:
+        import tbank
+
+        marker.apply_bank(tbank.TemplateBank.load(args.bank), size[0])
+
+        if calib and os.path.exists(args.measure):
+            scale = refrac.Measure.SCALE
+            refrac.Measure.load(args.measure)
+            refrac.Measure.SCALE = scale
+        elif calib:
+            print("[W] no %s, estimating the calibration" % args.measure)
+            refrac.Measure.estimate(size[0], size[1], marker.bottle)
+    elif calib:
+        refrac.Measure.load(args.measure)
+        marker.apply_calib()
+
+    return marker
+
+def cmd_devices(args):
+    import adb as pyadb3
+
+    client = pyadb3.ADB(args.adb, connect = False)
+    client.init_devices()
+
+    for dev in client.devices:
+        print(" ".join(dev))
+
+def cmd_calib(args):
+    dev = open_device(args)
+    marker = open_marker(args, calib = False)
+
+    marker.calib(dev.screencap())
+
+    with open(args.measure, "wb") as fp:
+        fp.write(marker.save_calib().encode())
+
+def open_player(args):
+    import refrac
+
+    dev = open_device(args)
+    marker = open_marker(args, size = dev.size)
+
+    governor = None
+
+    if args.governor:
+        import governor as gov
+        governor = gov.CaptureGovernor(args.min_fps, args.max_fps)
+
+    profiler = None
+
+    if args.profile_rate > 0:
+        import profiler as prof
+
+        profiler = prof.SamplingProfiler(args.profile_rate, args.profile_window)
+
+        # headless runs can only toggle it with SIGUSR1
+        if args.headless and not profiler.install_signal():
+            profiler = None
+
+    log = None
+
+    if args.log:
+        import jumplog
+        log = jumplog.JumpLog(args.log)
+
+    viewer = None
+
+    if args.view_port:
+        import viewer as view
+        viewer = view.FrameViewer(args.view_port, args.view_fps, host = args.viewer_host).start()
+        print("viewer at %s" % viewer.url)
+
+    metrics = None
+
+    if args.metrics_port:
+        import metrics as met
+        metrics = met.LoopMetrics()
+        met.watch_adb()
+        print("metrics at %s" % met.MetricsServer(args.metrics_port, host = args.metrics_host).start().url)
+
+    muscle = refrac.Muscle(args.adapt, args.muscle, args.wda if args.ios else args.serial or "default")
+
+    player = refrac.Player(dev, marker, muscle,
+                           mode = args.mode, headless = args.headless,
+                           governor = governor, profiler = profiler, log = log,
+                           viewer = viewer, metrics = metrics, budget = args.budget)
+
+    return player
+
+def cmd_run(args):
+    open_player(args).run()
+
+def cmd_fleet(args):
+    import fleet
+
+    # the global options given before "fleet" are passed on to every worker
+    argv = args.global_argv
+    run_argv = args.run_args[1:] if args.run_args[:1] == [ "--" ] else args.run_args
+
+    f = fleet.Fleet(argv, run_argv, args.serials or None, args.adb, args.adb_cores)
+    fleet.Fleet.REPORT_INTERVAL = args.report
+    f.run()
+
+def cmd_coordinator(args):
+    import cluster
+
+    coordinator = cluster.Coordinator(args.dir, args.secret).serve(args.port, args.host)
+
+    if args.metrics_port:
+        import metrics as met
+        server = met.MetricsServer(args.metrics_port, render = coordinator.render, host = args.metrics_host).start()
+        print("cluster metrics at %s" % server.url)
+
+    while True:
+        time.sleep(args.report)
+
+        for name, host in sorted(coordinator.rpc_status().items()):
+            print("%-20s devices %-3d playing %s" % (name, len(host["devices"]), " ".join(host["assigned"]) or "-"))
+
+def cmd_agent(args):
+    import cluster
+
+    argv = args.global_argv
+    run_argv = args.run_args[1:] if args.run_args[:1] == [ "--" ] else args.run_args
+
+    agent = cluster.Agent(cluster.parse_addr(args.coordinator), argv, run_argv, args.name, args.dir,
+                          args.adb, args.adb_cores, args.secret)
+    agent.run()
+
+def cmd_record(args):
+    import numpy as np
+
+    dev = open_device(args)
+    frame = dev.screencap()
+
+    frames = np.lib.format.open_memmap(args.output, mode = "w+",
+                                       dtype = frame.dtype,
+                                       shape = (args.n,) + frame.shape)
+
+    for i in range(args.n):
+        dev.screencap(dst = frames[i])
+
+        if args.interval:
+            time.sleep(args.interval)
+
+    frames.flush()
+    print("recorded %d frames to %s" % (args.n, args.output))
+
+# entry point of a detect worker: marks every jobs-th frame of the ring,
+# in place in shared memory
+# counts :: shared [ marked, overwritten ] of this worker
+def detector(args, name, size, index, jobs, counts):
+    import framering
+
+    ring = framering.FrameRing.attach(name)
+    marker = open_marker(args, size = size)
+
+    n = index # next frame of this worker
+
+    try:
+        while True:
+            head = ring.head()
+
+            if n >= head:
+                time.sleep(0.002)
+                continue
+
+            if n < head - ring.slots:
+                # fell behind, skip to the oldest of its frames still there
+                n += (head - ring.slots - n + jobs - 1) // jobs * jobs
+                continue
+
+            res = ring.read(n)
+            n += jobs
+
+            if res is None:
+                continue # being written again
+
+            marker.mark(res[1])
+
+            # a result from a slot the capture overwrote meanwhile is torn
+            counts[0 if ring.valid(res[0]) else 1] += 1
+    finally:
+        ring.close()
+
+# capture into a shared frame ring and mark the frames in worker processes
+def cmd_detect(args):
+    import multiprocessing
+    import framering
+
+    dev = open_device(args)
+    frame = dev.screencap()
+    ring = framering.FrameRing.create(frame.shape, frame.dtype, args.slots)
+
+    counts = [ multiprocessing.Array("l", 2, lock = False) for _ in range(args.jobs) ]
+    workers = [ multiprocessing.Process(target = detector, args = (args, ring.name, dev.size, i, args.jobs, counts[i]),
+                                        name = "detect-%d" % i, daemon = True)
+                for i in range(args.jobs) ]
+
+    for w in workers:
+        w.start()
+
+    start = time.time()
+
+    try:
+        while time.time() - start < args.seconds:
+            dev.screencap(dst = ring.claim())
+            ring.commit()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        elapsed = time.time() - start
+
+        for w in workers:
+            w.terminate()
+            w.join()
+
+        marked = sum(c[0] for c in counts)
+        torn = sum(c[1] for c in counts)
+
+        print("captured %d frames in %.1fs (%.1f fps), marked %d, %d overwritten while marked" %
+              (ring.head(), elapsed, ring.head() / max(elapsed, 1e-9), marked, torn))
+
+        ring.close()
+
+def cmd_replay(args):
+    import numpy as np
+
+    if args.coarse or args.segment:
+        # mark_batch has no batch version of these
+        raise SystemExit("replay supports neither --coarse nor --segment")
+
+    frames = np.load(args.input, mmap_mode = "r")
+    marker = open_marker(args, size = frames.shape[2:0:-1])
+
+    start = time.time()
+    bottle, next, dist = marker.mark_batch(frames, workers = args.jobs)
+    elapsed = time.time() - start
+
+    print("%d frames in %.3fs (%.1f fps)" % (len(frames), elapsed, len(frames) / max(elapsed, 1e-9)))
+
+    if args.output:
+        np.savez(args.output, bottle = bottle, next = next, dist = dist)
+    else:
+        for b, n, d in zip(bottle.tolist(), next.tolist(), dist.tolist()):
+            print(tuple(b), tuple(n), d)
+
+# time matchTemplate against the fft correlator, for one template per frame
+# and for the calibration sweep
+def compare_matchers(marker, frames, bottle):
+    import numpy as np
+    import refrac
+
+    rounds = { "template": [], "fft": [] }
+    worst = 0
+
+    for frame in frames:
+        for name, find in (("template", marker.find_bottle_template), ("fft", marker.find_bottle_fft)):
+            t0 = time.perf_counter()
+            pos, val = find(frame)
+            rounds[name].append((time.perf_counter() - t0) * 1000)
+
+        worst = max(worst, refrac.Util.dist(pos, marker.find_bottle_template(frame)[0]))
+
+    for name, times in rounds.items():
+        print("%-12s mean %8.3f ms  p99 %8.3f ms" % ("match " + name, np.mean(times), np.percentile(times, 99)))
+
+    print("largest position difference %.1f px" % worst)
+
+    calib = refrac.Marker(bottle)
+    sweeps = {}
+
+    for locator in ("template", "fft"):
+        calib.locator = locator
+        t0 = time.perf_counter()
+
+        if locator == "fft":
+            scale = calib.calib_scale_fft(frames[0])
+        else:
+            h, w = frames[0].shape[:2]
+            th, tw = calib.bottle.shape
+
+            # as calib, scaling the frame, where the template still fits
+            scales = [ s for s in np.linspace(*refrac.Marker.CALIB_SCALES).tolist()
+                       if int(h * s) >= th and int(w * s) >= tw ]
+            scale = max(scales, key = lambda s: calib.find_bottle_template(refrac.Util.resize(frames[0], s))[1])
+
+        sweeps[locator] = (time.perf_counter() - t0) * 1000, scale
+
+    for locator, (ms, scale) in sweeps.items():
+        print("%-12s %8.1f ms  scale %.3f" % ("sweep " + locator, ms, scale))
+
+def cmd_bench(args):
+    import numpy as np
+    import refrac
+
+    if args.input:
+        frames = np.load(args.input, mmap_mode = "r")
+        capture = lambda i: np.array(frames[i % len(frames)])
+        size = frames.shape[2:0:-1]
+    else:
+        dev = open_device(args)
+        capture = lambda i: dev.screencap()
+        size = dev.size
+
+    marker = open_marker(args, size = size)
+
+    stages = { "capture": [], "find_bottle": [], "next": [] }
+
+    for i in range(args.n):
+        t0 = time.perf_counter()
+        screen = capture(i)
+        t1 = time.perf_counter()
+        bottle_pos, _ = marker.find_bottle(screen)
+        t2 = time.perf_counter()
+        marker.next(screen, bottle_pos)
+        t3 = time.perf_counter()
+
+        stages["capture"].append(t1 - t0)
+        stages["find_bottle"].append(t2 - t1)
+        stages["next"].append(t3 - t2)
+
+    for name, times in stages.items():
+        times = np.array(times) * 1000
+        print("%-12s mean %8.3f ms  p50 %8.3f ms  p99 %8.3f ms" %
+              (name, times.mean(), np.percentile(times, 50), np.percentile(times, 99)))
+
+    if args.compare:
+        compare_matchers(marker, [ capture(i) for i in range(min(args.n, 20)) ], args.bottle)
+
+    if not args.input:
+        for fmt, (path, times) in dev.decoder().report().items():
+            print("decode %s with %s: %s" % (fmt, path or "(undecided)",
+                  ", ".join("%s %.3f ms" % kv for kv in times.items())))
+
+def cmd_collect(args):
+    import metrics as met
+
+    collector = met.Collector(args.targets)
+
+    if args.port:
+        server = met.MetricsServer(args.port, render = collector.render, host = args.host).start()
+        print("merged metrics at %s" % server.url)
+
+    while True:
+        collector.scrape()
+        up = sum(samples is not None for _, samples in collector.results.values())
+
+        print("%s  workers %d/%d  jumps %d  games %d  frames %d  adb failures %d" %
+              (time.strftime("%H:%M:%S"), up, len(args.targets),
+               collector.total("rush_jumps_total"), collector.total("rush_games_total"),
+               collector.total("rush_frames_total"), collector.total("rush_adb_failures_total")))
+
+        time.sleep(args.interval)
+
+def cmd_bank(args):
+    import tbank
+
+    TB = tbank.TemplateBank
+    bank = TB.build(args.bottle, args.sprites, args.ref_width or TB.REF_WIDTH,
+                    args.min_scale or TB.MIN_SCALE, args.max_scale or TB.MAX_SCALE, args.steps or TB.STEPS)
+    bank.save(args.output)
+
+    print("%d templates x %d scales (%.3f - %.3f) to %s" %
+          (len(bank.names), len(bank.scales), bank.scales[0], bank.scales[-1], args.output))
+
+# subcommand action that keeps the global options given before the
+# subcommand as args.global_argv, for the commands that pass them on
+class Subcommands(argparse._SubParsersAction):
+    def __call__(self, parser, namespace, values, option_string = None):
+        # values are the subcommand and everything after it
+        namespace.rest = len(values)
+        super(Subcommands, self).__call__(parser, namespace, values, option_string)
+
+def parser():
+    ap = argparse.ArgumentParser(prog = "rush", description = "automated player for 跳一跳")
+
+    ap.add_argument("--serial", help = "adb serial of the device to use")
+    ap.add_argument("--ios", action = "store_true", help = "use an iOS device through WebDriverAgent")
+    ap.add_argument("--wda", default = "http://localhost:8100", help = "WebDriverAgent url")
+    ap.add_argument("--mjpeg", help = "WebDriverAgent MJPEG stream url, e.g. http://localhost:9100")
+    ap.add_argument("--adb", default = "adb", help = "path to the adb binary")
+    ap.add_argument("--adb-timeout", type = float, help = "seconds before a stuck adb command is killed "
+                                                          "and the transport reset (no limit by default)")
+    ap.add_argument("--capture", choices = ("pull", "auto", "stream"), default = "pull",
+                    help = "pull: screencap + adb pull, auto: pick raw/gzip/png by measured link speed, "
+                           "stream: continuous frames from a helper on the device over adb forward")
+    ap.add_argument("--band", help = "only capture rows TOP:BOTTOM (fractions of the height) of the screen, e.g. 0.3:0.75")
+    ap.add_argument("--bottle", default = "bottle.png", help = "bottle template")
+    ap.add_argument("--locator", choices = ("template", "color", "check", "fft"), default = "template",
+                    help = "bottle locator, check uses the template and cross-checks the color locator, "
+                           "fft matches the template in the frequency domain")
+    ap.add_argument("--measure", default = "measure.py", help = "calibration file")
+    ap.add_argument("--resize", type = float, help = "scale of the frames to the screen (0.3 by default), "
+                                                      "calibrations made at another scale are converted")
+    ap.add_argument("--coarse", type = float, help = "find bottle and target on a thumbnail of this scale "
+                                                      "of the frame and refine them in crops, e.g. 0.25 with --resize 1")
+    ap.add_argument("--segment", action = "store_true",
+                    help = "label the blocks of each frame once and look the target up instead of flood filling")
+    ap.add_argument("--bank", help = "template bank from the bank command, picks the template by frame width")
+
+    ap.register("action", "parsers", Subcommands)
+    sub = ap.add_subparsers(dest = "command", metavar = "command")
+    sub.required = True
+
+    p = sub.add_parser("devices", help = "list connected adb devices")
+    p.set_defaults(func = cmd_devices)
+
+    p = sub.add_parser("calib", help = "calibrate on the initial screen and write the calibration file")
+    p.set_defaults(func = cmd_calib)
+
+    p = sub.add_parser("run", help = "play the game")
+    p.add_argument("--mode", choices = ("coach", "auto"), default = "coach")
+    p.add_argument("--headless", action = "store_true", help = "no window, keys are not available")
+    p.add_argument("--governor", action = "store_true", help = "pace captures by loop state and scene activity")
+    p.add_argument("--min-fps", type = float, default = 1.0, help = "slowest governed capture rate")
+    p.add_argument("--max-fps", type = float, default = 15.0, help = "fastest governed capture rate")
+    p.add_argument("--profile-rate", type = int, default = 100,
+                   help = "profiler samples per second (toggle with p, or SIGUSR1 when headless), 0 disables it")
+    p.add_argument("--view-port", type = int, help = "serve annotated frames as MJPEG on this port")
+    p.add_argument("--view-fps", type = float, default = 5, help = "frame rate cap of the viewer")
+    p.add_argument("--viewer-host", default = "127.0.0.1", help = "address of the viewer, 0.0.0.0 to watch from other hosts")
+    p.add_argument("--log", help = "append a record per jump to this jump log")
+    p.add_argument("--profile-window", type = float, default = 30, help = "seconds before the profiler stops itself")
+    p.add_argument("--adapt", action = "store_true", help = "correct the press duration model from the observed landings")
+    p.add_argument("--muscle", help = "json file keeping the duration model of each device across runs")
+    p.add_argument("--metrics-port", type = int, help = "serve counters and latency histograms at /metrics on this port")
+    p.add_argument("--metrics-host", default = "127.0.0.1", help = "address of the metrics endpoint")
+    p.add_argument("--budget", type = float, help = "seconds a round may take to capture and decide, "
+                                                    "late captures are retried or skipped, late presses dropped")
+    p.set_defaults(func = cmd_run)
+
+    p = sub.add_parser("fleet", help = "run every device in its own worker process, pinned to its own cores")
+    p.add_argument("--serials", nargs = "+", help = "devices to run (all connected ones by default)")
+    p.add_argument("--adb-cores", type = int, default = 1, help = "cores kept for adb")
+    p.add_argument("--report", type = float, default = 30, help = "seconds between worker reports")
+    p.add_argument("run_args", nargs = argparse.REMAINDER, help = "-- followed by options of the run command")
+    p.set_defaults(func = cmd_fleet)
+
+    p = sub.add_parser("coordinator", help = "assign the devices of many hosts and collect their calibrations and jumps")
+    p.add_argument("--port", type = int, default = 7300)
+    p.add_argument("--host", default = "127.0.0.1", help = "address to listen on, e.g. 0.0.0.0 with --secret")
+    p.add_argument("--secret", default = os.environ.get("RUSH_CLUSTER_SECRET"),
+                   help = "shared secret of the agents ($RUSH_CLUSTER_SECRET by default)")
+    p.add_argument("--dir", default = "cluster", help = "directory of the calibrations and collected jump logs")
+    p.add_argument("--report", type = float, default = 30, help = "seconds between host reports")
+    p.add_argument("--metrics-port", type = int, help = "serve the cluster metrics at /metrics on this port")
+    p.add_argument("--metrics-host", default = "127.0.0.1", help = "address of the metrics endpoint")
+    p.set_defaults(func = cmd_coordinator)
+
+    p = sub.add_parser("agent", help = "play the devices a coordinator assigns to this host")
+    p.add_argument("--coordinator", default = "127.0.0.1:7300", help = "host:port of the coordinator")
+    p.add_argument("--name", help = "name of this host (its hostname by default)")
+    p.add_argument("--dir", default = "agent", help = "directory of the calibrations and jump logs of this host")
+    p.add_argument("--secret", default = os.environ.get("RUSH_CLUSTER_SECRET"),
+                   help = "shared secret of the coordinator ($RUSH_CLUSTER_SECRET by default)")
+    p.add_argument("--adb-cores", type = int, default = 1, help = "cores kept for adb")
+    p.add_argument("run_args", nargs = argparse.REMAINDER, help = "-- followed by options of the run command")
+    p.set_defaults(func = cmd_agent)
+
+    p = sub.add_parser("record", help = "record frames to a .npy file")
+    p.add_argument("output")
+    p.add_argument("-n", type = int, default = 100, help = "number of frames")
+    p.add_argument("--interval", type = float, default = 0, help = "seconds between frames")
+    p.set_defaults(func = cmd_record)
+
+    p = sub.add_parser("replay", help = "mark recorded frames offline")
+    p.add_argument("input")
+    p.add_argument("-j", "--jobs", type = int, default = 0, help = "worker processes")
+    p.add_argument("-o", "--output", help = "save results to a .npz file")
+    p.set_defaults(func = cmd_replay)
+
+    p = sub.add_parser("detect", help = "capture into shared memory and mark the frames in worker processes")
+    p.add_argument("-j", "--jobs", type = int, default = 2, help = "detector processes")
+    p.add_argument("--slots", type = int, default = 8, help = "frames the ring holds")
+    p.add_argument("--seconds", type = float, default = 60, help = "how long to capture")
+    p.set_defaults(func = cmd_detect)
+
+    p = sub.add_parser("bench", help = "time the pipeline stages")
+    p.add_argument("input", nargs = "?", help = "recorded frames instead of a live device")
+    p.add_argument("-n", type = int, default = 50, help = "number of rounds")
+    p.add_argument("--compare", action = "store_true", help = "also time matchTemplate against the fft correlator")
+    p.set_defaults(func = cmd_bench)
+
+    p = sub.add_parser("collect", help = "scrape the metrics of many workers")
+    p.add_argument("targets", nargs = "+", help = "worker metrics urls, e.g. http://10.0.0.5:9200/metrics")
+    p.add_argument("--port", type = int, help = "serve the merged metrics on this port")
+    p.add_argument("--host", default = "127.0.0.1", help = "address of the merged endpoint")
+    p.add_argument("--interval", type = float, default = 10, help = "seconds between scrapes")
+    p.set_defaults(func = cmd_collect)
+
+    p = sub.add_parser("bank", help = "pre-render the bottle template at many scales")
+    p.add_argument("output", nargs = "?", default = "bank.npz")
+    p.add_argument("--sprites", help = "glob of extra images to include, e.g. 'source/res/*.png'")
+    p.add_argument("--ref-width", type = float, help = "frame width at which the bottle template matches unscaled")
+    p.add_argument("--min-scale", type = float, help = "smallest template scale")
+    p.add_argument("--max-scale", type = float, help = "largest template scale")
+    p.add_argument("--steps", type = int, help = "number of scales")
+    p.set_defaults(func = cmd_bank)
+
+    return ap
+
+def main(argv = None):
+    import sys
+
+    argv = list(sys.argv[1:] if argv is None else argv)
+    args = parser().parse_args(argv)
+    args.global_argv = argv[:len(argv) - args.rest]
+
+    setup(args)
+    args.func(args)
+
+# process wide settings from the global options
+def setup(args):
+    if args.resize:
+        import refrac
+        refrac.Device.RESIZE = args.resize
+
+    if args.adb_timeout:
+        import adb as pyadb3
+        pyadb3.ADB.TIMEOUT = args.adb_timeout
+
+if __name__ == "__main__":
+    main()
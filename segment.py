@@ -0,0 +1,117 @@
+#! /usr/bin/python3
+
+# per-frame segmentation of the scene into flat regions
+#
+# a pixel belongs to the region of its right and lower neighbours when it
+# differs from them by at most TOLERANCE in every channel, the criterion
+# Marker.next's floodFill uses. pixels on an edge are left unlabelled, so
+# connected components split the frame into the background (its vertical
+# gradient is smooth, so it stays one region) and the faces of the blocks,
+# the bottle and the score. one pass labels everything:
+#
+#     index = SceneIndex(screen)
+#     region = index.region_at((x, y))  # top face under a point or None
+#     region = index.nearest((x, y))    # closest block region
+#
+# region_at is a lookup in the label image, nearest only looks at the
+# regions of the grid cells around the point
+
+import collections
+
+import cv2
+import numpy as np
+
+Region = collections.namedtuple("Region", [
+    "label",
+    "bbox", # (x, y, w, h)
+    "area",
+    "centroid", # (x, y)
+    "top", # topmost pixel (x, y), the back vertex of a block face
+])
+
+# per pixel maximum over the channels, much faster than ndarray.max(axis = 2)
+def channel_max(img):
+    return cv2.max(cv2.max(img[..., 0], img[..., 1]), img[..., 2])
+
+class SceneIndex:
+    TOLERANCE = 4 # per channel, as the floodFill in Marker.next
+    MIN_AREA = 30 # pixels, smaller regions are noise or text
+    CELL = 16 # grid cell size in pixels
+
+    def __init__(self, screen):
+        h, w = screen.shape[:2]
+        self.size = (w, h)
+
+        # largest difference to the right or the lower neighbour
+        diff = np.zeros((h, w), np.uint8)
+        diff[:, :-1] = channel_max(cv2.absdiff(screen[:, 1:], screen[:, :-1]))
+        np.maximum(diff[:-1], channel_max(cv2.absdiff(screen[1:], screen[:-1])), out = diff[:-1])
+
+        flat = (diff <= SceneIndex.TOLERANCE).view(np.uint8)
+        n, self.labels, self.stats, self.centroids = \
+            cv2.connectedComponentsWithStats(flat, connectivity = 4)
+
+        # label 0 are the edges, the largest region is the background
+        areas = self.stats[:, cv2.CC_STAT_AREA]
+        self.background = int(np.argmax(areas[1:]) + 1) if n > 1 else 0
+
+        self.regions = {}
+        self.grid = collections.defaultdict(list) # (cx, cy) -> [ label ]
+
+        for i in np.flatnonzero(areas >= SceneIndex.MIN_AREA).tolist():
+            if i == 0 or i == self.background:
+                continue
+
+            x, y, bw, bh = self.stats[i, :4].tolist()
+            top = np.flatnonzero(self.labels[y, x:x + bw] == i)
+
+            self.regions[i] = Region(i, (x, y, bw, bh), int(areas[i]),
+                                     tuple(self.centroids[i].tolist()),
+                                     (int(x + top.mean()), y))
+
+            for cy in range(y // SceneIndex.CELL, (y + bh - 1) // SceneIndex.CELL + 1):
+                for cx in range(x // SceneIndex.CELL, (x + bw - 1) // SceneIndex.CELL + 1):
+                    self.grid[cx, cy].append(i)
+
+    def label_at(self, pos):
+        x, y = pos
+        w, h = self.size
+
+        if not (0 <= x < w and 0 <= y < h):
+            return 0
+
+        return int(self.labels[int(y), int(x)])
+
+    def is_background(self, pos):
+        return self.label_at(pos) == self.background
+
+    # region under pos, None on the background, an edge or a tiny region
+    def region_at(self, pos):
+        return self.regions.get(self.label_at(pos))
+
+    # region whose bounding box is closest to pos, within radius pixels
+    def nearest(self, pos, radius = 2 * CELL):
+        x, y = pos
+        r = -(-radius // SceneIndex.CELL)
+        cx, cy = int(x) // SceneIndex.CELL, int(y) // SceneIndex.CELL
+
+        best, best_dist = None, radius
+
+        for gy in range(cy - r, cy + r + 1):
+            for gx in range(cx - r, cx + r + 1):
+                for i in self.grid.get((gx, gy), ()):
+                    bx, by, bw, bh = self.regions[i].bbox
+                    dx = max(bx - x, 0, x - (bx + bw - 1))
+                    dy = max(by - y, 0, y - (by + bh - 1))
+                    dist = (dx * dx + dy * dy) ** 0.5
+
+                    if dist <= best_dist:
+                        best, best_dist = self.regions[i], dist
+
+        return best
+
+    # center of the bounding box, as Marker.next reports the target
+    @staticmethod
+    def center(region):
+        x, y, w, h = region.bbox
+        return int(x + w / 2), int(y + h / 2)
@@ -0,0 +1,145 @@
+#! /usr/bin/python3
+
+# precomputed template bank
+#
+# the bottle template (and optionally other sprites) pre-rendered at a dense
+# geometric series of scales, all stored in one .npz:
+#
+#     bank = TemplateBank.build("bottle.png")
+#     bank.save("bank.npz")
+#
+#     bank = TemplateBank.load("bank.npz")
+#     template = bank.pick_for_width(frame_width)
+#
+# a loaded bank only reads the entries that are picked from, a bank with
+# all the sprites is hundreds of MB and a device only needs the bottle.
+#
+# because the scales are geometric, picking the nearest one is a log and a
+# rounding, no search. the game scales with the screen width, so the
+# template scale of a new device follows from its frame width alone and no
+# calibration sweep is needed
+
+import glob
+import math
+import os
+
+import cv2
+import numpy as np
+
+class TemplateBank:
+    MIN_SCALE = 0.08
+    MAX_SCALE = 2.0
+    STEPS = 160 # about 2% between neighbouring scales
+
+    # frame width at which the bottle template matches unscaled:
+    # calibrated SCALE 2.82 on 1080 px wide screens at Device.RESIZE 0.3
+    REF_WIDTH = 1080 * 0.3 * 2.820690
+
+    # data :: the open .npz of a loaded bank, entries missing from entries
+    #         are read from it on their first use
+    def __init__(self, scales, entries, ref_width = REF_WIDTH, names = None, data = None):
+        self.scales = scales
+        self.entries = entries # name -> templates
+        self.names = list(entries) if names is None else names
+        self.ref_width = ref_width
+        self.data = data
+
+        self.log_min = math.log(scales[0])
+        self.log_step = math.log(scales[1] / scales[0]) if len(scales) > 1 else 1
+
+    @staticmethod
+    def render(img, scales):
+        h, w = img.shape[:2]
+        templates = []
+
+        for scale in scales:
+            size = (max(int(w * scale), 1), max(int(h * scale), 1))
+            interp = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+
+            templates.append(cv2.resize(img, size, interpolation = interp))
+
+        return templates
+
+    # sprites :: optional glob of extra images, e.g. "source/res/*.png",
+    #            stored under their file name without extension
+    @staticmethod
+    def build(bottle = "bottle.png", sprites = None, ref_width = REF_WIDTH,
+              min_scale = MIN_SCALE, max_scale = MAX_SCALE, steps = STEPS):
+        scales = np.geomspace(min_scale, max_scale, steps)
+        paths = { "bottle": bottle }
+
+        if sprites:
+            for path in sorted(glob.glob(sprites)):
+                paths.setdefault(os.path.splitext(os.path.basename(path))[0], path)
+
+        entries = {}
+
+        for name, path in paths.items():
+            img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+
+            if img is None:
+                print("[W] skipping %s, not an image" % path)
+                continue
+
+            entries[name] = TemplateBank.render(img, scales)
+
+        return TemplateBank(scales, entries, ref_width)
+
+    def save(self, path):
+        arrays = { "scales": self.scales, "ref_width": np.array(self.ref_width),
+                   "names": np.array(self.names) }
+
+        for name in self.names:
+            templates = self.entry(name)
+            shapes = np.array([ t.shape for t in templates ])
+            sizes = shapes[:, 0] * shapes[:, 1]
+
+            arrays[name + ".pixels"] = np.concatenate([ t.ravel() for t in templates ])
+            arrays[name + ".offsets"] = np.concatenate(([ 0 ], np.cumsum(sizes)[:-1]))
+            arrays[name + ".shapes"] = shapes
+
+        np.savez(path, **arrays)
+
+    # only the names are read here, see entry
+    @staticmethod
+    def load(path):
+        data = np.load(path)
+
+        return TemplateBank(data["scales"], {}, float(data["ref_width"]), data["names"].tolist(), data)
+
+    # -> templates of name, read from the file the first time
+    def entry(self, name):
+        res = self.entries.get(name)
+
+        if res is not None:
+            return res
+
+        if self.data is None or name not in self.names:
+            raise KeyError(name)
+
+        data = self.data
+        pixels = data[name + ".pixels"]
+
+        # views into one buffer, nothing is copied
+        templates = [ pixels[o:o + h * w].reshape(h, w)
+                      for o, (h, w) in zip(data[name + ".offsets"].tolist(), data[name + ".shapes"].tolist()) ]
+
+        self.entries[name] = templates
+
+        return templates
+
+    # index of the stored scale nearest to scale (in log space)
+    def index(self, scale):
+        i = int(round((math.log(scale) - self.log_min) / self.log_step))
+        return min(max(i, 0), len(self.scales) - 1)
+
+    # -> template nearest to scale
+    def pick(self, scale, name = "bottle"):
+        return self.entry(name)[self.index(scale)]
+
+    # template scale for frames of the given width
+    def scale_for_width(self, width):
+        return width / self.ref_width
+
+    def pick_for_width(self, width, name = "bottle"):
+        return self.pick(self.scale_for_width(width), name)
@@ -0,0 +1,93 @@
+#! /usr/bin/env python3
+
+# stand-in for the adb binary, so that devices, fleets and clusters can run
+# without a phone:
+#
+#     rush.py --adb tests/fakeadb.py ...
+#
+# behaviour comes from the environment:
+#
+#     FAKE_DEVICES  serial:model,... listed by adb devices (fake1,fake2)
+#     FAKE_SCREEN   PNG pulled as the screenshot
+#     FAKE_HANG     seconds every command touching the screen or the
+#                   input hangs before answering (0)
+#     FAKE_LOG      file every command line is appended to
+#
+# screen() draws a synthetic first screen of the game to serve
+
+import os
+import shutil
+import sys
+import time
+
+def screen(path, size = (1080, 1920), seed = 0):
+    import cv2
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    w, h = size
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    frame = np.empty((h, w, 3), np.uint8)
+    frame[:] = np.linspace(200, 150, h).astype(np.uint8)[:, None, None]
+
+    for _ in range(3):
+        x, y = rng.integers(20, w - 200), rng.integers(h // 3, 2 * h // 3)
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        cv2.rectangle(frame, (int(x), int(y)), (int(x) + 130, int(y) + 80), color, -1)
+
+    bottle = cv2.imread(os.path.join(root, "bottle.png"))
+    th, tw = bottle.shape[:2]
+    x, y = w // 3, h // 2
+
+    roi = frame[y:y + th, x:x + tw]
+    mask = bottle.sum(axis = 2) < 600
+    roi[mask] = bottle[mask]
+
+    cv2.imwrite(path, frame)
+    return path
+
+def main(argv):
+    if argv[:1] == [ "-s" ]:
+        argv = argv[2:]
+
+    if os.environ.get("FAKE_LOG"):
+        with open(os.environ["FAKE_LOG"], "a") as fp:
+            fp.write(" ".join(argv) + "\n")
+
+    hang = float(os.environ.get("FAKE_HANG", "0"))
+
+    if argv[:1] == [ "devices" ]:
+        print("List of devices attached")
+
+        for dev in os.environ.get("FAKE_DEVICES", "fake1,fake2").split(","):
+            serial, _, model = dev.partition(":")
+            print("%s\tdevice usb:1 product:fake%s" % (serial, " model:" + model if model else ""))
+    elif argv[:3] == [ "shell", "echo", "ok" ]:
+        print("ok")
+    elif argv[:2] == [ "shell", "sleep" ]:
+        time.sleep(float(argv[2]))
+    elif argv[:1] == [ "pull" ]:
+        time.sleep(hang)
+        shutil.copy(os.environ["FAKE_SCREEN"], argv[2])
+    elif argv[:3] == [ "shell", "input", "swipe" ]:
+        time.sleep(hang + int(argv[-1]) / 1000)
+    elif argv[:1] == [ "exec-out" ] and argv[-1].endswith("wc -c"):
+        time.sleep(hang)
+        print(1000)
+    elif argv[:1] == [ "exec-out" ]:
+        sys.stdout.buffer.write(b"\0" * 1000)
+        sys.stdout.flush()
+        time.sleep(hang)
+    elif argv[:2] == [ "forward", "tcp:0" ]:
+        # adb prints the local port it picked
+        time.sleep(hang)
+        print(20000 + os.getpid() % 10000)
+    elif argv[:1] in ([ "shell" ], [ "forward" ], [ "push" ]):
+        time.sleep(hang)
+
+    # anything else (reconnect, connect, ...) just succeeds
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
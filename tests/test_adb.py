@@ -0,0 +1,55 @@
+# deadlines of adb commands, against fakeadb.py
+
+import os
+import tempfile
+import time
+import unittest
+
+import adb as pyadb3
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKE_ADB = os.path.join(HERE, "fakeadb.py")
+
+class TimeoutTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.log = tempfile.mkstemp()
+        os.close(fd)
+        os.environ["FAKE_LOG"] = self.log
+
+        self.client = pyadb3.ADB(FAKE_ADB, connect = False)
+        self.client.set_target_device("t%d" % id(self))
+
+    def tearDown(self):
+        del os.environ["FAKE_LOG"]
+        os.unlink(self.log)
+
+    def resets(self):
+        time.sleep(1)
+
+        with open(self.log) as fp:
+            return fp.read().count("reconnect")
+
+    def test_call_returns_at_the_deadline(self):
+        start = time.time()
+        res = self.client.call([ "shell", "sleep", "5" ], timeout = 0.3)
+
+        self.assertTrue(res.timed_out)
+        self.assertLess(time.time() - start, 0.3 + pyadb3.ADB.KILL_TIMEOUT + 0.5)
+
+    def test_budget_miss_does_not_reset(self):
+        self.client.call([ "shell", "sleep", "5" ], timeout = 0.3)
+        self.assertEqual(self.resets(), 0)
+
+    def test_repeated_timeouts_reset_once(self):
+        for _ in range(pyadb3.ADB.RESET_AFTER):
+            self.client.call([ "shell", "sleep", "5" ], timeout = 0.3)
+
+        self.assertEqual(self.resets(), 1)
+
+    def test_hard_timeout_resets(self):
+        self.client.set_timeout(0.3)
+        self.client.call([ "shell", "sleep", "5" ])
+        self.assertEqual(self.resets(), 1)
+
+if __name__ == "__main__":
+    unittest.main()
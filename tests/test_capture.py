@@ -0,0 +1,127 @@
+# capture transports, with tests/fakeadb.py as the device
+
+import os
+import tempfile
+import unittest
+
+import adb as pyadb3
+import capture
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# encoding choice of LinkAwareCapture, with the link played by grab_with
+class Link(capture.LinkAwareCapture):
+    def __init__(self, stalled):
+        client = pyadb3.ADB(os.path.join(HERE, "fakeadb.py"), connect = False)
+        super(Link, self).__init__(client)
+
+        self.stalled = stalled
+
+    def grab_with(self, enc):
+        if enc in self.stalled:
+            raise TimeoutError("%s stalled" % enc)
+
+        return enc, 100
+
+class EvaluateTest(unittest.TestCase):
+    def test_stalled_encoding_is_skipped(self):
+        link = Link([ "raw" ])
+
+        self.assertEqual(link.grab(), ("png", 100))
+        self.assertIn(link.encoding, ("gzip", "png"))
+        self.assertTrue(link.evaluated)
+        self.assertEqual(link.stats["raw"]["timeouts"], 1)
+
+    def test_every_encoding_stalled(self):
+        link = Link(capture.LinkAwareCapture.ENCODINGS)
+
+        with self.assertRaises(TimeoutError):
+            link.grab()
+
+        self.assertIsNone(link.encoding)
+
+class ExecOutTest(unittest.TestCase):
+    def setUp(self):
+        self.client = pyadb3.ADB(os.path.join(HERE, "fakeadb.py"), connect = False)
+        self.client.set_target_device("e%d" % id(self))
+        self.seen = []
+        pyadb3.ADB.observer = lambda cmd, res: self.seen.append((cmd, res))
+
+    def tearDown(self):
+        pyadb3.ADB.observer = None
+        os.environ.pop("FAKE_HANG", None)
+
+    def test_stream_goes_through_the_client(self):
+        chunks = []
+
+        self.assertEqual(capture.ExecOutCapture(self.client).stream("screencap", chunks.append), 1000)
+        self.assertEqual(sum(map(len, chunks)), 1000)
+        self.assertEqual(self.seen[0][0], [ "exec-out", "screencap" ])
+
+    def test_stream_timeout(self):
+        os.environ["FAKE_HANG"] = "5"
+        cap = capture.ExecOutCapture(self.client)
+        cap.timeout = 0.3
+
+        with self.assertRaises(TimeoutError):
+            cap.stream("screencap", lambda chunk: None)
+
+        self.assertTrue(self.seen[0][1].timed_out)
+
+class StreamSetupTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.log = tempfile.mkstemp()
+        os.close(fd)
+        os.environ["FAKE_LOG"] = self.log
+
+        client = pyadb3.ADB(os.path.join(HERE, "fakeadb.py"), connect = False)
+        client.set_target_device("st%d" % id(self))
+        self.capture = capture.StreamCapture(client)
+
+    def tearDown(self):
+        os.environ.pop("FAKE_HANG", None)
+        del os.environ["FAKE_LOG"]
+        os.unlink(self.log)
+
+    def commands(self):
+        with open(self.log) as fp:
+            return [ line.split() for line in fp ]
+
+    def test_resetup_removes_the_old_forward(self):
+        self.capture.setup()
+        first = self.capture.local_port
+        self.capture.setup()
+
+        self.assertIn([ "forward", "--remove", "tcp:%d" % first ], self.commands())
+
+        # the framebuffer size is probed once and handed to the helper
+        self.assertIn([ "shell", "nohup", "sh", capture.StreamCapture.HELPER_PATH, "serve",
+                        str(capture.StreamCapture.PORT), "1000", ">", "/dev/null", "2>&1", "&" ], self.commands())
+        self.assertNotEqual(self.capture.local_port, first)
+
+    def test_setup_has_a_deadline(self):
+        os.environ["FAKE_HANG"] = "5"
+        capture.StreamCapture.SETUP_TIMEOUT = 0.3
+
+        try:
+            with self.assertRaises(TimeoutError):
+                self.capture.setup()
+        finally:
+            capture.StreamCapture.SETUP_TIMEOUT = 10
+
+        self.assertIsNone(self.capture.local_port)
+
+    def test_first_grab_raises_the_setup_error(self):
+        os.environ["FAKE_HANG"] = "5"
+        capture.StreamCapture.SETUP_TIMEOUT = 0.3
+
+        try:
+            with self.assertRaises(TimeoutError):
+                self.capture.grab()
+        finally:
+            capture.StreamCapture.SETUP_TIMEOUT = 10
+
+        self.assertIsNone(self.capture.thread)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,256 @@
+# coordinator and agents on one box over loopback, devices from fakeadb.py
+
+import base64
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+import cluster
+import jumplog
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+FAKE_ADB = os.path.join(HERE, "fakeadb.py")
+
+CALIB = { "UNIT": 4.4, "PIVOT_POS": [ 139, 311 ], "SCALE": 3.3, "RESIZE": 0.3 }
+
+# rush with short heartbeats and lease, so that the test doesn't wait long
+LAUNCH = """
+import sys
+sys.path.insert(0, %r)
+import cluster, rush
+cluster.Agent.INTERVAL = 0.5
+cluster.Coordinator.HOST_TIMEOUT = 3
+rush.main(sys.argv[1:])
+""" % ROOT
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for(cond, timeout, step = 0.2):
+    end = time.time() + timeout
+
+    while time.time() < end:
+        value = cond()
+
+        if value:
+            return value
+
+        time.sleep(step)
+
+    return cond()
+
+class CoordinatorTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.coordinator = cluster.Coordinator(self.dir).serve()
+        self.client = cluster.RPCClient(self.coordinator.server.server_address)
+
+    def tearDown(self):
+        self.client.close()
+        self.coordinator.server.stop()
+        shutil.rmtree(self.dir)
+
+    def test_shared_device_goes_to_one_host(self):
+        a = self.client.call("heartbeat", host = "a", devices = [ [ "s1", "M" ], [ "s2", "M" ] ])
+        b = self.client.call("heartbeat", host = "b", devices = [ [ "s2", "M" ], [ "s3", "N" ] ])
+
+        self.assertEqual(a["assigned"], [ "s1", "s2" ])
+        self.assertEqual(b["assigned"], [ "s3" ])
+
+        # one calibration per model, asked of one host
+        self.assertEqual(a["calibrate"], [ "s1" ])
+        self.assertEqual(b["calibrate"], [ "s3" ])
+
+    def test_calibration_is_checked_data(self):
+        self.client.call("heartbeat", host = "a", devices = [ [ "s1", "../M" ] ])
+
+        self.assertFalse(self.client.call("calibration", host = "intruder", model = "../M", measure = CALIB))
+        self.assertFalse(self.client.call("calibration", host = "a", model = "../M",
+                                          measure = dict(CALIB, UNIT = "__import__('os')")))
+
+        self.client.call("heartbeat", host = "a", devices = [ [ "s1", "../M" ] ])
+        self.assertTrue(self.client.call("calibration", host = "a", model = "../M", measure = CALIB))
+        self.assertEqual(os.listdir(self.dir), [ "calib-.._M.json" ])
+
+        b = self.client.call("heartbeat", host = "b", devices = [ [ "s2", "../M" ] ])
+        self.assertEqual(b["calibrations"][".._M"]["PIVOT_POS"], CALIB["PIVOT_POS"])
+
+    def test_jumps_resume_from_the_coordinator(self):
+        records = np.zeros(5, jumplog.JUMP)
+        records["dist"] = np.arange(5)
+        data = lambda r: base64.b64encode(r.tobytes()).decode()
+
+        self.assertEqual(self.client.call("jumps", host = "a", serial = "s1"), 0)
+        self.assertEqual(self.client.call("jumps", host = "a", serial = "s1", start = 0, records = data(records[:3])), 3)
+        # a resend of what the coordinator already has is ignored
+        self.assertEqual(self.client.call("jumps", host = "a", serial = "s1", start = 0, records = data(records[:3])), 3)
+        self.assertEqual(self.client.call("jumps", host = "a", serial = "s1", start = 3, records = data(records[3:])), 5)
+
+        self.coordinator.logs["a", "s1"].flush()
+        got = jumplog.JumpLog.load(os.path.join(self.dir, "a-s1.jumps"))
+        self.assertEqual(got.tobytes(), records.tobytes())
+
+    def test_oversized_message_is_refused(self):
+        with socket.create_connection(self.coordinator.server.server_address) as s:
+            s.sendall(struct.pack("<I", cluster.MAX_MESSAGE + 1))
+            self.assertEqual(s.recv(1), b"")
+
+    def test_secret(self):
+        coordinator = cluster.Coordinator(tempfile.mkdtemp(), secret = "k").serve()
+
+        try:
+            with self.assertRaises(EOFError):
+                cluster.RPCClient(coordinator.server.server_address).call("status")
+
+            self.assertEqual(cluster.RPCClient(coordinator.server.server_address, secret = "k").call("status"), {})
+        finally:
+            coordinator.server.stop()
+            shutil.rmtree(coordinator.path)
+
+class AgentTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+        # a coordinator that accepts and never answers, as behind a partition
+        self.silent = socket.socket()
+        self.silent.bind(("127.0.0.1", 0))
+        self.silent.listen()
+
+        self.agent = cluster.Agent(self.silent.getsockname(), [], [], name = "a", path = self.dir,
+                                   adb_path = FAKE_ADB)
+        self.agent.set_lease(2)
+
+    def tearDown(self):
+        self.silent.close()
+        shutil.rmtree(self.dir)
+
+    def test_heartbeat_is_not_retried_after_a_timeout(self):
+        start = time.monotonic()
+
+        with self.assertRaises(socket.timeout):
+            self.agent.heartbeat()
+
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_lease_runs_out_while_the_heartbeat_hangs(self):
+        self.agent.fleet.serials = [ "s1" ]
+        self.agent.last_ok = time.monotonic()
+
+        # step blocks on the heartbeat, the watchdog doesn't
+        self.assertTrue(wait_for(lambda: self.agent.fleet.serials == [], 2))
+
+class LoopbackTest(unittest.TestCase):
+    TIMEOUT = 90
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.procs = []
+
+        import fakeadb
+        self.env = dict(os.environ, FAKE_SCREEN = fakeadb.screen(os.path.join(self.dir, "screen.png")))
+
+    def tearDown(self):
+        for proc in self.procs:
+            try:
+                os.killpg(proc.pid, 15)
+            except ProcessLookupError:
+                pass
+
+        for proc in self.procs:
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+        shutil.rmtree(self.dir)
+
+    def rush(self, name, argv, **env):
+        log = open(os.path.join(self.dir, name + ".log"), "w")
+        proc = subprocess.Popen([ sys.executable, "-c", LAUNCH ] + argv, cwd = self.dir,
+                                env = dict(self.env, **env), stdout = log, stderr = subprocess.STDOUT,
+                                start_new_session = True)
+        self.procs.append(proc)
+        return proc
+
+    def agent(self, name, port, devices):
+        return self.rush(name, [ "--adb", FAKE_ADB, "--bottle", os.path.join(ROOT, "bottle.png"),
+                                 "agent", "--coordinator", "127.0.0.1:%d" % port, "--name", name,
+                                 "--dir", name, "--", "--mode", "auto" ],
+                         FAKE_DEVICES = devices)
+
+    def kill(self, proc):
+        # the agent and its fleet workers
+        os.killpg(proc.pid, 15)
+        proc.wait(10)
+
+    def test_two_coordinators_three_agents(self):
+        ports = free_port(), free_port()
+
+        for name, port in zip(("ca", "cb"), ports):
+            self.rush(name, [ "coordinator", "--port", str(port), "--dir", name, "--report", "1" ])
+
+        clients = [ cluster.RPCClient(("127.0.0.1", port)) for port in ports ]
+        wait_for(lambda: all(os.path.exists(os.path.join(self.dir, name)) for name in ("ca", "cb")), 10)
+
+        h1 = self.agent("h1", ports[0], "s1:Pixel_5,s2:Pixel_5,s3:SM-G991B")
+        self.agent("h2", ports[0], "s2:Pixel_5,s3:SM-G991B,s4:Pixel_5")
+        self.agent("h3", ports[1], "s9:Pixel_5")
+
+        # every device of a coordinator played by exactly one host, every
+        # model calibrated once and handed to the hosts that need it
+        def settled():
+            status = clients[0].call("status")
+
+            if sorted(status) != [ "h1", "h2" ]:
+                return None
+
+            played = sorted(s for h in status.values() for s in h["assigned"])
+            running = sorted(row[0] for h in status.values() for row in h["workers"])
+
+            return played == running == [ "s1", "s2", "s3", "s4" ] and status
+
+        status = wait_for(settled, LoopbackTest.TIMEOUT)
+        self.assertTrue(status, "cluster never settled: %s" % clients[0].call("status"))
+
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dir, "ca"))),
+                         [ "calib-Pixel_5.json", "calib-SM-G991B.json" ] +
+                         sorted("%s-%s.jumps" % (h, s) for h in status for s in status[h]["assigned"]))
+
+        for host in status:
+            for model in set(status[host]["devices"][s] for s in status[host]["assigned"]):
+                self.assertTrue(os.path.exists(os.path.join(self.dir, host, "measure-%s.py" % model)))
+
+        self.assertTrue(wait_for(lambda: clients[1].call("status").get("h3", {}).get("workers"), 30))
+
+        # the collected jump logs are the agents' own
+        def shipped():
+            host, serial = next((h, s) for h in status for s in status[h]["assigned"])
+            got = jumplog.JumpLog.load(os.path.join(self.dir, "ca", "%s-%s.jumps" % (host, serial)))
+            local = jumplog.JumpLog.load(os.path.join(self.dir, host, "%s.jumps" % serial))
+
+            return len(got) and got.tobytes() == local[:len(got)].tobytes()
+
+        self.assertTrue(wait_for(shipped, 30))
+
+        # a host that goes away leaves its devices to the other one where it can
+        self.kill(h1)
+
+        def failed_over():
+            status = clients[0].call("status")
+            return list(status) == [ "h2" ] and status["h2"]["assigned"] == [ "s2", "s3", "s4" ]
+
+        self.assertTrue(wait_for(failed_over, 20))
+
+if __name__ == "__main__":
+    unittest.main()
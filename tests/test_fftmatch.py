@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+import fakeadb
+import fftmatch
+import refrac
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class CorrelatorTest(unittest.TestCase):
+    def setUp(self):
+        dir = tempfile.mkdtemp()
+
+        try:
+            self.frame = cv2.resize(cv2.imread(fakeadb.screen(os.path.join(dir, "s.png"))), None, fx = 0.3, fy = 0.3)
+        finally:
+            shutil.rmtree(dir)
+
+        self.template = cv2.resize(cv2.imread(os.path.join(ROOT, "bottle.png"), 0), None, fx = 0.3, fy = 0.3)
+
+    def correlate(self, gray):
+        corr = fftmatch.Correlator((gray.shape[1], gray.shape[0]))
+        corr.add("bottle", self.template)
+        corr.transform(gray)
+
+        return corr.correlate("bottle"), cv2.matchTemplate(gray, self.template, cv2.TM_CCOEFF_NORMED)
+
+    def test_as_match_template(self):
+        res, expected = self.correlate(cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY))
+
+        self.assertEqual(res.shape, expected.shape)
+        self.assertLess(np.abs(res - expected).max(), 1e-3)
+        self.assertEqual(res.argmax(), expected.argmax())
+
+    def test_flat_frame(self):
+        res, expected = self.correlate(np.full(self.frame.shape[:2], 200, np.uint8))
+
+        # no structure to match, both score about 0 everywhere
+        self.assertLess(np.abs(res - expected).max(), 1e-3)
+        self.assertLess(np.abs(res).max(), 1e-3)
+
+    def test_calib_scale(self):
+        marker = refrac.Marker(os.path.join(ROOT, "bottle.png"))
+
+        # the frame-scaled sweep of Marker.calib
+        scales = np.linspace(*refrac.Marker.CALIB_SCALES).tolist()
+        expected = max(scales, key = lambda scale: marker.find_bottle_template(refrac.Util.resize(self.frame, scale))[1])
+
+        self.assertEqual(marker.calib_scale_fft(self.frame), expected)
+
+if __name__ == "__main__":
+    unittest.main()
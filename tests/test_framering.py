@@ -0,0 +1,69 @@
+import multiprocessing
+import unittest
+
+import numpy as np
+
+import framering
+
+def read_in_child(name, n, out):
+    ring = framering.FrameRing.attach(name)
+
+    try:
+        res = ring.read(n)
+        out.put(None if res is None else int(res[1].sum()))
+    finally:
+        ring.close()
+
+class FrameRingTest(unittest.TestCase):
+    def setUp(self):
+        self.ring = framering.FrameRing.create((4, 6, 3), slots = 3)
+
+    def tearDown(self):
+        self.ring.close()
+
+    def frame(self, value):
+        return np.full((4, 6, 3), value, np.uint8)
+
+    def test_frame_being_written_is_not_handed_out(self):
+        self.ring.write(self.frame(1))
+        self.ring.claim()[:] = 2
+
+        # frame 1 is claimed, not committed: readers get frame 0
+        self.assertIsNone(self.ring.read(1))
+        self.assertEqual(self.ring.latest()[0], 0)
+
+    def test_overwritten_frame(self):
+        for i in range(3):
+            self.ring.write(self.frame(i))
+
+        n, view = self.ring.read(0)
+        self.assertTrue(self.ring.valid(n))
+
+        # frame 3 lands in the slot of frame 0 while a reader holds its view
+        self.ring.write(self.frame(3))
+
+        self.assertFalse(self.ring.valid(n))
+        self.assertIsNone(self.ring.read(0))
+        self.assertIsNone(self.ring.copy(0))
+        self.assertEqual(int(view[0, 0, 0]), 3)
+
+    def test_slow_reader_skips_ahead(self):
+        for i in range(5):
+            self.ring.write(self.frame(i))
+
+        # past the oldest frame still in the ring, the next to be overwritten
+        self.assertEqual(self.ring.next(0)[0], 3)
+        self.assertIsNone(self.ring.next(4))
+
+    def test_other_process_sees_the_frame(self):
+        self.ring.write(self.frame(7))
+        out = multiprocessing.Queue()
+
+        proc = multiprocessing.Process(target = read_in_child, args = (self.ring.name, 0, out))
+        proc.start()
+        proc.join(30)
+
+        self.assertEqual(out.get(timeout = 5), 7 * 4 * 6 * 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import time
+import unittest
+
+import numpy as np
+
+import governor
+import metrics
+
+class CaptureGovernorTest(unittest.TestCase):
+    def frame(self, value):
+        return np.full((56, 32), value, np.uint8)
+
+    def test_landing_ends_on_a_still_scene(self):
+        gov = governor.CaptureGovernor()
+        gov.pressed(0)
+        gov.landing_at = time.time() - 0.1
+
+        for _ in range(governor.CaptureGovernor.SETTLE_FRAMES + 1):
+            gov.observe(self.frame(100))
+
+        self.assertTrue(gov.ready())
+        self.assertEqual(gov.unsettled, 0)
+
+    def test_landing_ends_on_a_moving_scene(self):
+        gov = governor.CaptureGovernor()
+        gov.pressed(0)
+
+        gov.landing_at = time.time() - 0.1
+        gov.observe(self.frame(0))
+        gov.observe(self.frame(100))
+        self.assertFalse(gov.ready())
+
+        gov.landing_at = time.time() - governor.CaptureGovernor.MAX_SETTLE
+        gov.observe(self.frame(0))
+        self.assertTrue(gov.ready())
+        self.assertEqual(gov.unsettled, 1)
+
+    def test_metrics_are_exported(self):
+        gov = governor.CaptureGovernor(2, 10)
+        gov.observe(self.frame(0))
+        gov.delay()
+
+        loop = metrics.LoopMetrics(metrics.Registry())
+        loop.set_governor(gov.metrics())
+
+        self.assertEqual(loop.fps.value(), 2)
+        self.assertEqual(loop.activity.value(), 0)
+
+if __name__ == "__main__":
+    unittest.main()
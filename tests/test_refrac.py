@@ -0,0 +1,124 @@
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import refrac
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class MarkerTest(unittest.TestCase):
+    def setUp(self):
+        self.measure = refrac.Measure.UNIT, refrac.Measure.PIVOT_POS
+        refrac.Measure.UNIT, refrac.Measure.PIVOT_POS = 4.4, (162, 288)
+
+    def tearDown(self):
+        refrac.Measure.UNIT, refrac.Measure.PIVOT_POS = self.measure
+
+    def test_color_locator_without_bottle(self):
+        marker = refrac.Marker(os.path.join(ROOT, "bottle.png"), locator = "color")
+        screen = np.full((576, 324, 3), 200, np.uint8)
+
+        pos, score = marker.find_bottle(screen)
+
+        self.assertEqual(len(pos), 2)
+        self.assertEqual(score, 0)
+
+        # and the target can still be predicted from it
+        marker.next(screen, pos)
+
+    def test_mark_leaves_the_frame_alone(self):
+        import cv2
+        import fakeadb
+
+        dir = tempfile.mkdtemp()
+
+        try:
+            frame = cv2.resize(cv2.imread(fakeadb.screen(os.path.join(dir, "s.png"))), None, fx = 0.3, fy = 0.3)
+        finally:
+            shutil.rmtree(dir)
+
+        for locator in ("template", "check"):
+            marker = refrac.Marker(os.path.join(ROOT, "bottle.png"), locator = locator)
+            marker.bottle = cv2.resize(marker.bottle, None, fx = 0.3, fy = 0.3)
+
+            screen = frame.copy()
+            res = marker.mark(screen)
+            self.assertTrue(np.array_equal(screen, frame))
+            self.assertIsNotNone(marker.bottle_box)
+
+            # drawn only on display, the same marks either way
+            marker.display(screen, *res)
+            self.assertFalse(np.array_equal(screen, frame))
+            self.assertEqual(marker.mark(frame.copy()), res)
+
+    def test_mark_batch_uses_the_locator(self):
+        import cv2
+        import fakeadb
+
+        dir = tempfile.mkdtemp()
+
+        try:
+            frames = np.stack([ cv2.resize(cv2.imread(fakeadb.screen(os.path.join(dir, "%d.png" % i), seed = i)),
+                                           None, fx = 0.3, fy = 0.3) for i in range(4) ])
+        finally:
+            shutil.rmtree(dir)
+
+        for locator in ("template", "color"):
+            marker = refrac.Marker(os.path.join(ROOT, "bottle.png"), locator = locator)
+            marker.bottle = cv2.resize(marker.bottle, None, fx = 0.3, fy = 0.3)
+
+            bottle, next, dist = marker.mark_batch(frames, chunk = 2)
+
+            for i, frame in enumerate(frames):
+                self.assertEqual(tuple(bottle[i]), marker.find_bottle(frame)[0])
+
+        with self.assertRaises(ValueError):
+            refrac.Marker(os.path.join(ROOT, "bottle.png"), coarse = 0.25).mark_batch(frames)
+
+def save_often(path, key):
+    muscle = refrac.Muscle(True, path, key)
+
+    for i in range(20):
+        muscle.landings = i + 1
+        muscle.save()
+
+class MuscleTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "muscle.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_workers_keep_each_others_models(self):
+        procs = [ multiprocessing.Process(target = save_often, args = (self.path, "d%d" % i)) for i in range(4) ]
+
+        for proc in procs:
+            proc.start()
+
+        for proc in procs:
+            proc.join(30)
+
+        with open(self.path) as fp:
+            states = json.load(fp)
+
+        self.assertEqual(sorted(states), [ "d0", "d1", "d2", "d3" ])
+        self.assertTrue(all(state["landings"] == 20 for state in states.values()))
+
+    def test_landings_are_flushed(self):
+        muscle = refrac.Muscle(True, self.path, "d")
+
+        self.assertTrue(muscle.landed(100, 250, 5))
+        self.assertTrue(muscle.landed(100, 250, 5))
+        self.assertEqual(refrac.Muscle(True, self.path, "d").landings, 1)
+
+        muscle.flush()
+        self.assertEqual(refrac.Muscle(True, self.path, "d").landings, 2)
+
+if __name__ == "__main__":
+    unittest.main()
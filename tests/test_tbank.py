@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import tbank
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class TemplateBankTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        shutil.copy(os.path.join(ROOT, "bottle.png"), os.path.join(self.dir, "sprite.png"))
+
+        self.bank = tbank.TemplateBank.build(os.path.join(ROOT, "bottle.png"), os.path.join(self.dir, "*.png"), steps = 12)
+        self.path = os.path.join(self.dir, "bank.npz")
+        self.bank.save(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_load_reads_only_what_is_picked(self):
+        bank = tbank.TemplateBank.load(self.path)
+
+        self.assertEqual(bank.names, [ "bottle", "sprite" ])
+        self.assertEqual(bank.entries, {})
+
+        template = bank.pick_for_width(324)
+        self.assertEqual(list(bank.entries), [ "bottle" ])
+
+        self.assertTrue(np.array_equal(template, self.bank.pick_for_width(324)))
+
+    def test_resave(self):
+        path = os.path.join(self.dir, "copy.npz")
+        tbank.TemplateBank.load(self.path).save(path)
+
+        self.assertTrue(np.array_equal(tbank.TemplateBank.load(path).pick(0.5, "sprite"), self.bank.pick(0.5, "sprite")))
+
+if __name__ == "__main__":
+    unittest.main()
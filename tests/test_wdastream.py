@@ -0,0 +1,137 @@
+# MJPEGReader against the MJPEGStandIn server, WDASession against a raw one
+
+import socket
+import threading
+import time
+import unittest
+
+import cv2
+import numpy as np
+
+import wdastream
+
+def jpeg(value):
+    return cv2.imencode(".jpg", np.full((64, 36, 3), value, np.uint8))[1].tobytes()
+
+class MJPEGReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.server = wdastream.MJPEGStandIn([ jpeg(0), jpeg(255) ], fps = 50).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_wait_newer(self):
+        reader = wdastream.MJPEGReader(self.server.url).start()
+
+        try:
+            seq, img = reader.wait_newer(0, 0.5, timeout = 5)
+            self.assertGreater(seq, 0)
+            self.assertEqual(img.shape[:2], (32, 18))
+
+            newer, _ = reader.wait_newer(seq, 0.5, timeout = 5)
+            self.assertGreater(newer, seq)
+        finally:
+            reader.stop()
+
+    def test_no_frame_times_out(self):
+        # never started, nothing ever arrives
+        reader = wdastream.MJPEGReader(self.server.url)
+
+        with self.assertRaises(TimeoutError):
+            reader.wait_newer(0, timeout = 0.2)
+
+        with self.assertRaises(TimeoutError):
+            reader.latest(timeout = 0.2)
+
+# answers the first request of every connection, then acts as told:
+# "close" drops the connection, "hang" never answers the next request
+class RawServer:
+    REPLY = b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: 15\r\n\r\n{\"value\": null}"
+
+    def __init__(self, then):
+        self.then = then
+        self.requests = []
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen()
+        threading.Thread(target = self.serve, daemon = True).start()
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.sock.getsockname()
+
+    def read_request(self, fp):
+        line = fp.readline()
+
+        if not line:
+            return False
+
+        length = 0
+
+        for header in iter(fp.readline, b"\r\n"):
+            key, _, value = header.partition(b":")
+
+            if key.lower() == b"content-length":
+                length = int(value)
+
+        fp.read(length)
+        self.requests.append(line.split()[1].decode())
+        return True
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+
+            threading.Thread(target = self.handle, args = (conn,), daemon = True).start()
+
+    def handle(self, conn):
+        fp = conn.makefile("rb")
+
+        if self.read_request(fp):
+            conn.sendall(RawServer.REPLY)
+
+        if self.then == "hang":
+            self.read_request(fp)
+            threading.Event().wait()
+
+        conn.close()
+
+    def close(self):
+        self.sock.close()
+
+class WDASessionTest(unittest.TestCase):
+    def test_dropped_pooled_connection_is_retried(self):
+        server = RawServer("close")
+        session = wdastream.WDASession(server.url, timeout = 2)
+
+        try:
+            session.request("GET", "/status")
+            time.sleep(0.2) # the server closes the kept connection
+            session.request("GET", "/status")
+        finally:
+            server.close()
+
+        self.assertEqual(server.requests, [ "/status", "/status" ])
+
+    def test_timed_out_press_is_not_sent_again(self):
+        server = RawServer("hang")
+        session = wdastream.WDASession(server.url, timeout = 0.3)
+        session.session_id = "s"
+
+        try:
+            session.request("GET", "/status")
+
+            with self.assertRaises(socket.timeout):
+                session.taphold(1, 2, 100)
+
+            time.sleep(0.3)
+        finally:
+            server.close()
+
+        self.assertEqual(server.requests, [ "/status", "/session/s/wda/touchAndHold" ])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+#! /usr/bin/python3
+
+# remote viewer for annotated frames, MJPEG over HTTP
+#
+#     http://host:port/        page showing the stream
+#     http://host:port/stream  multipart/x-mixed-replace JPEG stream
+#
+# the loop asks wants_frame() before drawing anything; it is false while no
+# client is connected and between frames of the capped rate, so unwatched
+# workers pay neither drawing nor encoding. encoding runs on its own thread
+
+import http.server
+import socketserver
+import threading
+import time
+
+import cv2
+
+PAGE = b"""<!doctype html>
+<html><head><title>bottle-rush</title></head>
+<body style="margin:0;background:#222"><img src="/stream" style="height:100vh"></body>
+</html>
+"""
+
+BOUNDARY = "frame"
+
+class FrameViewer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port = 8080, fps = 5, quality = 70, host = "127.0.0.1"):
+        self.fps = fps
+        self.quality = quality
+
+        self.clients = 0
+        self.last_submit = 0
+
+        self.cond = threading.Condition()
+        self.pending = None # frame waiting to be encoded
+        self.jpeg = None
+        self.seq = 0 # frames encoded
+
+        self.stopped = threading.Event()
+
+        super(FrameViewer, self).__init__((host, port), FrameViewerHandler)
+
+    @property
+    def url(self):
+        return "http://%s:%d/" % self.server_address[:2]
+
+    def start(self):
+        threading.Thread(target = self.serve_forever, name = "viewer-http", daemon = True).start()
+        threading.Thread(target = self.encode_loop, name = "viewer-encode", daemon = True).start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+        with self.cond:
+            self.cond.notify_all()
+
+        self.shutdown()
+        self.server_close()
+
+    # should the loop draw and submit the current frame
+    def wants_frame(self):
+        return self.clients > 0 and time.time() - self.last_submit >= 1 / self.fps
+
+    # hand over an annotated frame, the loop must not draw on it afterwards
+    def submit(self, frame):
+        self.last_submit = time.time()
+
+        with self.cond:
+            self.pending = frame
+            self.cond.notify_all()
+
+    def encode_loop(self):
+        params = [ int(cv2.IMWRITE_JPEG_QUALITY), self.quality ]
+
+        while not self.stopped.is_set():
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending is not None or self.stopped.is_set())
+                frame, self.pending = self.pending, None
+
+            if frame is None:
+                continue
+
+            ok, buf = cv2.imencode(".jpg", frame, params)
+
+            if not ok:
+                continue
+
+            with self.cond:
+                self.jpeg = buf.tobytes()
+                self.seq += 1
+                self.cond.notify_all()
+
+    # block until a frame newer than seq is encoded -> (seq, jpeg)
+    def wait_frame(self, seq, timeout = 5):
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq > seq or self.stopped.is_set(), timeout)
+            return self.seq, self.jpeg
+
+class FrameViewerHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/":
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(PAGE)))
+            self.end_headers()
+            self.wfile.write(PAGE)
+        elif self.path == "/stream":
+            self.stream()
+        else:
+            self.send_error(404)
+
+    def stream(self):
+        server = self.server
+
+        self.send_response(200)
+        self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=%s" % BOUNDARY)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        with server.cond:
+            server.clients += 1
+
+        seq = 0
+
+        try:
+            while not server.stopped.is_set():
+                new, jpeg = server.wait_frame(seq)
+
+                if new == seq or jpeg is None:
+                    continue
+
+                seq = new
+
+                self.wfile.write(("--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n" %
+                                  (BOUNDARY, len(jpeg))).encode())
+                self.wfile.write(jpeg)
+                self.wfile.write(b"\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with server.cond:
+                server.clients -= 1
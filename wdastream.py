@@ -0,0 +1,310 @@
+#! /usr/bin/python3
+
+# WebDriverAgent frame source and command session for iOS devices
+#
+# instead of a full HTTP request + PNG round trip per screenshot, MJPEGReader
+# keeps WDA's MJPEG stream (mjpegServerPort, 9100 by default) open on a
+# background thread and only decodes the newest frame when it's asked for,
+# at reduced scale. WDASession sends commands over pooled keep-alive
+# connections instead of opening one per request.
+#
+# MJPEGStandIn serves a fixed set of JPEG frames and records commands, so
+# both can be tried without a device.
+
+import http.client
+import http.server
+import json
+import queue
+import socketserver
+import threading
+import time
+
+from urllib.parse import urlsplit
+
+import decode
+
+def connect(url, timeout = None):
+    parts = urlsplit(url)
+
+    if parts.scheme == "https":
+        return http.client.HTTPSConnection(parts.hostname, parts.port or 443, timeout = timeout)
+
+    return http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout = timeout)
+
+class MJPEGReader:
+    RECONNECT_DELAY = 1
+
+    def __init__(self, url = "http://localhost:9100", timeout = 5):
+        self.url = url
+        self.timeout = timeout
+
+        self.cond = threading.Condition()
+        self.jpeg = None # newest undecoded frame
+        self.seq = 0 # frames received
+
+        self.decoded = None # (seq, scale, img) cache
+        self.decoder = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target = self.loop, name = "mjpeg", daemon = True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def loop(self):
+        while not self.stopped.is_set():
+            try:
+                self.read_stream()
+            except Exception as e:
+                if not self.stopped.is_set():
+                    print("[W] mjpeg stream %s: %s" % (self.url, e))
+
+            self.stopped.wait(MJPEGReader.RECONNECT_DELAY)
+
+    def read_stream(self):
+        conn = connect(self.url, self.timeout)
+        path = urlsplit(self.url).path or "/"
+
+        try:
+            conn.request("GET", path)
+            resp = conn.getresponse()
+
+            if resp.status != 200:
+                raise IOError("HTTP %d" % resp.status)
+
+            while not self.stopped.is_set():
+                jpeg = self.read_part(resp)
+
+                with self.cond:
+                    self.jpeg = jpeg
+                    self.seq += 1
+                    self.cond.notify_all()
+        finally:
+            conn.close()
+
+    # read one part of the multipart/x-mixed-replace stream
+    def read_part(self, resp):
+        length = None
+
+        # part headers up to the empty line, skipping the boundary line
+        while True:
+            line = resp.fp.readline()
+
+            if not line:
+                raise EOFError("stream closed")
+
+            line = line.strip()
+
+            if not line:
+                if length is not None:
+                    break
+                continue
+
+            key, _, value = line.partition(b":")
+
+            if key.strip().lower() == b"content-length":
+                length = int(value)
+
+        data = resp.fp.read(length)
+
+        if len(data) != length:
+            raise EOFError("stream closed")
+
+        return data
+
+    # newest frame decoded at scale -> (seq, img), waits for the first frame
+    # and raises TimeoutError if there is none after timeout seconds;
+    # frames that arrive in between are never decoded
+    def latest(self, scale = 1.0, timeout = None):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.jpeg is not None, timeout):
+                raise TimeoutError("no frame from %s in %.1fs" % (self.url, timeout))
+
+            seq, jpeg = self.seq, self.jpeg
+
+        cached = self.decoded
+
+        if cached is not None and cached[0] == seq and cached[1] == scale:
+            return seq, cached[2]
+
+        if self.decoder is None or self.decoder.scale != scale:
+            self.decoder = decode.Decoder(scale)
+
+        img = self.decoder.decode(jpeg)
+        self.decoded = seq, scale, img
+
+        return seq, img
+
+    # block until a frame newer than seq arrives -> (seq, img), raises
+    # TimeoutError if none does in timeout seconds
+    def wait_newer(self, seq, scale = 1.0, timeout = None):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.seq > seq, timeout):
+                raise TimeoutError("no frame after %d from %s in %.1fs" % (seq, self.url, timeout))
+
+        return self.latest(scale, timeout)
+
+class WDASession:
+    POOL_SIZE = 2
+
+    def __init__(self, url = "http://localhost:8100", timeout = 10):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+        self.pool = queue.LifoQueue()
+        self.session_id = None
+
+    # -> (connection, whether it was used before)
+    def conn(self):
+        try:
+            return self.pool.get_nowait(), True
+        except queue.Empty:
+            return connect(self.url, self.timeout), False
+
+    def release(self, conn):
+        if self.pool.qsize() < WDASession.POOL_SIZE:
+            self.pool.put(conn)
+        else:
+            conn.close()
+
+    # one JSON request over a pooled keep-alive connection -> decoded value
+    def request(self, method, path, body = None):
+        data = None if body is None else json.dumps(body).encode()
+        headers = { "Content-Type": "application/json", "Connection": "keep-alive" }
+
+        while True:
+            conn, reused = self.conn()
+
+            try:
+                conn.request(method, path, data, headers)
+                resp = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+
+                # the server dropped the idle pooled connection before
+                # answering anything, the request never ran: once more on
+                # a fresh one. a timeout may have reached the server, a
+                # touchAndHold sent twice is two presses
+                if reused:
+                    continue
+                raise
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                raise
+
+            try:
+                payload = resp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                raise
+
+            if resp.will_close:
+                conn.close()
+            else:
+                self.release(conn)
+
+            return json.loads(payload.decode() or "null")
+
+    def session(self):
+        if self.session_id is None:
+            res = self.request("POST", "/session", { "capabilities": {} })
+            self.session_id = res.get("sessionId") or res.get("value", {}).get("sessionId")
+
+        return self.session_id
+
+    # duration in ms, as for AndroidDevice.taphold
+    def taphold(self, x, y, duration):
+        return self.request("POST", "/session/%s/wda/touchAndHold" % self.session(),
+                            { "x": x, "y": y, "duration": duration / 1000 })
+
+    # full PNG screenshot, for when there is no MJPEG stream
+    def screenshot(self):
+        import base64
+        return base64.b64decode(self.request("GET", "/screenshot")["value"])
+
+    def close(self):
+        while not self.pool.empty():
+            self.pool.get_nowait().close()
+
+class MJPEGStandIn(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    BOUNDARY = "--BoundaryString"
+
+    # frames :: list of JPEG byte strings served round robin at fps
+    def __init__(self, frames, fps = 30, addr = ("127.0.0.1", 0)):
+        self.frames = frames
+        self.fps = fps
+        self.commands = [] # (method, path, body) received
+        self.connections = 0 # TCP connections accepted
+
+        super(MJPEGStandIn, self).__init__(addr, MJPEGStandInHandler)
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address[:2]
+
+    def get_request(self):
+        self.connections += 1
+        return super(MJPEGStandIn, self).get_request()
+
+    def start(self):
+        threading.Thread(target = self.serve_forever, daemon = True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class MJPEGStandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != "/":
+            return self.reply({ "value": None })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=%s" % MJPEGStandIn.BOUNDARY)
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        i = 0
+
+        try:
+            while True:
+                jpeg = self.server.frames[i % len(self.server.frames)]
+                self.wfile.write(("%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n" %
+                                  (MJPEGStandIn.BOUNDARY, len(jpeg))).encode())
+                self.wfile.write(jpeg)
+                self.wfile.write(b"\r\n")
+                i += 1
+                time.sleep(1 / self.server.fps)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"null")
+        self.server.commands.append(("POST", self.path, body))
+
+        if self.path == "/session":
+            return self.reply({ "sessionId": "standin", "value": { "sessionId": "standin" } })
+
+        self.reply({ "value": None })
+
+    def reply(self, obj):
+        data = json.dumps(obj).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)